@@ -0,0 +1,369 @@
+"""
+A local stand-in for the MWS Products, Reports and FulfillmentInventory APIs, for exercising and benchmarking the
+Routine pipeline without live credentials.
+
+Responses are replayed from the records in Amazon/DataFiles/archive when a capture for the requested id exists, and
+are otherwise synthesised from templates. Each Action is throttled with the same quotas as Routine.throt
+(maxreqquota, restorerate), answering with MWS's 503 RequestThrottled error when a request would overdraw it.
+
+To point the MWS clients at it, set the MWS_STANDIN environment variable to 'host:port' before starting the routine
+(MWSManager reads it when it opens its connections, so it also reaches processes started with spawn).
+"""
+
+import hashlib
+import io
+import random
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+from AmazonSelling.archive import get_archive
+from AmazonSelling.throttle import TokenBucket
+
+
+productsNs = 'http://mws.amazonservices.com/schema/Products/2011-10-01'
+inventoryNs = 'http://mws.amazonaws.com/FulfillmentInventory/2010-10-01/'
+reportsNs = 'http://mws.amazonaws.com/doc/2009-01-01/'
+
+# Action: (Routine.throt key, boto operation name, record element, the attribute holding the record's id)
+standInActions = {
+    'ListMatchingProducts':          ('lmp',       None,                                 None, None),
+    'GetMatchingProduct':            ('gmp',       None,                                 None, None),
+    'GetMatchingProductForId':       ('gmpfId',    'get_matching_product_for_id',        'GetMatchingProductForIdResult', 'Id'),
+    'GetCompetitivePricingForASIN':  ('gcpfAsin',  'get_competitive_pricing_for_asin',   'GetCompetitivePricingForASINResult', 'ASIN'),
+    'GetLowestOfferListingsForASIN': ('glolfAsin', 'get_lowest_offer_listings_for_asin', 'GetLowestOfferListingsForASINResult', 'ASIN'),
+    'GetLowestPricedOffersForASIN':  ('glpofAsin', None,                                 None, None),
+    'GetMyFeesEstimate':             ('gmfe',      None,                                 None, None),
+    'GetMyPriceForASIN':             ('gmpfAsin',  None,                                 None, None),
+    'GetProductCategoriesForASIN':   ('gpcfAsin',  None,                                 None, None),
+    'ListInventorySupply':           ('lis',       None,                                 None, None),
+    'RequestReport':                 ('rr',        None,                                 None, None),
+    'GetReportRequestList':          ('grrl',      None,                                 None, None),
+    'GetReportList':                 ('grl',       None,                                 None, None),
+    'GetReport':                     ('gr',        None,                                 None, None)}
+
+# Reports quotas, which aren't in Routine.throt since the Routine doesn't use them. Restore rates are per second.
+reportsThrot = {
+    'rr':   {'maxreqquota': 15, 'restorerate': 1 / 60},
+    'grrl': {'maxreqquota': 10, 'restorerate': 1 / 45},
+    'grl':  {'maxreqquota': 10, 'restorerate': 1 / 60},
+    'gr':   {'maxreqquota': 15, 'restorerate': 1 / 60}}
+
+
+class MWSStandIn:
+    """
+    Serves MWS-formatted responses on http://<host>:<port>. Use start()/stop(), or serve_forever() from __main__.
+    <latency> is the (minimum, maximum) seconds added to every response.
+    <replay> turns replaying archived records on or off. <seed> makes the synthesised data and latencies repeatable.
+    """
+
+    def __init__(self, host='localhost', port=8765, latency=(0.05, 0.25), replay=True, seed=0):
+        from AmazonSelling.routine import Routine
+
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.rand = random.Random(seed)
+        self.randLock = threading.Lock()
+        self.nextReportId = 50000000000
+
+        throt = dict(Routine.throt, **reportsThrot)
+        self.quotas = {op: TokenBucket(throt[op]['maxreqquota'], throt[op]['restorerate']) for op in throt}
+        self.stats = {action: {'requests': 0, 'items': 0, 'throttled': 0} for action in standInActions}
+        self.statsLock = threading.Lock()  # The handlers run in the server's threads
+
+        self.records = self.load_records() if replay else {}
+        self.server = None
+        self.thread = None
+
+    def load_records(self):
+        """
+        Returns {(boto operation, id): record xml} for every record in the archive. Later captures win.
+        """
+
+        records = {}
+        archive = get_archive('Amazon')
+        wanted = {val[1]: val[2:] for val in standInActions.values() if val[1]}
+        for entry in archive.find():
+            if entry['op'] not in wanted:
+                continue
+            recordTag, idAttrib = wanted[entry['op']]
+            try:
+                root = ET.fromstring(archive.read(entry))
+            except (ET.ParseError, OSError):
+                continue
+            for el in root.iter('{{{}}}{}'.format(productsNs, recordTag)):
+                if idAttrib in el.attrib:
+                    records[(entry['op'], el.attrib[idAttrib])] = ET.tostring(el, encoding='unicode')
+
+        print('MWSStandIn: loaded {} archived records for replay'.format(len(records)))
+        return records
+
+    def start(self):
+        """
+        Starts serving on a background thread
+        """
+
+        self.server = ThreadingHTTPServer((self.host, self.port), self.handler_class())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        print('MWSStandIn: serving on http://{}:{}'.format(self.host, self.port))
+
+    def stop(self):
+
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def serve_forever(self):
+
+        self.start()
+        try:
+            while True:
+                time.sleep(60)
+                with self.statsLock:
+                    print(self.stats)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def handler_class(self):
+
+        standIn = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                self.answer(parse_qs(urlsplit(self.path).query) if not body else parse_qs(body))
+
+            def do_GET(self):
+                self.answer(parse_qs(urlsplit(self.path).query))
+
+            def answer(self, params):
+                status, contentType, payload = standIn.respond({key: val[0] for key, val in params.items()})
+                self.send_response(status)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, params):
+        """
+        Returns (http status, content type, body bytes) for a request with the query parameters <params>
+        """
+
+        action = params.get('Action')
+        if action not in standInActions:
+            return 400, 'text/xml', error_xml(productsNs, 'InvalidParameterValue',
+                                              'Action {} is not supported by the stand-in'.format(action))
+
+        ids = request_ids(action, params)
+        numItems = max(len(ids), 1)  # Quotas are counted in items, like Routine.throt
+        with self.statsLock:
+            self.stats[action]['requests'] += 1
+            self.stats[action]['items'] += numItems
+
+        with self.randLock:
+            delay = self.rand.uniform(*self.latency)
+        time.sleep(delay)
+
+        quota = self.quotas[standInActions[action][0]]
+        if not quota.try_take(min(numItems, quota.capacity)):
+            with self.statsLock:
+                self.stats[action]['throttled'] += 1
+            return 503, 'text/xml', error_xml(productsNs, 'RequestThrottled', 'Request is throttled')
+
+        if action == 'GetReport':
+            return 200, 'text/plain', report_txt(params.get('ReportId', ''))
+
+        return 200, 'text/xml', getattr(self, 'xml_' + action, self.xml_unsupported)(params, ids).encode('utf-8')
+
+    def replayed_or(self, operation, theId, template):
+        """
+        Returns the archived record for <theId>, or else the output of <template>
+        """
+
+        return self.records.get((operation, theId)) or template()
+
+    def xml_unsupported(self, params, ids):
+        return response_xml(params['Action'], productsNs, '')
+
+    def xml_GetMatchingProductForId(self, params, ids):
+        idType = params.get('IdType', 'UPC')
+        return response_xml('GetMatchingProductForId', productsNs, ''.join(
+            self.replayed_or('get_matching_product_for_id', i, lambda i=i: matching_product_xml(i, idType))
+            for i in ids), wrapResult=False)
+
+    def xml_GetCompetitivePricingForASIN(self, params, ids):
+        return response_xml('GetCompetitivePricingForASIN', productsNs, ''.join(
+            self.replayed_or('get_competitive_pricing_for_asin', i, lambda i=i: comp_pricing_xml(i))
+            for i in ids), wrapResult=False)
+
+    def xml_GetLowestOfferListingsForASIN(self, params, ids):
+        return response_xml('GetLowestOfferListingsForASIN', productsNs, ''.join(
+            self.replayed_or('get_lowest_offer_listings_for_asin', i, lambda i=i: lowest_offers_xml(i))
+            for i in ids), wrapResult=False)
+
+    def xml_GetMyFeesEstimate(self, params, ids):
+        results = []
+        for n in range(1, len(ids) + 1):
+            prefix = 'FeesEstimateRequestList.FeesEstimateRequest.{}.'.format(n)
+            price = float(params.get(prefix + 'PriceToEstimateFees.ListingPrice.Amount', 0))
+            results.append(fees_estimate_xml(ids[n - 1], price, params.get(prefix + 'MarketplaceId', '')))
+        return response_xml('GetMyFeesEstimate', productsNs,
+                            '<FeesEstimateResultList>{}</FeesEstimateResultList>'.format(''.join(results)))
+
+    def xml_ListInventorySupply(self, params, ids):
+        return response_xml('ListInventorySupply', inventoryNs, '<InventorySupplyList>{}</InventorySupplyList>'
+                            .format(''.join(inventory_supply_xml(i) for i in ids)))
+
+    def xml_RequestReport(self, params, ids):
+        with self.randLock:
+            self.nextReportId += 1
+            reqId = self.nextReportId
+        return response_xml('RequestReport', reportsNs, report_request_xml(reqId, params.get('ReportType', ''),
+                                                                           '_SUBMITTED_'))
+
+    def xml_GetReportRequestList(self, params, ids):
+        # Every report that's been requested is reported as done, with its report id equal to its request id
+        return response_xml('GetReportRequestList', reportsNs, '<HasNext>false</HasNext>' + ''.join(
+            report_request_xml(reqId, '', '_DONE_') for reqId in range(50000000001, self.nextReportId + 1)))
+
+    def xml_GetReportList(self, params, ids):
+        return response_xml('GetReportList', reportsNs, '<HasNext>false</HasNext>' + ''.join(
+            '<ReportInfo><ReportId>{0}</ReportId><ReportRequestId>{0}</ReportRequestId><Acknowledged>false'
+            '</Acknowledged></ReportInfo>'.format(reqId) for reqId in range(50000000001, self.nextReportId + 1)))
+
+
+def request_ids(action, params):
+    """
+    Returns the ASINs/ids/SKUs in the MWS list parameters of a request, in order
+    """
+
+    if action == 'GetMyFeesEstimate':
+        prefix, suffix = 'FeesEstimateRequestList.FeesEstimateRequest.', '.IdValue'
+    else:
+        prefix, suffix = {'GetMatchingProductForId': 'IdList.Id.',
+                          'ListInventorySupply':     'SellerSkus.member.'}.get(action, 'ASINList.ASIN.'), ''
+
+    ids = []
+    n = 1
+    while prefix + str(n) + suffix in params:
+        ids.append(params[prefix + str(n) + suffix])
+        n += 1
+    return ids
+
+
+def fake_number(theId, salt, low, high):
+    """
+    A number between <low> and <high> that's always the same for the same <theId> and <salt>
+    """
+
+    digest = hashlib.md5('{}:{}'.format(salt, theId).encode('utf-8')).hexdigest()
+    return low + (high - low) * int(digest[:8], 16) / 0xFFFFFFFF
+
+
+def fake_asin(theId):
+    return 'B0' + hashlib.md5(str(theId).encode('utf-8')).hexdigest()[:8].upper()
+
+
+def response_xml(action, ns, inner, wrapResult=True):
+    if wrapResult:
+        inner = '<{0}Result>{1}</{0}Result>'.format(action, inner)
+    return ('<?xml version="1.0"?><{0}Response xmlns="{1}">{2}<ResponseMetadata><RequestId>{3}</RequestId>'
+            '</ResponseMetadata></{0}Response>'.format(action, ns, inner, uuid.uuid4()))
+
+
+def error_xml(ns, code, message):
+    return ('<?xml version="1.0"?><ErrorResponse xmlns="{}"><Error><Type>Sender</Type><Code>{}</Code>'
+            '<Message>{}</Message></Error><RequestID>{}</RequestID></ErrorResponse>'
+            .format(ns, code, escape(message), uuid.uuid4())).encode('utf-8')
+
+
+def money_xml(tag, amount):
+    return '<{0}><CurrencyCode>USD</CurrencyCode><Amount>{1:.2f}</Amount></{0}>'.format(tag, amount)
+
+
+def sales_ranks_xml(asin):
+    return ('<SalesRankings><SalesRank><ProductCategoryId>home_garden_display_on_website</ProductCategoryId>'
+            '<Rank>{}</Rank></SalesRank></SalesRankings>'.format(int(fake_number(asin, 'rank', 100, 500000))))
+
+
+def matching_product_xml(theId, idType):
+    asin = theId if idType == 'ASIN' else fake_asin(theId)
+    return ('<GetMatchingProductForIdResult Id="{0}" IdType="{1}" status="Success"><Products>'
+            '<Product xmlns:ns2="{2}/default.xsd"><Identifiers><MarketplaceASIN><MarketplaceId>STANDIN</MarketplaceId>'
+            '<ASIN>{3}</ASIN></MarketplaceASIN></Identifiers><AttributeSets><ns2:ItemAttributes xml:lang="en-US">'
+            '<ns2:Brand>Stand-In</ns2:Brand><ns2:Title>Stand-in product {3}</ns2:Title></ns2:ItemAttributes>'
+            '</AttributeSets><Relationships/>{4}</Product></Products></GetMatchingProductForIdResult>'
+            .format(escape(theId), idType, productsNs, asin, sales_ranks_xml(asin)))
+
+
+def comp_pricing_xml(asin):
+    return ('<GetCompetitivePricingForASINResult ASIN="{0}" status="Success"><Product><CompetitivePricing>'
+            '<CompetitivePrices><CompetitivePrice belongsToRequester="false" condition="New" subcondition="New">'
+            '<CompetitivePriceId>1</CompetitivePriceId><Price>{1}</Price></CompetitivePrice></CompetitivePrices>'
+            '</CompetitivePricing>{2}</Product></GetCompetitivePricingForASINResult>'
+            .format(escape(asin), money_xml('LandedPrice', fake_number(asin, 'comp', 8, 60)), sales_ranks_xml(asin)))
+
+
+def lowest_offers_xml(asin):
+    listings = ''.join('<LowestOfferListing><Qualifiers><ItemCondition>New</ItemCondition><FulfillmentChannel>{}'
+                       '</FulfillmentChannel></Qualifiers><Price>{}</Price></LowestOfferListing>'
+                       .format(channel, money_xml('LandedPrice', fake_number(asin, channel, 8, 60)))
+                       for channel in ('Amazon', 'Merchant'))
+    return ('<GetLowestOfferListingsForASINResult ASIN="{}" status="Success" AllOfferListingsConsidered="true">'
+            '<Product><LowestOfferListings>{}</LowestOfferListings></Product></GetLowestOfferListingsForASINResult>'
+            .format(escape(asin), listings))
+
+
+def fees_estimate_xml(asin, price, marketplaceId):
+    return ('<FeesEstimateResult><Status>Success</Status><FeesEstimateIdentifier><MarketplaceId>{0}</MarketplaceId>'
+            '<IdType>ASIN</IdType><SellerId>STANDIN</SellerId><SellerInputIdentifier>{1}</SellerInputIdentifier>'
+            '<IsAmazonFulfilled>true</IsAmazonFulfilled><IdValue>{1}</IdValue><PriceToEstimateFees>{2}'
+            '</PriceToEstimateFees></FeesEstimateIdentifier><FeesEstimate><TimeOfFeesEstimation>{3}'
+            '</TimeOfFeesEstimation>{4}</FeesEstimate><Error><Type/><Code/><Message/></Error></FeesEstimateResult>'
+            .format(marketplaceId, escape(asin), money_xml('ListingPrice', price),
+                    time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                    money_xml('TotalFeesEstimate', 0.15 * price + 3.0)))
+
+
+def inventory_supply_xml(sku):
+    total = int(fake_number(sku, 'total', 0, 40))
+    inStock = int(fake_number(sku, 'instock', 0, total + 1))
+    return ('<member><SellerSKU>{0}</SellerSKU><ASIN>{1}</ASIN><TotalSupplyQuantity>{2}</TotalSupplyQuantity>'
+            '<FNSKU>X{1}</FNSKU><Condition>NewItem</Condition><SupplyDetail/><InStockSupplyQuantity>{3}'
+            '</InStockSupplyQuantity></member>'.format(escape(sku), fake_asin(sku), total, inStock))
+
+
+def report_request_xml(reqId, reportType, status):
+    done = '<GeneratedReportId>{}</GeneratedReportId>'.format(reqId) if status == '_DONE_' else ''
+    return ('<ReportRequestInfo><ReportRequestId>{}</ReportRequestId><ReportType>{}</ReportType>'
+            '<ReportProcessingStatus>{}</ReportProcessingStatus>{}</ReportRequestInfo>'
+            .format(reqId, escape(reportType), status, done))
+
+
+def report_txt(reportId):
+    out = io.StringIO()
+    out.write('sku\tasin\tprice\tquantity\n')
+    for n in range(10):
+        sku = '{}-{}'.format(reportId, n)
+        out.write('{}\t{}\t{:.2f}\t{}\n'.format(sku, fake_asin(sku), fake_number(sku, 'price', 8, 60),
+                                                int(fake_number(sku, 'qty', 0, 20))))
+    return out.getvalue().encode('utf-8')
+
+
+if __name__ == '__main__':
+
+    MWSStandIn().serve_forever()
@@ -1,79 +1,398 @@
 import csv
 import io
+import os
+import threading
 import time
 import xml.etree.ElementTree as ET
 from decimal import Decimal
-from operator import itemgetter
+from operator import attrgetter, itemgetter
 
+import dateutil.parser
 from boto.mws.connection import MWSConnection
 from mwstools.mws_overrides import OverrideProducts
 
-from AmazonSelling.tools import call_sql, write_to_file, record_timestamps, datetime_floor, chunks, make_sql_list, \
-    get_credentials, con_postgres
+from AmazonSelling import metrics
+from AmazonSelling.archive import archive_response
+from AmazonSelling.records import AzProduct, AzMatchResult, ProductMatch, MatcherCandidate, CompPricing, \
+    LowestOffers, FeesEstimate
+from AmazonSelling.tools import call_sql, record_timestamps, datetime_floor, chunks, \
+    get_credentials, con_postgres, pg_con, matchDueAfter, Staged, UnitOfWork
+
+
+# Needed to make boto response readable:
+# http://stackoverflow.com/questions/25503563/how-can-i-return-xml-from-boto-calls?rq=1
+MWSConnection._parse_response = lambda _s, _x, _y, z: z
+
+# The MWS API section that each boto operation belongs to. Each section gets its own long-lived connection.
+mwsSections = {
+    'get_matching_product_for_id':        'Products',
+    'get_competitive_pricing_for_asin':   'Products',
+    'get_lowest_offer_listings_for_asin': 'Products',
+    'request_report':                     'Reports',
+    'get_report_request_list':            'Reports',
+    'get_report_list':                    'Reports',
+    'get_report':                         'Reports',
+    'list_inventory_supply':              'FulfillmentInventory'}
+
+# The boto arguments whose values are used to tag each archived response, so it can be found again by ASIN/UPC/SKU
+archiveIdArgs = ('ASINList', 'IdList', 'SellerSkus')
+
+idListMax = 5  # The most ids GetMatchingProductForId takes in one request
+sourceQueryMax = 1000  # The most wm_ids looked up in one wm_db_query call
+
+
+# {MWS Action: the token bucket that paces it}. Routine.mws_proc fills this in, in its own process, so that what MWS
+# says about each quota (see quota_feedback) goes back to the bucket that's spending it
+quotaListeners = {}
+
+
+def quota_headers(getheader):
+    """
+    Returns (remaining, resetsOn) from the x-mws-quota-remaining and x-mws-quota-resetsOn headers of an MWS response,
+    with resetsOn as a unix time, or (None, None) if the operation has no hourly quota. <getheader> looks up a header.
+    """
+    
+    remaining, resetsOn = getheader('x-mws-quota-remaining'), getheader('x-mws-quota-resetsOn')
+    if remaining is None or resetsOn is None:
+        return None, None
+    try:
+        return float(remaining), dateutil.parser.parse(resetsOn).timestamp()
+    except (ValueError, OverflowError):
+        print('quota_headers: could not read x-mws-quota-remaining: {}, x-mws-quota-resetsOn: {}'
+              .format(remaining, resetsOn))
+        return None, None
+
+
+def quota_feedback(action, throttled, getheader):
+    """
+    Passes on whether MWS throttled a request for <action>, and what its quota headers say, to the token bucket
+    in <quotaListeners>. Returns the bucket, or None if there isn't one
+    """
+    
+    if throttled:
+        metrics.count('throttled')
+    
+    listener = quotaListeners.get(action)
+    if listener is not None:
+        listener.feedback(throttled, *quota_headers(getheader))
+    return listener
+
+
+class QuotaMWSConnection(MWSConnection):
+    """
+    An MWSConnection that hands every response's quota headers to quota_feedback.
+    boto retries a throttled request (503) on its own exponential backoff. For Actions with a token bucket in
+    <quotaListeners>, this waits for the bucket instead, which will have just been emptied and slowed down.
+    """
+    
+    def _mexe(self, request, sender=None, override_num_retries=None, retry_handler=None):
+        
+        action = request.params.get('Action')
+        numItems = max(1, sum(1 for k in request.params if k.split('.')[0] in archiveIdArgs))
+        
+        def handler(response, i, nextSleep):
+            throttled = False
+            if response.status == 503:
+                body = response.read()
+                throttled = b'RequestThrottled' in body or b'QuotaExceeded' in body
+                # The body can only be read once, and boto reads it again for the error when this leaves it to boto
+                response.read = lambda amt=None: body
+            
+            listener = quota_feedback(action, throttled, response.getheader)
+            if throttled and listener is not None:
+                with metrics.timed('quota'):
+                    waited = listener.take(min(numItems, listener.capacity))
+                return '{} throttled, retried after {:.1f} seconds'.format(action, waited), i + 1, 0
+            return None  # Up to boto
+        
+        return super()._mexe(request, sender, override_num_retries, handler)
 
 
 class MWSManager:
+    """
+    Holds the MWS credentials and one authenticated connection per API section.
+    Use MWSManager.shared() rather than MWSManager() so every call in a process reuses the same connections (and
+    their keep-alive sockets) instead of re-reading credentials.ini and doing a new TLS handshake each time.
+    """
+    
+    # {(pid, thread id): MWSManager}. Keyed by pid, since a connection can't be shared across a fork, and by thread,
+    # since boto connections aren't thread-safe (the asyncio Routine mode runs MWS calls in a thread pool)
+    _registry = {}
     
     def __init__(self):
 
         self.apiKeys = get_credentials({'AmazonMWS': ('marketplaceID', 'merchantID', 'accessKeyID',
                                                       'secretKey')})['AmazonMWS']
-        mws = MWSConnection(self.apiKeys['accessKeyID'], self.apiKeys['secretKey'], Merchant=self.apiKeys['merchantID'],
-                            SellerId=self.apiKeys['merchantID'])
-        
-        self.botoFuncs = {
-        'get_matching_product_for_id':        mws.get_matching_product_for_id,
-        'get_competitive_pricing_for_asin':   mws.get_competitive_pricing_for_asin,
-        'get_lowest_offer_listings_for_asin': mws.get_lowest_offer_listings_for_asin,
-        'request_report':                     mws.request_report,
-        'get_report_request_list':            mws.get_report_request_list,
-        'get_report_list':                    mws.get_report_list,
-        'get_report':                         mws.get_report,
-        'list_inventory_supply':              mws.list_inventory_supply}
-    
-    def boto_call(self, operation, botoArgs=dict()):
+        self.conns = {}  # {section: MWSConnection}
+        self.feesApi = None
+        
+        # 'host:port' of a local MWS stand-in (Amazon/mwsstandin.py) to send every request to instead of MWS
+        self.standIn = os.environ.get('MWS_STANDIN')
+    
+    @classmethod
+    def shared(cls):
+        """
+        Returns this process's (and thread's) MWSManager, creating it on first use
+        """
+        
+        regKey = (os.getpid(), threading.get_ident())
+        if regKey not in cls._registry:
+            cls._registry[regKey] = cls()
+        return cls._registry[regKey]
+    
+    def connection(self, section):
+        """
+        Returns the boto connection for the MWS API <section> ('Products', 'Reports', etc.), creating it on first use
+        """
+        
+        if section not in self.conns:
+            endpoint = {}
+            if self.standIn:
+                host, port = self.standIn.split(':')
+                endpoint = {'host': host, 'port': int(port), 'is_secure': False}
+            self.conns[section] = QuotaMWSConnection(self.apiKeys['accessKeyID'], self.apiKeys['secretKey'],
+                                                Merchant=self.apiKeys['merchantID'],
+                                                SellerId=self.apiKeys['merchantID'], **endpoint)
+        return self.conns[section]
+    
+    def fees_api(self):
+        """
+        Returns the mwstools client used for GetMyFeesEstimate, creating it on first use
+        """
+        
+        if self.feesApi is None:
+            endpoint = {'domain': 'http://' + self.standIn} if self.standIn else {}
+            self.feesApi = OverrideProducts(self.apiKeys['accessKeyID'], self.apiKeys['secretKey'],
+                                            self.apiKeys['merchantID'], **endpoint)
+        return self.feesApi
+    
+    def boto_request(self, operation, botoArgs=dict()):
         """
         Takes the MWS <operation> and its specific arguments as a dict in <botoArgs>
-        Submits a query request to MWS and writes the response to an XML file
-        Also returns the query result as an ElementTree root
+        Submits a query request to MWS and returns the raw response bytes, or None if the request failed
         """
-
-        # Needed to make boto response readable:
-        # http://stackoverflow.com/questions/25503563/how-can-i-return-xml-from-boto-calls?rq=1
-        MWSConnection._parse_response = lambda _s, _x, _y, z: z
+        
+        try:
+            botoFunc = getattr(self.connection(mwsSections[operation]), operation)
+        except KeyError:
+            print('MWSManager.boto_request: operation <{}> is not in mwsSections'.format(operation))
+            return None
         
         botoArgs['MarketplaceId'] = self.apiKeys['marketplaceID']
         
         try:
-            response = self.botoFuncs[operation](**botoArgs)
+            with metrics.timed('api'):
+                response = botoFunc(**botoArgs)
         except Exception as err:
             print('----------\nThere was an error with operation: {}, args: {}\n{}\n----------'
                   .format(operation, botoArgs, err))
-            return None        
+            return None
         
-        it = ET.iterparse(io.StringIO(response.decode('utf-8')))
+        # Keep the raw response in Amazon/DataFiles/archive. This just queues it for the archive's writer thread
+        archive_response('Amazon', operation, response,
+                         ids=[i for key in archiveIdArgs if key in botoArgs for i in botoArgs[key]])
         
-        # Insert code here to parse result for errors
-        '''root = it.root
-        <parse>'''
+        return response
+    
+    def boto_stream(self, operation, botoArgs=dict()):
+        """
+        Takes the MWS <operation> and its specific arguments as a dict in <botoArgs>, submits the request, and returns a
+        generator of the flat records registered for <operation> in <streamRecords>, rather than the whole tree. Each
+        record element is cleared as soon as it's been extracted, and namespaces are resolved with local_name().
+        Returns None if the request itself failed, so callers can tell that apart from an empty response.
+        """
         
-        # This chunk's to get rid of the namespaces in the xml from Amazon. http://stackoverflow.com/a/33997423
-        for _, el in it:
-            if '}' in el.tag:
-                el.tag = el.tag.split('}', 1)[1]  # strip all namespaces
-            for at in el.attrib.keys():  # strip namespaces of attributes too
-                if '}' in at:
-                    newat = at.split('}', 1)[1]
-                    el.attrib[newat] = el.attrib[at]
-                    del el.attrib[at]
-          
-        root = it.root
+        response = self.boto_request(operation, botoArgs)
+        if response is None:
+            return None
         
-        # Write data to file in <relative path>/DataFiles/<operation>.xml
-        write_to_file('%s.xml' % operation, (ET.tostring(root, encoding="us-ascii", method="xml")).decode('utf-8'),
-                      dirrr='DataFiles', absPath=False)
+        recordTag, extractor = streamRecords[operation]
+        return self.iter_records(response, recordTag, extractor)
+    
+    @staticmethod
+    def iter_records(response, recordTag, extractor):
+        """
+        Incrementally parses the raw xml <response>, yielding extractor(element) for every <recordTag> element.
+        Records that the extractor returns None for are skipped.
+        """
         
-        return root
+        for _, el in ET.iterparse(io.BytesIO(response)):
+            if local_name(el.tag) == recordTag:
+                record = extractor(el)
+                el.clear()
+                if record is not None:
+                    yield record
+
+
+_localNames = {}  # {'{namespace}Tag': 'Tag'}. Filled in as new tags are seen
+
+
+def local_name(tag):
+    """
+    Returns <tag> without its namespace, e.g. '{http://mws.amazonservices.com/schema/...}ASIN' becomes 'ASIN'.
+    Goes through a lookup table, so each distinct tag is only split once.
+    """
+    
+    try:
+        return _localNames[tag]
+    except KeyError:
+        _localNames[tag] = tag.rsplit('}', 1)[-1]
+        return _localNames[tag]
+
+
+def iter_path(elem, path):
+    """
+    Returns a list of the elements under <elem> that match <path>, a '/'-separated list of namespace-free child tags
+    """
+    
+    level = [elem]
+    for name in path.split('/'):
+        level = [child for parent in level for child in parent if local_name(child.tag) == name]
+    return level
+
+
+def find_path(elem, path):
+    """
+    Returns the first element under <elem> matching <path> (see iter_path), or None
+    """
+    
+    found = iter_path(elem, path)
+    return found[0] if found else None
+
+
+def iter_local(elem, name):
+    """
+    Yields <elem> and every element below it whose namespace-free tag is <name>, like Element.iter(<name>)
+    """
+    
+    return (e for e in elem.iter() if local_name(e.tag) == name)
+
+
+def strip_ns(elem):
+    """
+    Returns a namespace-free copy of <elem> and its children. Only used on the small subtrees that get stored as xml
+    text, so the rest of the response never has to be rewritten.
+    """
+    
+    copy = ET.Element(local_name(elem.tag), {local_name(k): v for k, v in elem.attrib.items()})
+    copy.text, copy.tail = elem.text, elem.tail
+    copy.extend(strip_ns(child) for child in elem)
+    return copy
+
+
+def extract_sales_ranks(elem):
+    """
+    Returns [Rank_1, ProductCategoryId_1, ... Rank_4, ProductCategoryId_4] from the first 4 SalesRanks under <elem>
+    """
+    
+    ranks = [None] * 8
+    for numSalesRanks, salesRank in enumerate(iter_local(elem, 'SalesRank')):
+        if numSalesRanks >= 4:
+            break
+        for y in salesRank:
+            tag = local_name(y.tag)
+            if tag == 'Rank':
+                ranks[2 * numSalesRanks] = y.text
+            elif tag == 'ProductCategoryId':
+                ranks[2 * numSalesRanks + 1] = y.text
+    return ranks
+
+
+def extract_matching_product(result):
+    """
+    Extracts a GetMatchingProductForIdResult element into an AzMatchResult, with an AzProduct for each matched Product
+    """
+    
+    if 'Id' not in result.attrib:
+        return None
+    
+    products = []
+    for product in iter_local(result, 'Product'):  # Using iter, since each ID can match multiple ASINs
+        asin, title, brand, varParent = None, None, None, None
+        
+        u = find_path(product, 'Identifiers/MarketplaceASIN/ASIN')
+        if u is not None:
+            asin = u.text
+        
+        v = find_path(product, 'AttributeSets/ItemAttributes')
+        if v is not None:
+            for y in v:
+                if local_name(y.tag) == 'Title':
+                    title = y.text
+                elif local_name(y.tag) == 'Brand':
+                    brand = y.text
+        
+        w = find_path(product, 'Relationships/VariationParent/Identifiers/MarketplaceASIN/ASIN')
+        if w is not None:
+            varParent = w.text
+        
+        # Kept as xml text for Matcher_WmAz, in case this ID matches more than one ASIN
+        xmlTexts = []
+        for path in ('AttributeSets/ItemAttributes', 'Relationships', 'SalesRankings'):
+            x = find_path(product, path)
+            xmlTexts.append(ET.tostring(strip_ns(x), encoding='unicode') if x is not None else None)
+        
+        products.append(AzProduct(asin, title, brand, varParent, *extract_sales_ranks(product), *xmlTexts))
+    
+    return AzMatchResult(str(result.attrib['Id']), products)
+
+
+def extract_comp_pricing(result):
+    """
+    Extracts a GetCompetitivePricingForASINResult element into a CompPricing
+    """
+    
+    competPrice, tradeIn = None, None
+    
+    for w in iter_path(result, 'Product/CompetitivePricing/CompetitivePrices/CompetitivePrice'):
+        if w.attrib['condition'] == 'New':
+            x = find_path(w, 'Price/LandedPrice/Amount')
+            if x is None:  # Sometimes LandedPrice is missing
+                x = find_path(w, 'Price/ListingPrice/Amount')
+            competPrice = x.text
+    
+    for w in iter_path(result, 'Product/CompetitivePricing/TradeInValue/Amount'):
+        tradeIn = w.text
+    
+    return CompPricing(competPrice, *extract_sales_ranks(result), tradeIn, result.attrib['ASIN'])
+
+
+def extract_lowest_offers(result):
+    """
+    Extracts a GetLowestOfferListingsForASINResult element into a LowestOffers, with the lowest landed price per channel
+    """
+    
+    lowest = {'Amazon': None, 'Merchant': None}
+    
+    for w in iter_path(result, 'Product/LowestOfferListings/LowestOfferListing'):
+        channel = find_path(w, 'Qualifiers/FulfillmentChannel').text
+        price = find_path(w, 'Price/LandedPrice/Amount').text
+        
+        if lowest[channel] is None:
+            lowest[channel] = price
+        else:
+            lowest[channel] = min(float(price), float(lowest[channel]))
+    
+    return LowestOffers(lowest['Amazon'], lowest['Merchant'], result.attrib['ASIN'])
+
+
+def extract_children(result):
+    """
+    Extracts an element's direct children into a dict of {namespace-free tag: text}
+    """
+    
+    return {local_name(v.tag): v.text for v in result}
+
+
+# The record element, and the function that flattens it, for each operation that MWSManager.boto_stream supports
+streamRecords = {
+    'get_matching_product_for_id':        ('GetMatchingProductForIdResult',      extract_matching_product),
+    'get_competitive_pricing_for_asin':   ('GetCompetitivePricingForASINResult', extract_comp_pricing),
+    'get_lowest_offer_listings_for_asin': ('GetLowestOfferListingsForASINResult', extract_lowest_offers),
+    'request_report':                     ('ReportRequestInfo',                  extract_children),
+    'get_report_request_list':            ('ReportRequestInfo',                  extract_children),
+    'get_report_list':                    ('ReportInfo',                         extract_children),
+    'list_inventory_supply':              ('member',                             extract_children)}
 
 
 class Products:
@@ -87,336 +406,230 @@ class Products:
         <id_type> defines which IdType will be used for GetMatchingProductForId ('upc', 'asin', etc.)
         <ids> is a list/tuple of wm_ids, if <idType> is 'upc'
         <ids> is a list/tuple of dicts with keys 'wm_id' and also 'asin'/whatever for idTypes other than 'upc'
+        <ids> can be any length. It's split into IdList-sized requests here
+        Returns the ProductMatch rows that were written to Products_WmAz, or None if every request failed, or the
+        writes did (so nothing was written, and the ids stay due). The wm_ids of requests that failed stay due either way
         """
         
         from Walmart.walmartclasses import wm_db_query
         
         if idType == 'upc':
-            wm_ids = ids
+            wm_ids = list(ids)
         else:
-            wm_ids = tuple(b['wm_id'] for b in ids)
+            wm_ids = [b['wm_id'] for b in ids]
         
-        sourceDicts = wm_db_query(wm_ids)
-        upcs = tuple(i['upc'] for i in sourceDicts)
+        # Get the source data in chunks, so the OR-chain in wm_db_query stays a reasonable size
+        sourceDicts = []
+        for wmIdChunk in chunks(wm_ids, sourceQueryMax):
+            sourceDicts.extend(wm_db_query(wmIdChunk))
         
-        # Create <theParams> using <idType> & <ids>
+        # Index the source items once for the whole batch, rather than scanning <sourceDicts> for every result.
+        # setdefault keeps the first item for a key, which is what the scans used to find.
         if idType == 'upc':
-            theParams = {'IdType': 'UPC', 'IdList': upcs}
-        else:  # Use <idType> to create <mwsIdType> & <theParams>
+            sourceByUpc = {}
+            for sourceItem in sourceDicts:
+                if sourceItem['upc']:
+                    sourceByUpc.setdefault(str(sourceItem['upc']), sourceItem)
+            idList = list(sourceByUpc)
+            mwsIdType = 'UPC'
+        else:
+            sourceByWmId = {}
+            for sourceItem in sourceDicts:
+                sourceByWmId.setdefault(str(sourceItem['wm_id']), sourceItem)
+            wmIdByAzId = {}
+            for idDict in ids:
+                wmIdByAzId.setdefault(str(idDict[idType]), str(idDict['wm_id']))
+            idList = [g[idType] for g in ids]
             mwsIdType = idType.upper()
-            theParams = {'IdType': mwsIdType, 'IdList': [g[idType] for g in ids]}
-        
-        '''Match the Walmart product data to Amazon using the IdList (probably UPCs or ASINs)'''
-        root = MWSManager.boto_call(MWSManager(), 'get_matching_product_for_id', theParams)
-    
-        '''Parse the xml and write the data to SQL'''
-        con = con_postgres()
         
-        marketplaceAsinTags = ["ASIN"]
-        itemAttributesTags = ["Title", "Brand"]  # , "Model", "NumberOfItems", "PackageQuantity"]
-#         relationshipsTags = ["ASIN"]
-        
-        azKeys = ["ASIN", "Title", "Brand", "var_parent", "Rank_1", "ProductCategoryId_1", "Rank_2",
-                  "ProductCategoryId_2", "Rank_3", "ProductCategoryId_3", "Rank_4", "ProductCategoryId_4"]
         if source == 'Walmart':
-            sourceKeys = ["wm_id", "name", "price", "upc", "model", "brand", "in_stock", "free_ship"] 
+            sourceKeys = ["wm_id", "name", "price", "upc", "model", "brand", "in_stock", "free_ship"]
         
         theData = []
-        if root is not None:
+        matcherData = []
+        numOk = 0
+        failedIds = set()  # The ids of the requests that failed
+        
+        # GetMatchingProductForId takes at most <idListMax> ids per request, so bigger lists are split into chunks
+        for idChunk in chunks(idList, idListMax):
             
-            # Parse through the xml and get everything I want
-            for result in root.iter('GetMatchingProductForIdResult'):
-                # Initializes a dictionary with keys from sourceKeys, and all values as None
-                sourceValues = dict.fromkeys(sourceKeys)
-                xmlCongl = []
-                
-                try:
-                    resultId = str(result.attrib['Id'])
-                except ValueError:  # Couldn't cast to integer
-                    continue
+            '''Match the Walmart product data to Amazon using the IdList (probably UPCs or ASINs)'''
+            results = MWSManager.shared().boto_stream('get_matching_product_for_id',
+                                                      {'IdType': mwsIdType, 'IdList': idChunk})
+            if results is None:
+                failedIds.update(str(i) for i in idChunk)
+                continue
+            numOk += 1
+            
+            # Go through each extracted result and get everything I want
+            for result in results:
+                # Matches a product from the Amazon xml to the Wm item, using the UPC or other ID.
+                # Falls back to a dictionary with keys from sourceKeys, and all values as None
+                if idType == 'upc':
+                    sourceValues = sourceByUpc.get(result.id)
+                else:
+                    sourceValues = sourceByWmId.get(wmIdByAzId.get(result.id))
+                if sourceValues is None:
+                    sourceValues = dict.fromkeys(sourceKeys)
                 
-                if idType == 'upc':  # Matches a product from the Amazon xml to the Wm item, using the UPC or other ID
-                    for sourceItem in sourceDicts:
-                        if resultId == sourceItem['upc']:
-                            sourceValues = sourceItem
-                            break
-                elif idType == 'asin':
-                    for idDict in ids:  # Match <resultID> to <ids>
-                        if resultId == idDict[idType]:
-                            for sourceItem in sourceDicts:  # Match <ids> to <sourceDicts>
-                                if str(idDict['wm_id']) == str(sourceItem['wm_id']):
-                                    sourceValues = sourceItem
-                                    break
-                            break
-                 
-                for product in result.iter('Product'):  # Using iter, since each ID can match multiple ASINs
-                    # Initializes a dictionary with keys from azKeys, and all values as None
-                    azValues = {key: None for key in azKeys}
-                     
-                    u = product.find('.//Identifiers/MarketplaceASIN')      
-                    for y in list(u):
-                        if y.tag in marketplaceAsinTags:
-                            azValues[y.tag] = y.text
-                             
-                    v = product.find('.//AttributeSets/ItemAttributes')
-                    for y in list(v):
-                        if y.tag in itemAttributesTags:
-                            azValues[y.tag] = y.text
-                     
-    #               #This is for if I need to get multiple variations, rather than just one
-    #                     azValues['Alt_ASINs'] = None
-    #                     # There can be multiple VariationParents?? VariationChildren, yes.
-    #                     for variation in product.iter('VariationParent'):
-    #                         asinsTemp = list()
-    #                         for y in variation.findall('.//Identifiers/MarketplaceASIN'):
-    #                             for z in list(y):
-    #                                 if z.tag in relationshipsTags:
-    #                                     asinsTemp.append(z.text)
-    #                                     # Comma-separated string of variation ASINs
-    #                                     azValues['var_parent'] = ','.join(asinsTemp)
-                    
-                    w = product.find('.//Relationships/VariationParent/Identifiers/MarketplaceASIN')
-                    if w is not None:
-                        for y in list(w):
-                            if y.tag == "ASIN":
-                                azValues['var_parent'] = y.text
-                     
-                    numSalesRanks = 0
-                    for salesRank in product.iter('SalesRank'):
-                        numSalesRanks += 1
-                        if numSalesRanks > 4:
-                            # print ('{} has more than 4 sales ranks!'.format(azValues["ASIN"]))
-                            break
-                        for y in list(salesRank):
-                            if y.tag == 'Rank':
-                                libKey = 'Rank_%s' % numSalesRanks
-                                print(libKey)
-                                azValues[libKey] = y.text
-                            if y.tag == 'ProductCategoryId':
-                                libKey = 'ProductCategoryId_%s' % numSalesRanks
-                                print(libKey)
-                                azValues[libKey] = y.text
-                     
-#                     azValues["url"] = 'amazon.com/dp/{}'.format(str(azValues["ASIN"]))
-#                     azValues["ccc"] = 'camelcamelcamel.com/product/{}?active=sales_rank'.format(str(azValues["ASIN"]))
-                    
-                    # This is for writing to Matcher_WmAz, in case that needs to happen for this ID
-                    if idType != 'asin':
-                        xmlCongl.append([str(sourceValues["wm_id"]) + azValues['ASIN'],
-                                         sourceValues["upc"],
-                                         sourceValues["wm_id"],
-                                         sourceValues["name"],
-                                         sourceValues["price"],
-                                         sourceValues["model"],
-                                         sourceValues["brand"],
-                                         azValues['ASIN'],
-                                         ET.tostring(v, encoding='unicode'),
-                                         ET.tostring(product.find('.//Relationships'), encoding='unicode'),
-                                         ET.tostring(product.find('.//SalesRankings'), encoding='unicode'),
-                                         # ON CONFLICT DO UPDATE values start here
-                                         sourceValues["upc"],
-                                         sourceValues["name"],
-                                         sourceValues["price"],
-                                         sourceValues["model"],
-                                         sourceValues["brand"],
-                                         ET.tostring(v, encoding='unicode'),
-                                         ET.tostring(product.find('.//Relationships'), encoding='unicode'),
-                                         ET.tostring(product.find('.//SalesRankings'), encoding='unicode')])
-                    
+                for azProduct in result.products:
                     # This is for writing to Products_WmAz
-                    theData.append((azValues["ASIN"],
-                                    azValues["Title"],
-                                    sourceValues["wm_id"],
-                                    sourceValues["name"],
-                                    sourceValues["price"],
-                                    sourceValues["upc"],
-                                    azValues["Brand"],
-                                    sourceValues["in_stock"],
-                                    sourceValues["free_ship"],
-                                    azValues["Rank_1"],
-                                    azValues["ProductCategoryId_1"],
-                                    azValues["Rank_2"],
-                                    azValues["ProductCategoryId_2"],
-                                    azValues["Rank_3"],
-                                    azValues["ProductCategoryId_3"],
-                                    azValues["Rank_4"],
-                                    azValues["ProductCategoryId_4"],
-                                    azValues["var_parent"],
-                                    # ON CONFLICT DO UPDATE values start here
-                                    sourceValues["price"],
-                                    sourceValues["in_stock"],
-                                    sourceValues["free_ship"],
-                                    azValues["var_parent"],
-                                    azValues["Rank_1"],
-                                    azValues["ProductCategoryId_1"],
-                                    azValues["Rank_2"],
-                                    azValues["ProductCategoryId_2"],
-                                    azValues["Rank_3"],
-                                    azValues["ProductCategoryId_3"],
-                                    azValues["Rank_4"],
-                                    azValues["ProductCategoryId_4"]))
-                    
+                    theData.append(ProductMatch(azProduct.asin,
+                                                azProduct.az_name,
+                                                sourceValues["wm_id"],
+                                                sourceValues["name"],
+                                                sourceValues["price"],
+                                                sourceValues["upc"],
+                                                azProduct.az_brand,
+                                                sourceValues["in_stock"],
+                                                sourceValues["free_ship"],
+                                                azProduct.salesrank1,
+                                                azProduct.catid1,
+                                                azProduct.salesrank2,
+                                                azProduct.catid2,
+                                                azProduct.salesrank3,
+                                                azProduct.catid3,
+                                                azProduct.salesrank4,
+                                                azProduct.catid4,
+                                                azProduct.var_parent))
+                
                 # If the UPC yielded multiple Az matches, write relevant data to Matcher_WmAz to be looked at
                 # later by a different subroutine
-                if len(xmlCongl) > 1 and idType != 'asin':
-                    theData = theData[:-len(xmlCongl)]  # Remove last n elements from theData, where n = len(xmlCongl)
+                if len(result.products) > 1 and idType != 'asin':
+                    del theData[-len(result.products):]  # Remove the rows that were just added for this UPC
                     # This is so the results of UPCs with multiple matches are ommited from Products_WmAz, until
                     # matcher can find the one true match.
-
-                    sqlTxt = '''INSERT INTO "Matcher_WmAz" (unique_id, upc, wm_id, wm_name, wm_price, wm_model,
-                                wm_brand, asin, item_attribs, relationships, sales_ranks)
-                                VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                ON CONFLICT ("unique_id") DO UPDATE
-                                SET upc = %s, wm_name = %s, wm_price = %s, wm_model = %s, wm_brand = %s,
-                                item_attribs = %s, relationships = %s, sales_ranks = %s'''
-                    call_sql(con, sqlTxt, xmlCongl, "executeBatch")
+                    matcherData.extend(MatcherCandidate(str(sourceValues["wm_id"]) + azProduct.asin,
+                                                        sourceValues["upc"],
+                                                        sourceValues["wm_id"],
+                                                        sourceValues["name"],
+                                                        sourceValues["price"],
+                                                        sourceValues["model"],
+                                                        sourceValues["brand"],
+                                                        azProduct.asin,
+                                                        azProduct.item_attribs,
+                                                        azProduct.relationships,
+                                                        azProduct.sales_ranks) for azProduct in result.products)
+        
+        if idList and not numOk:
+            return None
+        
+        # Only the wm_ids whose requests worked (or that weren't sent, having no id) are stamped as matched
+        if failedIds:
+            if idType == 'upc':
+                idByWmId = {str(s['wm_id']): str(s['upc']) for s in sourceDicts if s['upc']}
+            else:
+                idByWmId = {str(d['wm_id']): str(d[idType]) for d in ids}
+            wm_ids = [w for w in wm_ids if idByWmId.get(str(w)) not in failedIds]
+        
+        '''Write the data to SQL, and the timestamps, in one transaction'''
+        with UnitOfWork() as unit:
+            con = unit.con
+            
+            if matcherData:
+                sqlTxt = '''INSERT INTO "Matcher_WmAz" (unique_id, upc, wm_id, wm_name, wm_price, wm_model,
+                            wm_brand, asin, item_attribs, relationships, sales_ranks)
+                            VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            ON CONFLICT ("unique_id") DO UPDATE
+                            SET upc = EXCLUDED.upc, wm_name = EXCLUDED.wm_name, wm_price = EXCLUDED.wm_price,
+                            wm_model = EXCLUDED.wm_model, wm_brand = EXCLUDED.wm_brand,
+                            item_attribs = EXCLUDED.item_attribs, relationships = EXCLUDED.relationships,
+                            sales_ranks = EXCLUDED.sales_ranks'''
+                call_sql(con, sqlTxt, matcherData, "executeBatch", prepare=True, key=attrgetter('unique_id'))
             
             # Update Products_WmAz
-            sqlTxt = '''INSERT INTO "Products_WmAz" (asin, az_name, wm_id, wm_name, wm_price, upc, az_brand, wm_instock,
-                        free_ship, salesrank1, catid1, salesrank2, catid2, salesrank3, catid3, salesrank4, catid4,
-                        var_parent)
-                        VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT ("asin") DO UPDATE
-                        SET wm_price = %s, wm_instock = %s, free_ship = %s, var_parent = %s, salesrank1 = %s,
-                        catid1 = %s, salesrank2 = %s, catid2 = %s, salesrank3 = %s, catid3 = %s, salesrank4 = %s,
-                        catid4 = %s'''
             if theData:
-                theData.sort(key=itemgetter(0))
-            call_sql(con, sqlTxt, theData, 'executeBatch')
+                sqlTxt = '''INSERT INTO "Products_WmAz" (asin, az_name, wm_id, wm_name, wm_price, upc, az_brand,
+                            wm_instock, free_ship, salesrank1, catid1, salesrank2, catid2, salesrank3, catid3, salesrank4,
+                            catid4, var_parent)
+                            VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            ON CONFLICT ("asin") DO UPDATE
+                            SET wm_price = EXCLUDED.wm_price, wm_instock = EXCLUDED.wm_instock,
+                            free_ship = EXCLUDED.free_ship, var_parent = EXCLUDED.var_parent,
+                            salesrank1 = EXCLUDED.salesrank1, catid1 = EXCLUDED.catid1,
+                            salesrank2 = EXCLUDED.salesrank2, catid2 = EXCLUDED.catid2,
+                            salesrank3 = EXCLUDED.salesrank3, catid3 = EXCLUDED.catid3,
+                            salesrank4 = EXCLUDED.salesrank4, catid4 = EXCLUDED.catid4'''
+                call_sql(con, sqlTxt, theData, 'executeBatch', prepare=True, key=attrgetter('asin'))
             
-        # Update Prod_Wm.last_matched
-        sqlTxt = '''UPDATE "Prod_Wm"
-                    SET last_matched = %s
-                    WHERE wm_id = %s'''
-        if wm_ids:
-            theData2 = sorted([(datetime_floor(1.0/60), wmId) for wmId in wm_ids], key=itemgetter(1))
-        call_sql(con, sqlTxt, theData2, 'executeBatch')
-        if con:
-            con.close()
+            # Update Prod_Wm.last_matched, and when it'll be due to be matched again
+            if wm_ids:
+                sqlTxt = '''UPDATE "Prod_Wm"
+                            SET last_matched = %s, match_due = %s
+                            WHERE wm_id = %s'''
+                ts = datetime_floor(1.0/60)
+                theData2 = [(ts, ts + matchDueAfter, wmId) for wmId in wm_ids]
+                call_sql(con, sqlTxt, theData2, 'executeBatch', prepare=True, key=itemgetter(2))
+            
+            if theData:
+                record_timestamps([hnng.asin for hnng in theData], 'match_to_az')
+        if unit.failed:
+            return None
         
         if not theData:
-            if idType == 'upc':
-                print('No Amazon matches for UPCs {0}, or all matches were with multiple ASINs, so they were omitted'
-                      .format(upcs))
-            else:
-                print('No Amazon matches for {0}s {1}, or all matches were with multiple ASINs, so they were omitted'
-                      .format(mwsIdType, theParams['IdList']))
-        else:
-            record_timestamps([hnng[0] for hnng in theData], 'match_to_az')
+            print('No Amazon matches for the {0} {1}s, or all matches were with multiple ASINs, so they were omitted'
+                  .format(len(idList), mwsIdType))
+        
+        return theData
     
     def get_comp_pricing(self, asins):
         """
         Using ASINs, retrieves GetCompetitivePricingForASIN from Amazon and writes it to SQL
         <asins> is a list of ASINs
         Retrieves both pricing and sales ranks
+        Returns the CompPricing records that were written, or None if the request or the writes failed
         """
         
         theParams = {'ASINList': asins}
-        root = MWSManager.boto_call(MWSManager(), 'get_competitive_pricing_for_asin', theParams)
+        results = MWSManager.shared().boto_stream('get_competitive_pricing_for_asin', theParams)
+        if results is None:
+            return None
         
         '''Write the Amazon replies to SQL'''
         
-        azKeys = ["CompetPrice", "Rank_1", "ProductCategoryId_1", "Rank_2", "ProductCategoryId_2",
-                  "Rank_3", "ProductCategoryId_3", "Rank_4", "ProductCategoryId_4", "TradeIn", "ASIN"]
-        
-        theData = []
-        # Parse through the xml and get everything I want
-        for result in root.iter('GetCompetitivePricingForASINResult'):
-            azValues = dict.fromkeys(azKeys)  # Initializes a dictionary with keys from azKeys, and all values as None
-            azValues['ASIN'] = result.attrib['ASIN']
-            
-            foundNewPrice = False
-            for w in result.findall('.//Product/CompetitivePricing/CompetitivePrices/CompetitivePrice'):
-                if w.attrib['condition'] == 'New':
-                    try:
-                        azValues['CompetPrice'] = w.find('.//Price/LandedPrice/Amount').text
-                    except AttributeError:  # Sometimes LandedPrice is missing
-                        azValues['CompetPrice'] = w.find('.//Price/ListingPrice/Amount').text
-                    foundNewPrice = True
-            if not foundNewPrice:
-                azValues['CompetPrice'] = None
-                
-            foundTradeIn = False
-            for w in result.findall('.//Product/CompetitivePricing/TradeInValue'):
-                azValues['TradeIn'] = w.find('.//Amount').text
-                foundTradeIn = True
-            if not foundTradeIn:
-                azValues['TradeIn'] = None
-                
-            numSalesRanks = 0
-            for salesRank in result.iter('SalesRank'):
-                numSalesRanks += 1
-                if numSalesRanks > 4:
-                    # print('{} has more than 4 sales ranks!'.format(azValues["ASIN"]))
-                    break
-                for y in list(salesRank):
-                    if y.tag == 'Rank':
-                        libKey = 'Rank_%s' % numSalesRanks
-                        azValues[libKey] = y.text
-                    if y.tag == 'ProductCategoryId':
-                        libKey = 'ProductCategoryId_%s' % numSalesRanks
-                        azValues[libKey] = y.text
-            
-            theData.append(tuple(azValues.values()))
+        theData = list(results)  # CompPricing records are already in the order of the UPDATE's parameters
         
         sqlTxt = '''UPDATE "Products_WmAz"
                     SET comp_price = %s, salesrank1 = %s, catid1 = %s, salesrank2 = %s, catid2 = %s, salesrank3 = %s,
                     catid3 = %s, salesrank4 = %s, catid4 = %s, trade_in = %s
                     WHERE asin = %s'''
-        if theData:
-            theData.sort(key=itemgetter(-1))
-        con = con_postgres()
-        call_sql(con, sqlTxt, theData, 'executeBatch')
-        if con:
-            con.close()
-            
-        if asins:
-            record_timestamps(asins, 'az_comp_price')
+        with UnitOfWork() as unit:  # The data and its timestamps in one transaction
+            call_sql(unit.con, sqlTxt, theData, 'executeBatch', prepare=True, key=attrgetter('asin'))
+            if asins:
+                record_timestamps(asins, 'az_comp_price')
+        if unit.failed:
+            return None
+        
+        return theData
         
     def get_lowest_offer_listings(self, asins):
         """
         Using ASINs, retrieves GetLowestOfferListingsForASIN from Amazon and writes it to SQL
         <asins> is a list of ASINs
         Retrieves the lowest FBA offer and the lowest merchant fulfilled offer, new only
+        Returns the LowestOffers records that were written, or None if the request or the writes failed
         """
         
         theParams = {'ASINList': asins, 'ItemCondition': 'New'}
-        root = MWSManager.boto_call(MWSManager(), 'get_lowest_offer_listings_for_asin', theParams)
+        results = MWSManager.shared().boto_stream('get_lowest_offer_listings_for_asin', theParams)
+        if results is None:
+            return None
         
         '''Write the Amazon replies to SQL'''
         
-        azKeys = ["Amazon", "Merchant", "ASIN"]
-        
-        theData = []
-        # Parse through the xml and get everything I want
-        for result in root.iter('GetLowestOfferListingsForASINResult'):
-            azValues = dict.fromkeys(azKeys)  # Initializes a dictionary with keys from azKeys, and all values as None
-            azValues['ASIN'] = result.attrib['ASIN']
-            
-            channel = None
-            for w in result.findall('.//Product/LowestOfferListings/LowestOfferListing'):
-                channel = w.find('.//Qualifiers/FulfillmentChannel').text
-                price = w.find('.//Price/LandedPrice/Amount').text
-                
-                if azValues[channel] is None:
-                    azValues[channel] = price
-                else:
-                    azValues[channel] = min(float(price), float(azValues[channel]))
-            
-            theData.append(tuple(azValues.values()))
+        theData = list(results)  # LowestOffers records are already in the order of the UPDATE's parameters
         
         sqlTxt = '''UPDATE "Products_WmAz"
                     SET lowest_fba = %s, lowest_merch = %s
                     WHERE asin = %s'''
-        if theData:
-            theData.sort(key=itemgetter(-1))
-        con = con_postgres()
-        call_sql(con, sqlTxt, theData, "executeBatch")
-        if con:
-            con.close()
-            
-        if asins:
-            record_timestamps(asins, "az_lowest_offer")
+        with UnitOfWork() as unit:  # The data and its timestamps in one transaction
+            call_sql(unit.con, sqlTxt, theData, "executeBatch", prepare=True, key=attrgetter('asin'))
+            if asins:
+                record_timestamps(asins, "az_lowest_offer")
+        if unit.failed:
+            return None
+        
+        return theData
             
     def get_fees_est(self, asins):
         """
@@ -424,51 +637,60 @@ class Products:
         <asins> is a list or tuple of asins.
         Currently, can only take 4 ASINs at a time
         Also updates the my_price column in Products_WmAz for the passed asins
+        Returns the FeesEstimate records that were written, or None if the request or the writes failed
         """
         
         from mwstools.parsers.products.get_my_fees_estimate import GetMyFeesEstimateResponse
         
-        con = con_postgres()
-        
         # Get my theoretical price for each item
         myPrices = get_my_price(asins)
         inputs = tuple((q, myPrices[q],) for q in myPrices if myPrices[q])  # Remove entries that are lacking a price
         if not inputs:  # Oops, now there's no entries still remaining
             record_timestamps(asins, 'az_fees')
-            return
+            return []
         
-        api = OverrideProducts(MWSManager().apiKeys['accessKeyID'], MWSManager().apiKeys['secretKey'],
-                               MWSManager().apiKeys['merchantID'])
-        estimate_requests = [api.gen_fees_estimate_request(MWSManager().apiKeys['marketplaceID'], x[0], identifier=x[0],
+        mws = MWSManager.shared()
+        api = mws.fees_api()
+        estimate_requests = [api.gen_fees_estimate_request(mws.apiKeys['marketplaceID'], x[0], identifier=x[0],
                                                            listing_price=x[1]) for x in inputs]
         try:
-            response = api.get_my_fees_estimate(estimate_requests)
+            with metrics.timed('api'):
+                response = api.get_my_fees_estimate(estimate_requests)
         except Exception as err:
             print('Error with get_my_fees_estimate in the mwstools library:\ninputs:{}\n{}'.format(inputs, err))
-            return
+            errResponse = getattr(err, 'response', None)
+            if errResponse is not None:
+                quota_feedback('GetMyFeesEstimate', errResponse.status_code == 503, errResponse.headers.get)
+            return None
+        
+        # mwstools uses requests, so this isn't a QuotaMWSConnection. It doesn't retry, so a throttled request is dropped
+        # (the ASINs stay due, and come around again)
+        throttled = response.status_code == 503
+        quota_feedback('GetMyFeesEstimate', throttled, response.headers.get)
+        if throttled:
+            print('get_my_fees_estimate was throttled:\ninputs:{}'.format(inputs))
+            return None
         
-        # Write data to file in <relative path>/DataFiles/<operation>.xml
-        write_to_file('get_my_fees_estimate.xml', response.text, dirrr='DataFiles', absPath=False)
+        # Keep the raw response in Amazon/DataFiles/archive
+        archive_response('Amazon', 'get_my_fees_estimate', response.content, ids=[x[0] for x in inputs])
         
         theData = []
         for w in GetMyFeesEstimateResponse.load(response.text).fees_estimate_result_list:
             if w.error.code:
-                theData.append((w.listing_price, -1.0, w.id_value))
+                theData.append(FeesEstimate(w.listing_price, -1.0, w.id_value))
             else:
-                theData.append((w.listing_price, w.total_fees_estimate, w.id_value))
+                theData.append(FeesEstimate(w.listing_price, w.total_fees_estimate, w.id_value))
         
         sqlTxt = '''UPDATE "Products_WmAz"
                     SET my_price = %s, fees_est = %s
                     WHERE asin = %s'''
-        if theData:
-            theData.sort(key=itemgetter(-1))
-        call_sql(con, sqlTxt, theData, 'executeBatch')
-        
-        if con:
-            con.close()
-        
-        if inputs:
+        with UnitOfWork() as unit:  # The data and its timestamps in one transaction
+            call_sql(unit.con, sqlTxt, theData, 'executeBatch', prepare=True, key=attrgetter('asin'))
             record_timestamps(asins, 'az_fees')
+        if unit.failed:
+            return None
+        
+        return theData
             
     
 class Reports:
@@ -548,11 +770,14 @@ class Reports:
         
         # return '50122017449'
         
-        root = MWSManager.boto_call(MWSManager(), 'request_report', reportParams)
+        results = MWSManager.shared().boto_stream('request_report', reportParams)
+        if results is None:
+            return None
         
         try:
-            reportRequestId = root.find('.//ReportRequestId').text
-        except:
+            reportRequestId = next(results)['ReportRequestId']
+        except (StopIteration, KeyError):
+            print('request_report: no ReportRequestId in the response for {}'.format(reportParams))
             return None
         
         if reportRequestId:
@@ -564,17 +789,11 @@ class Reports:
 
         # theParams = None
         theParams = {}
-        root = MWSManager.boto_call(MWSManager(), 'get_report_request_list', theParams)
+        results = MWSManager.shared().boto_stream('get_report_request_list', theParams)
         
         # Not all reports will generate a <GeneratedReportId>
-        reqsDict = {}  # <ReportRequestId>: {all fieldnames: values for each report request}
-        
-        # Go through the xml and pull out the relevant data from each <ReportRequestInfo>
-        for result in root.iter('ReportRequestInfo'):
-            
-            reqId = result.find('.//ReportRequestId').text
-            reqDict = {v.tag: v.text for v in list(result)}
-            reqsDict[reqId] = reqDict
+        # <ReportRequestId>: {all fieldnames: values for each report request}
+        reqsDict = {reqDict['ReportRequestId']: reqDict for reqDict in results or ()}
             
         return reqsDict
     
@@ -582,15 +801,10 @@ class Reports:
 
         # theParams = None
         theParams = {}
-        root = MWSManager.boto_call(MWSManager(), 'get_report_list', theParams)
-        repsDict = {}
+        results = MWSManager.shared().boto_stream('get_report_list', theParams)
         
-        # Go through the xml and pull out the relevant data from each <ReportRequestInfo>
-        for result in root.iter('ReportInfo'):
-            
-            reqId = result.find('.//ReportRequestId').text
-            repDict = {v.tag: v.text for v in list(result)}
-            repsDict[reqId] = repDict
+        # The relevant data from each <ReportInfo>
+        repsDict = {repDict['ReportRequestId']: repDict for repDict in results or ()}
             
         return repsDict
     
@@ -628,16 +842,17 @@ class FulfillmentInventory:
         """
         Gets my current FBA inventory data from MWS and writes it to SQL in io.SKUs
         Requires: skus (tuple, list, or set)
+        Returns the rows that were written, or None if the request failed
         """
         
         theParams = {'SellerSkus': skus}
-        root = MWSManager.boto_call(MWSManager(), 'list_inventory_supply', theParams)
+        results = MWSManager.shared().boto_stream('list_inventory_supply', theParams)
+        if results is None:
+            return None
         
-        tagsTupl = ('SellerSKU', 'FNSKU', 'InStockSupplyQuantity', 'TotalSupplyQuantity')
         sqlOrder = ('fnsku', 'processing', 'available', 'sku')
         theData = []
-        for result in root.iter('member'):
-            w = {y.tag: y.text for y in list(result) if y.tag in tagsTupl}
+        for w in results:
             
             x = {}
             if 'SellerSKU' in w:
@@ -668,9 +883,11 @@ class FulfillmentInventory:
                         SET fnsku = %s, processing = %s, available = %s
                         WHERE sku = %s'''
             con = con_postgres()
-            call_sql(con, sqlTxt, theData, "executeBatch")
+            call_sql(con, sqlTxt, theData, "executeBatch", key=itemgetter(3))
             if con:
                 con.close()
+        
+        return theData
 
         
 class FulfillmentInboundShipment:
@@ -687,15 +904,15 @@ class FulfillmentInboundShipment:
 #         '''
 #         
 #         theParams = {'SellerSKUList': skus}
-#         root = MWSManager.boto_call(MWSManager(), 'inbound_guidance_for_sku', theParams)
+#         results = MWSManager.shared().boto_stream('inbound_guidance_for_sku', theParams)
+#         if results is None:
+#             return None
 #         
 #         #The rest has just been copied from get_list_inventory_supply
 #         
-#         tagsTupl = ('SellerSKU', 'FNSKU', 'InStockSupplyQuantity', 'TotalSupplyQuantity')
 #         sqlOrder = ('fnsku', 'processing', 'available', 'sku')
 #         theData = []
-#         for result in root.iter('member'):
-#             w = {y.tag: y.text for y in list(result) if y.tag in tagsTupl}
+#         for w in results:
 #             
 #             x = {}
 #             if 'SellerSKU' in w:
@@ -725,7 +942,7 @@ class FulfillmentInboundShipment:
 #                         SET fnsku = %s, processing = %s, available = %s
 #                         WHERE sku = %s'''
 #             con = con_postgres()
-#             call_sql(con, sqlTxt, theData, "executeBatch")
+#             call_sql(con, sqlTxt, theData, "executeBatch", key=itemgetter(3))
 #             if con:
 #                 con.close()
 
@@ -735,14 +952,13 @@ def matcher(upc):
 
     import re  # , regex
     
-    con = con_postgres()
-    
     '''Retrieve data from Matcher_WmAz'''
     
     sqlTxt = '''SELECT *
                 FROM "Matcher_WmAz"
                 WHERE upc = %s'''
-    a = call_sql(con, sqlTxt, [upc], "executeReturn", dictCur=True)
+    with pg_con() as con:
+        a = call_sql(con, sqlTxt, [upc], "executeReturn", dictCur=True)
     
     azKeys = ['asin', 'item_attribs', 'relationships', 'sales_ranks']
     # Make a dict of all the values that are common between each item (basically all the Walmart data)
@@ -919,11 +1135,11 @@ def get_my_price(theAsins):
         asins = tuple(theAsins)
     
     # Retrieve pricing data from SQL
-    con = con_postgres()
     sqlTxt = '''SELECT asin, comp_price, lowest_fba, lowest_merch
                 FROM "Products_WmAz"
-                WHERE asin IN ({})'''.format(",".join(["'" + str(i) + "'" for i in asins]))
-    allPrices = call_sql(con, sqlTxt, [], "executeReturn", dictCur=True)
+                WHERE asin = ANY(%s)'''
+    with pg_con() as con:
+        allPrices = call_sql(con, sqlTxt, [list(asins)], "executeReturn", dictCur=True, prepare=True)
     
 #     allPrices = [{"asin": "QADASDW", "comp_price": None, "lowest_fba": None, "lowest_merch": 10},
 #                  {"asin": "ASD978", "comp_price": None, "lowest_fba": 5.57, "lowest_merch": None}]
@@ -963,9 +1179,10 @@ def get_my_price(theAsins):
     return myPrices
         
 
-def calc_sales_rank(asins, theTable='Products_WmAz'):
+def calc_sales_rank(asins=None, theTable='Products_WmAz'):
     """
     #Calculate the salesrank % for each product, write to SQL
+    If <asins> is None, does every product, streaming them from SQL a batch at a time
     amazon.com/s/ref=sr_hi_1?rh=n%3A1055398%2Ck%3A-fghfhf&keywords=-fghfhf&ie=UTF8&qid=1497942532
     amazon.com/s/ref=nb_sb_noss?url=search-alias%3Dkitchen&field-keywords=-fghfhf
     amazon.com/s/ref=nb_sb_noss?url=search-alias%3Dtoys-and-games&field-keywords=-fghfhf&rh=n%3A165793011%2Ck%3A-fghfhf
@@ -1014,65 +1231,65 @@ def calc_sales_rank(asins, theTable='Products_WmAz'):
                 # "wir_phone_accessory_display_on_website": "DUNNO",
                 }
     
-    # Get catids and salesranks from Products_WmAz
-    asinsStr = make_sql_list(asins, 'str')  # <('asin1', 'asin2', 'asin3', 'asin4')>
-    
-    con = con_postgres()
+    # Get catids and salesranks from Products_WmAz, in ASIN order, which is the order the UPDATE below locks rows in
     sqlTxt = '''SELECT asin, salesrank1, catid1, salesrank2, catid2, salesrank3, catid3, salesrank4, catid4
                 FROM "{}"
-                WHERE asin in {}
-                AND catid1 IS NOT NULL'''.format(theTable, asinsStr)        
-    datums = call_sql(con, sqlTxt, [], "executeReturn", dictCur=True)
+                WHERE catid1 IS NOT NULL'''.format(theTable)
+    theArgs = []
+    if asins is not None:
+        sqlTxt += ' AND asin = ANY(%s)'
+        theArgs.append(list(asins))
+    sqlTxt += ' ORDER BY asin'
     
     catOrder = ({'salesrank': 'salesrank1', 'catid': 'catid1'},
                 {'salesrank': 'salesrank2', 'catid': 'catid2'},
                 {'salesrank': 'salesrank3', 'catid': 'catid3'},
                 {'salesrank': 'salesrank4', 'catid': 'catid4'})
     
-    # Match each item to its corresponding department using deptDict
-    for item in datums:
-        for cat in catOrder:
-            checkCat = item[cat['catid']]
-            item['dept'] = None
-            if checkCat in deptDict:
-                item['dept'] = deptDict[checkCat]
-                item['rank'] = item[cat['salesrank']]
-                break
-
-    sqlTxt = '''SELECT dept_name, num_products 
-                FROM "Az_Depts"'''                
-    b = call_sql(con, sqlTxt, [], 'executeReturn', dictCur=True)
-    numProdsLookup = {x['dept_name']: x['num_products'] for x in b}  # Convert tuple of dicts into a simple dict
+    con = con_postgres()
     
-    # Take the needed final values out of datums and put into theData, including calculated salesrank%
-    theData = []
-    for item in datums:
-        if not item['dept']:
-            salesrank = None
-        else:
-            try:
-                salesrank = item['rank'] / numProdsLookup[item['dept']]
-            except KeyError:
-                if item['dept'] == 'Prime Pantry':
-                    salesrank = None
-                else:
-                    print('public.Az_Depts does not have an entry for the <{}> category as required by ASIN {}'
-                          .format(numProdsLookup[item['dept']], item['asin']))
-                    salesrank = None
-                
-        theData.append([item['dept'],                     
-                       salesrank,
-                       item['asin']])
+    sqlTxt2 = '''SELECT dept_name, num_products 
+                 FROM "Az_Depts"'''                
+    b = call_sql(con, sqlTxt2, [], 'executeReturn', dictCur=True)
+    numProdsLookup = {x['dept_name']: x['num_products'] for x in b}  # Convert tuple of dicts into a simple dict
     
-    sqlTxt = '''UPDATE "Products_WmAz"
-                SET dept = %s, salesrank = %s
-                WHERE asin = %s'''
+    sqlTxt3 = '''UPDATE "Products_WmAz" AS a
+                 SET dept = s.dept, salesrank = s.salesrank
+                 FROM staged AS s
+                 WHERE a.asin = s.asin'''
     
-    # Added this because it seemed like this SQL statement would continue running even after this function was done,
-    # causing deadlocks with calc_column('net')'s SQL statement, which I don't know how to execute in ASIN order.
-    for chunk in chunks(theData, 1000):
-        call_sql(con, sqlTxt, chunk, 'executeBatch')
+    # The rows are read on <readCon> and written on <con>, a batch of 1000 at a time, each locking its rows in ASIN order,
+    # as calc_column('net') and the other writers to Products_WmAz do, so they don't deadlock each other.
+    readCon = con_postgres()
+    for datums in call_sql(readCon, sqlTxt, theArgs, 'executeStream', dictCur=True, itersize=1000):
+        
+        # Match each item to its corresponding department using deptDict, and take the needed final values out of
+        # datums and put into theData, including calculated salesrank%
+        theData = []
+        for item in datums:
+            dept = rank = None
+            for cat in catOrder:
+                if item[cat['catid']] in deptDict:
+                    dept = deptDict[item[cat['catid']]]
+                    rank = item[cat['salesrank']]
+                    break
+            
+            if not dept:
+                salesrank = None
+            else:
+                try:
+                    salesrank = rank / numProdsLookup[dept]
+                except KeyError:
+                    if dept != 'Prime Pantry':
+                        print('public.Az_Depts does not have an entry for the <{}> category as required by ASIN {}'
+                              .format(dept, item['asin']))
+                    salesrank = None
+                    
+            theData.append((dept, salesrank, item['asin']))
+        
+        call_sql(con, sqlTxt3, Staged('"Products_WmAz"', ('dept', 'salesrank', 'asin'), theData, 'asin'), 'copyMerge')
     
+    readCon.close()
     if con:
         con.close()
         
@@ -1099,11 +1316,10 @@ def transfer_wm_datums(wmIds=[]):
                     WHEN LOWER(b.in_stock) = 'not available' then False
                     Else Null
                     END
-                FROM "Prod_Wm" AS b
-                WHERE a.wm_id = b.wm_id'''
-    if wmIds:
-        sqlTxt += " AND a.wm_id IN ({})".format(",".join([str(i) for i in wmIds]))
-    call_sql(con, sqlTxt, [], "executeNoReturn")
+                FROM "Prod_Wm" AS b,
+                  (SELECT asin FROM "Products_WmAz" {} ORDER BY asin FOR UPDATE) AS l  -- Lock in ASIN order
+                WHERE a.wm_id = b.wm_id AND a.asin = l.asin'''.format('WHERE wm_id = ANY(%s)' if wmIds else '')
+    call_sql(con, sqlTxt, [list(wmIds)] if wmIds else [], "executeNoReturn")
     
     if con:
         con.close()
@@ -1121,34 +1337,30 @@ def calc_column(column, asins=None):
     con = con_postgres()
     
     if column == 'my_price':
-        if asins:
-            myPrices = get_my_price(asins)
-        else:
-            myPrices = get_my_price(get_all_asins())
-            
         sqlTxt = '''UPDATE "Products_WmAz"
                     SET my_price = %s
                     WHERE asin = %s'''
-        # Get rid of asins that don't have a my_price associated with them
-        theData = tuple((myPrices[q], q,) for q in myPrices if myPrices[q])
-        call_sql(con, sqlTxt, theData, 'executeBatch')
+        for batch in ([asins] if asins else all_asin_batches()):
+            myPrices = get_my_price(batch)
+            # Get rid of asins that don't have a my_price associated with them
+            theData = tuple((myPrices[q], q,) for q in myPrices if myPrices[q])
+            call_sql(con, sqlTxt, theData, 'executeBatch', key=itemgetter(1))
     
     if column == 'net':
-        sqlTxt = '''UPDATE "Products_WmAz"
+        # The rows are locked in ASIN order first (l), the order every batch write to Products_WmAz locks them in, so
+        # this can't deadlock with them
+        sqlTxt = '''UPDATE "Products_WmAz" AS a
                     SET net = 
                     CASE WHEN fees_est = -1.00 THEN Null
                     WHEN my_price IS NOT Null THEN my_price - wm_price - fees_est
                     ELSE Null
-                    END'''
-        if asins:
-            sqlTxt += ' WHERE asin IN {}'.format(make_sql_list(asins, 'str'))
-        call_sql(con, sqlTxt, [], 'executeNoReturn')
+                    END
+                    FROM (SELECT asin FROM "Products_WmAz" {} ORDER BY asin FOR UPDATE) AS l
+                    WHERE a.asin = l.asin'''.format('WHERE asin = ANY(%s)' if asins else '')
+        call_sql(con, sqlTxt, [list(asins)] if asins else [], 'executeNoReturn')
     
     if column == 'salesrank':
-        if asins:
-            calc_sales_rank(asins)
-        else:
-            calc_sales_rank(get_all_asins())
+        calc_sales_rank(asins or None)
 
     if con:
         con.close()
@@ -1161,8 +1373,17 @@ def get_all_asins():
     Returns all ASINs in Products_WmAz as a list
     """
     
-    con = con_postgres()
+    return [q for batch in all_asin_batches() for q in batch]
+
+
+def all_asin_batches(itersize=2000):
+    """
+    Yields all ASINs in Products_WmAz, in ASIN order, as lists of up to <itersize>
+    """
+    
     sqlTxt = '''SELECT asin 
-                FROM "Products_WmAz"'''
-    a = call_sql(con, sqlTxt, [], 'executeReturn')
-    return [q[0] for q in a]
+                FROM "Products_WmAz"
+                ORDER BY asin'''
+    with pg_con() as con:
+        for rows in call_sql(con, sqlTxt, [], 'executeStream', itersize=itersize):
+            yield [q[0] for q in rows]
@@ -0,0 +1,203 @@
+import datetime
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+import time
+from multiprocessing.util import Finalize
+
+
+class ResponseArchive:
+    """
+    Keeps the raw bytes of API responses in rotating, gzip-compressed, append-only segment files.
+    Every response is its own gzip member in the current segment, so a single response can be read back by seeking to
+    its offset. Each segment has a sidecar .idx file (one JSON line per response) with the operation, timestamp, ids,
+    offset and length, which is what find() searches.
+    The writing is done by a background thread behind a bounded queue, so an API call only pays for a queue put. When the
+    queue is full the response is dropped (and counted in <self.dropped>) rather than blocking the caller.
+    """
+
+    def __init__(self, archiveDir, segmentBytes=64 * 1024 * 1024, maxQueue=500, sampleRates=None, defaultRate=1.0):
+        """
+        <archiveDir> is created if it doesn't exist yet
+        <segmentBytes> is the compressed size at which a new segment is started
+        <sampleRates> is a dict of {operation: fraction of its responses to keep}. Operations not in it use <defaultRate>
+        """
+
+        self.archiveDir = archiveDir
+        self.segmentBytes = segmentBytes
+        self.maxQueue = maxQueue
+        self.sampleRates = sampleRates or {}
+        self.defaultRate = defaultRate
+        self.dropped = 0
+
+        self.q = None
+        self.thread = None
+        self.pid = None
+        self.startLock = threading.Lock()
+
+        self.segment = None  # (data file, index file, segment name) for the current segment. Only used by the writer
+        self.numSegments = 0
+
+    def put(self, operation, raw, ids=()):
+        """
+        Queues the raw response <raw> (bytes or str) of <operation> to be archived, tagged with <ids>.
+        Returns True if it was queued, False if it was sampled out or the queue was full.
+        """
+
+        if random.random() >= self.sampleRates.get(operation, self.defaultRate):
+            return False
+
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+
+        self.start_writer()
+        try:
+            self.q.put_nowait((operation, time.time(), [str(i) for i in ids], raw))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def start_writer(self):
+        """
+        Starts the writer thread for this process, if it isn't running yet.
+        Checked by pid, since a forked Routine process inherits the object but not the thread.
+        """
+
+        if self.pid == os.getpid():
+            return
+
+        with self.startLock:
+            if self.pid != os.getpid():
+                self.q = queue.Queue(maxsize=self.maxQueue)
+                self.segment = None
+                self.thread = threading.Thread(target=self.writer, daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+                # Finalize (rather than atexit) also runs when a multiprocessing.Process exits
+                Finalize(self, self.close, exitpriority=10)
+
+    def close(self, timeout=30):
+        """
+        Flushes everything that's still queued and stops the writer thread
+        """
+
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+
+        self.q.put(None)
+        self.thread.join(timeout)
+
+    def writer(self):
+
+        while True:
+            item = self.q.get()
+            if item is None:
+                break
+
+            try:
+                self.write(*item)
+            except OSError as err:
+                print('ResponseArchive: could not archive a {} response\n{}'.format(item[0], err))
+
+        if self.segment:
+            for f in self.segment[:2]:
+                f.close()
+            self.segment = None
+
+    def write(self, operation, ts, ids, raw):
+
+        if self.segment is None or self.segment[0].tell() >= self.segmentBytes:
+            self.rotate()
+        dataFile, idxFile, segName = self.segment
+
+        compressed = gzip.compress(raw)
+        offset = dataFile.tell()
+        dataFile.write(compressed)
+        dataFile.flush()
+
+        idxFile.write(json.dumps({'op': operation, 'ts': ts, 'ids': ids, 'segment': segName, 'offset': offset,
+                                  'length': len(compressed)}) + '\n')
+        idxFile.flush()
+
+    def rotate(self):
+        """
+        Closes the current segment and starts a new one. Segment names include the pid, so processes never share one.
+        """
+
+        if self.segment:
+            for f in self.segment[:2]:
+                f.close()
+
+        os.makedirs(self.archiveDir, exist_ok=True)
+        self.numSegments += 1
+        segName = 'segment-{}-{}-{}.gz'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                                               self.numSegments)
+        self.segment = (open(os.path.join(self.archiveDir, segName), 'ab'),
+                        open(os.path.join(self.archiveDir, segName[:-3] + '.idx'), 'a', encoding='utf-8'),
+                        segName)
+
+    def find(self, operation=None, since=None, until=None, theId=None):
+        """
+        Yields the index entries (dicts) of archived responses, oldest segment first.
+        <operation>, <since>/<until> (datetimes), and <theId> (one of the ids the response was tagged with) are optional
+        filters.
+        """
+
+        if not os.path.isdir(self.archiveDir):
+            return
+
+        sinceTs = since.timestamp() if since else None
+        untilTs = until.timestamp() if until else None
+
+        for idxName in sorted(g for g in os.listdir(self.archiveDir) if g.endswith('.idx')):
+            with open(os.path.join(self.archiveDir, idxName), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # Partially written last line
+                        continue
+                    if operation and entry['op'] != operation:
+                        continue
+                    if sinceTs and entry['ts'] < sinceTs:
+                        continue
+                    if untilTs and entry['ts'] > untilTs:
+                        continue
+                    if theId is not None and str(theId) not in entry['ids']:
+                        continue
+                    yield entry
+
+    def read(self, entry):
+        """
+        Returns the raw response bytes for an index <entry> from find()
+        """
+
+        with open(os.path.join(self.archiveDir, entry['segment']), 'rb') as f:
+            f.seek(entry['offset'])
+            return gzip.decompress(f.read(entry['length']))
+
+
+archives = {}  # {source: ResponseArchive}
+
+
+def get_archive(source):
+    """
+    Returns the ResponseArchive for <source> ('Amazon', 'Walmart'), kept in <source>/DataFiles/archive
+    """
+
+    if source not in archives:
+        archives[source] = ResponseArchive(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir,
+                                                        source, 'DataFiles', 'archive'))
+    return archives[source]
+
+
+def archive_response(source, operation, raw, ids=()):
+    """
+    Queues a raw API response to be archived off the hot path. See ResponseArchive.put
+    """
+
+    return get_archive(source).put(operation, raw, ids)
@@ -3,19 +3,27 @@ import math
 import time
 
 from Amazon.mwsutils import calc_column, transfer_wm_datums
-from AmazonSelling.routine import RoutineOGaster, RoutineDisplay1, RoutineManually
-from AmazonSelling.tools import call_sql, con_postgres
+from AmazonSelling.routine import RoutineOGaster, RoutineContinuous, RoutineDisplay1, RoutineManually
+from AmazonSelling.schema import refresh_view
 from Walmart.walmartclasses import update_wm_data_timestamps, Lookup
 
 
-def crematogaster():
+def crematogaster(mode='processes', continuous=True):
+    """
+    Runs RoutineContinuous, which keeps going until it's stopped. Or if not <continuous>, runs RoutineOGaster once an
+    hour, recalculating salesrank and net after each run. <mode> is passed on to Routine.routine
+    """
+    
+    if continuous:
+        RoutineContinuous().routine(mode)
+        return
     
     a = time.time()
     while True:
         b = time.time()
         
         lasius = RoutineOGaster()
-        lasius.routine()
+        lasius.routine(mode)
         
         update_wm_data_timestamps()
         calc_column('salesrank')
@@ -40,18 +48,14 @@ def prepare_display1():
     calc_column('salesrank')
     calc_column('net')
     
-    con = con_postgres()
-    call_sql(con, 'REFRESH MATERIALIZED VIEW public."Display1"', [], "executeNoReturn")
-    con.close()
+    refresh_view('public."Display1"')
       
     e = RoutineDisplay1()
     e.routine()
     
     calc_column('net')
     
-    con = con_postgres()
-    call_sql(con, 'REFRESH MATERIALIZED VIEW public."Display1"', [], "executeNoReturn")
-    con.close()
+    refresh_view('public."Display1"')
     
     print('Total time elapsed: {}'.format(str(datetime.datetime.now() - a).split('.')[0]))
     
@@ -0,0 +1,254 @@
+"""
+A work queue kept in the "Jobs" table, so it outlives the process that filled it, and several hosts can work through
+the same queue at once.
+Workers claim jobs with FOR UPDATE SKIP LOCKED, so no two of them get the same job, and a claimed job is leased to its
+worker until <leaseFor> has passed. If the worker dies, the job becomes claimable again once its lease is up (or right
+away, when a new worker starts on the same host - see reclaim_host). Completing a job only counts for the worker that
+holds its lease, and completing it twice does nothing, so a job whose lease ran out can't be clobbered by a late worker.
+A job that has been claimed <maxAttempts> times without being completed is marked 'failed' instead of going back in the
+queue, so a batch that always fails isn't retried forever. It stays failed until it's asked for again with extend().
+Done and failed jobs are deleted once they've been finished for <pruneAfter> (or <redoAfter>, if that's longer), so
+the table only grows with the work that's in flight.
+The table itself is created by AmazonSelling.schema.ensure_schema.
+"""
+
+import datetime
+import os
+import socket
+import time
+
+from AmazonSelling.tools import call_sql, con_postgres, WorkQueue
+
+
+class JobQueue:
+    """
+    One named queue in "Jobs". It has the same interface as tools.WorkQueue (extend, pop_many, len) so Routine.mws_proc
+    can use either, plus complete() and release() for the jobs it has claimed.
+    Keys are stored as text, and turned back into <keyType> when they're claimed.
+    If <scoreFunc> is given, items are claimed highest score first, except for a <longTailShare> of each pop_many,
+    which goes to the jobs that have been waiting longest (like PriorityWorkQueue). Otherwise they're claimed FIFO.
+    A finished job is only put back in the queue by extend() once it's been done for <redoAfter>.
+    If <onlyKeys> is given, this JobQueue only counts and claims the jobs for those keys, so a caller that shares the
+    queue with others can work through just its own items.
+    """
+
+    def __init__(self, name, keyType=str, scoreFunc=None, longTailShare=0.2,
+                 leaseFor=datetime.timedelta(minutes=10), redoAfter=datetime.timedelta(0), maxAttempts=5, onlyKeys=None,
+                 pruneAfter=datetime.timedelta(days=1), items=()):
+        self.name = name
+        self.keyType = keyType
+        self.scoreFunc = scoreFunc
+        self.longTailShare = longTailShare if scoreFunc else 0
+        self.leaseFor = leaseFor
+        self.redoAfter = redoAfter
+        self.pruneAfter = max(pruneAfter, redoAfter)  # A done job pruned sooner would be redone sooner
+        self.maxAttempts = int(maxAttempts)
+        # Which jobs can be claimed, and what a job that isn't done goes back to (ready, or failed once it's used up its
+        # attempts). maxAttempts is fixed per queue, so it's in the SQL text rather than a parameter
+        self.claimable = '''(state = 'ready' OR (state = 'leased' AND lease_until < localtimestamp))
+                            AND attempts < {}'''.format(self.maxAttempts)
+        self.claimableArgs = []
+        if onlyKeys is not None:
+            self.claimable += ' AND key = ANY(%s)'
+            self.claimableArgs = [sorted(str(self.key(k)) for k in onlyKeys)]
+        self.putBack = '''state = CASE WHEN attempts < {0} THEN 'ready' ELSE 'failed' END,
+                          finished = CASE WHEN attempts < {0} THEN Null ELSE localtimestamp END'''.format(self.maxAttempts)
+        self.host = socket.gethostname()
+        self.worker = '{}:{}'.format(self.host, os.getpid())
+
+        self.numReady = None  # Cached count for __len__, which mws_proc calls several times a loop
+        self.countedAt = 0
+        self.countFor = 1  # Seconds
+        self.sweptAt = 0  # For sweep, which pop_many calls on every claim
+        self.sweepEvery = 60  # Seconds
+
+        self.extend(items)
+
+    key = staticmethod(WorkQueue.key)
+
+    def __len__(self):
+        """
+        The number of jobs that can be claimed right now (by any worker)
+        """
+
+        if self.numReady is None or time.time() - self.countedAt > self.countFor:
+            con = con_postgres()
+            rows = call_sql(con, '''SELECT count(*) FROM "Jobs" WHERE queue = %s AND {}'''.format(self.claimable),
+                            [self.name] + self.claimableArgs, 'executeReturn')
+            con.close()
+            self.numReady = rows[0][0] if rows else 0
+            self.countedAt = time.time()
+        return self.numReady
+
+    def extend(self, items, retryFailed=True):
+        """
+        Adds <items> (query rows, or single values) to the queue. Jobs already waiting or leased are left as they are,
+        except that a waiting job's priority is raised if the new score is higher. Done jobs are put back once they've
+        been done for <redoAfter>, and if <retryFailed>, failed ones are put back right away, with their attempts reset,
+        since they've been asked for again. A poll that adds whatever is due (fill_q) passes False, so the jobs that
+        keep failing aren't put back every time it runs.
+        Returns the number of items queued. The ones that were skipped are printed, if they were asked for explicitly.
+        """
+
+        scores = {}
+        for item in items:
+            k = str(self.key(item))
+            score = self.scoreFunc(item) if self.scoreFunc else 0.0
+            scores[k] = max(score, scores.get(k, score))  # An INSERT can only touch each row once
+        if not scores:
+            return 0
+
+        keys = sorted(scores)  # Same lock order for every worker
+        sqlTxt = '''INSERT INTO "Jobs" AS j (queue, key, priority)
+                    SELECT %s::text, k, p FROM unnest(%s::text[], %s::double precision[]) AS t(k, p)
+                    ON CONFLICT (queue, key) DO UPDATE
+                    SET priority = CASE WHEN j.state IN ('done', 'failed') THEN EXCLUDED.priority
+                                        ELSE GREATEST(j.priority, EXCLUDED.priority) END,
+                        enqueued = CASE WHEN j.state IN ('done', 'failed') THEN localtimestamp ELSE j.enqueued END,
+                        attempts = CASE WHEN j.state IN ('done', 'failed') THEN 0 ELSE j.attempts END,
+                        state = CASE WHEN j.state IN ('done', 'failed') THEN 'ready' ELSE j.state END,
+                        finished = Null
+                    WHERE j.state IN ('ready', 'leased') OR (j.state = 'failed' AND %s)
+                          OR (j.state = 'done' AND j.finished <= localtimestamp - %s * interval '1 second')
+                    RETURNING j.key'''
+        theArgs = [self.name, keys, [scores[k] for k in keys], retryFailed, self.redoAfter.total_seconds()]
+
+        con = con_postgres()
+        rows = call_sql(con, sqlTxt, theArgs, 'executeReturn', prepare=True)
+        con.commit()
+        con.close()
+        self.numReady = None
+        if rows is None:
+            return 0
+
+        numSkipped = len(keys) - len(rows)
+        if numSkipped and retryFailed:
+            queued = {row[0] for row in rows}
+            skipped = [k for k in keys if k not in queued]
+            print('JobQueue {}: skipped {} items done within the last {}: {}{}'
+                  .format(self.name, numSkipped, self.redoAfter, ', '.join(skipped[:10]),
+                          ' ...' if numSkipped > 10 else ''))
+        return len(rows)
+
+    def pop_many(self, n):
+        """
+        Claims (up to) <n> jobs and returns them as 1-tuples of their keys
+        """
+
+        self.sweep()
+        numTail = min(n, int(n * self.longTailShare + 0.999))
+        keys = self.claim(numTail, 'enqueued') if numTail else []
+        keys += self.claim(n - len(keys), 'priority DESC, enqueued')
+        return [(k,) for k in keys]
+
+    def claim(self, n, orderBy):
+        """
+        Leases (up to) <n> claimable jobs to this worker, taking them in <orderBy> order, and returns their keys
+        """
+
+        if n <= 0:
+            return []
+
+        sqlTxt = '''UPDATE "Jobs" AS j
+                    SET state = 'leased', worker = %s, attempts = j.attempts + 1,
+                        lease_until = localtimestamp + %s * interval '1 second'
+                    FROM (SELECT queue, key FROM "Jobs"
+                          WHERE queue = %s AND {}
+                          ORDER BY {}
+                          LIMIT %s
+                          FOR UPDATE SKIP LOCKED) AS c
+                    WHERE j.queue = c.queue AND j.key = c.key
+                    RETURNING j.key'''.format(self.claimable, orderBy)
+
+        con = con_postgres()
+        rows = call_sql(con, sqlTxt, [self.worker, self.leaseFor.total_seconds(), self.name] + self.claimableArgs + [n],
+                        'executeReturn', prepare=True)
+        con.commit()
+        con.close()
+
+        self.numReady = None
+        return [self.keyType(row[0]) for row in rows or []]
+
+    def complete(self, keys):
+        """
+        Marks the jobs for <keys> done, if this worker still holds their leases
+        """
+
+        self.finish(keys, '''state = 'done', finished = localtimestamp''')
+
+    def release(self, keys):
+        """
+        Puts the jobs for <keys> back in the queue, if this worker still holds their leases. For when a call failed.
+        Jobs that have used up their attempts are marked failed instead.
+        """
+
+        self.finish(keys, self.putBack)
+        self.numReady = None
+
+    def sweep(self):
+        """
+        Runs fail_expired and prune, at most once every <sweepEvery> seconds. Neither is urgent: a job that's waiting
+        to be marked failed can't be claimed in the meantime, and one that's waiting to be pruned is only taking space
+        """
+
+        if time.time() - self.sweptAt < self.sweepEvery:
+            return
+        self.sweptAt = time.time()
+        self.fail_expired()
+        self.prune()
+
+    def fail_expired(self):
+        """
+        Marks failed the jobs whose last attempt's lease ran out, since they can't be claimed again to be released
+        """
+
+        con = con_postgres()
+        call_sql(con, '''UPDATE "Jobs" SET state = 'failed', lease_until = Null, finished = localtimestamp
+                         WHERE queue = %s AND state = 'leased' AND lease_until < localtimestamp AND attempts >= %s''',
+                 [self.name, self.maxAttempts], 'executeNoReturn', prepare=True)
+        con.close()
+
+    def finish(self, keys, setTxt):
+
+        if not keys:
+            return
+
+        sqlTxt = '''UPDATE "Jobs" SET {}, lease_until = Null
+                    WHERE queue = %s AND key = ANY(%s) AND state = 'leased' AND worker = %s'''.format(setTxt)
+        con = con_postgres()
+        call_sql(con, sqlTxt, [self.name, sorted(str(k) for k in keys), self.worker], 'executeNoReturn', prepare=True)
+        con.close()
+
+    def reclaim_host(self):
+        """
+        Puts back any jobs leased to another worker on this host. Only call it when no other worker on this host is
+        using this queue, i.e. when they were left behind by a worker that crashed, so they needn't wait out their lease.
+        """
+
+        con = con_postgres()
+        call_sql(con, '''UPDATE "Jobs" SET {}, lease_until = Null
+                         WHERE queue = %s AND state = 'leased' AND worker LIKE %s AND worker <> %s'''.format(self.putBack),
+                 [self.name, self.host + ':%', self.worker], 'executeNoReturn')
+        con.close()
+        self.numReady = None
+        self.prune()
+
+    def prune(self):
+        """
+        Deletes the jobs that have been done or failed for <pruneAfter>. extend() would put them back anyway, and a
+        poll adds the failed ones again once they're gone, so they get another <maxAttempts>.
+        """
+
+        con = con_postgres()
+        call_sql(con, '''DELETE FROM "Jobs"
+                         WHERE queue = %s AND state IN ('done', 'failed') AND finished < localtimestamp - %s * interval '1 second' ''',
+                 [self.name, self.pruneAfter.total_seconds()], 'executeNoReturn', prepare=True)
+        con.close()
+
+    def discard(self, item):
+
+        con = con_postgres()
+        call_sql(con, '''DELETE FROM "Jobs" WHERE queue = %s AND key = %s''', [self.name, str(self.key(item))],
+                 'executeNoReturn')
+        con.close()
+        self.numReady = None
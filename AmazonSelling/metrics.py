@@ -0,0 +1,298 @@
+"""
+Per-stage metrics for the Routine: items and calls, where the time goes (waiting on quota, the MWS API, parsing,
+SQL, idle), how deep the queue is, and how much of the quota is being used.
+
+Each stage keeps a StageMetrics in its own process, and every <flushEvery> seconds writes a snapshot of it to
+<metricsDir> as JSON (atomically, so a reader never sees half a file). render() merges the snapshots into the
+Prometheus text format, which is served by MetricsServer (python -m AmazonSelling.metrics [port]) or written out for a
+textfile collector by write_textfile().
+
+Time is split into phases with timed(): a phase's time doesn't include the phases timed inside it, so a call's 'parse'
+time is what's left after its 'api' and 'sql' time (timed in Amazon.mwsutils and tools.call_sql) are taken out.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+metricsDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DataFiles', 'metrics')
+
+phases = ('quota', 'api', 'parse', 'sql', 'idle')
+callBuckets = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # Upper bounds of the call latency histogram, in seconds
+
+# name: (type, help). Counters are stored without the _total suffix
+metricDefs = {
+    'items':           ('counter', 'Items sent to MWS'),
+    'records':         ('counter', 'Records written to SQL'),
+    'calls':           ('counter', 'Calls of the stage\'s mwsutils function'),
+    'throttled':       ('counter', 'Requests that MWS throttled'),
+    'quota_tokens':    ('counter', 'Quota tokens taken from the stage\'s token bucket'),
+    'sql_retries':     ('counter', 'SQL statements retried after a deadlock or serialization failure'),
+    'seconds':         ('counter', 'Time spent in each phase, not counting the phases within it'),
+    'queue_depth':     ('gauge',   'Items waiting in the stage\'s queue'),
+    'quota_rate':      ('gauge',   'The token bucket\'s restore rate right now, in tokens per second'),
+    'quota_available': ('gauge',   'Tokens in the token bucket'),
+    'last_update':     ('gauge',   'Unix time of the snapshot'),
+    'call_seconds':    ('histogram', 'Time taken by each call of the stage\'s mwsutils function')}
+
+_local = threading.local()  # .metrics is the StageMetrics being timed into on this thread, .stack the open phases
+
+
+class StageMetrics:
+    """
+    The metrics for stage <stage> of Routine <routine>. Safe to update from several threads (the asyncio Routine
+    mode runs each stage's calls in a thread pool).
+    """
+
+    def __init__(self, routine, stage, flushEvery=15, theDir=metricsDir):
+
+        self.routine = routine
+        self.stage = stage
+        self.flushEvery = flushEvery
+        self.path = os.path.join(theDir, '{}.{}.json'.format(routine, stage))
+        self.lock = threading.Lock()
+
+        self.counters = {name: 0 for name in ('items', 'records', 'calls', 'throttled', 'quota_tokens',
+                                                    'sql_retries')}
+        self.seconds = {phase: 0.0 for phase in phases}
+        self.gauges = {}
+        self.callCounts = [0] * (len(callBuckets) + 1)  # The last one is +Inf
+        self.callSum = 0.0
+        self.lastFlush = 0.0
+
+    def count(self, name, n=1):
+
+        with self.lock:
+            self.counters[name] += n
+
+    def add_time(self, phase, secs):
+
+        with self.lock:
+            self.seconds[phase] += secs
+
+    def record_call(self, numItems, numRecords, secs):
+
+        with self.lock:
+            self.counters['calls'] += 1
+            self.counters['items'] += numItems
+            self.counters['records'] += numRecords
+            self.callSum += secs
+            self.callCounts[next((i for i, b in enumerate(callBuckets) if secs <= b), len(callBuckets))] += 1
+
+    def activate(self):
+        """
+        Makes this the active StageMetrics on this thread from now on (for a stage that has a process to itself)
+        """
+
+        _local.metrics = self
+
+    def run(self, func, *args):
+        """
+        Returns func(*args), with this StageMetrics active on this thread for the duration, so timed() and count()
+        calls within it are recorded here
+        """
+
+        prev = getattr(_local, 'metrics', None)
+        _local.metrics = self
+        try:
+            return func(*args)
+        finally:
+            _local.metrics = prev
+
+    def snapshot(self):
+
+        with self.lock:
+            return {'routine': self.routine, 'stage': self.stage, 'counters': dict(self.counters),
+                    'seconds': dict(self.seconds), 'gauges': dict(self.gauges, last_update=time.time()),
+                    'callCounts': list(self.callCounts), 'callSum': self.callSum}
+
+    def flush(self, gaugeFunc=None, force=False):
+        """
+        Writes a snapshot to <self.path>, if it's been <self.flushEvery> seconds since the last one (or <force>).
+        <gaugeFunc> returns {gauge name: value}. It's only called when there's a flush, so it can be slow.
+        """
+
+        if not force and time.time() - self.lastFlush < self.flushEvery:
+            return
+        self.lastFlush = time.time()
+
+        if gaugeFunc is not None:
+            gauges = gaugeFunc()
+            with self.lock:
+                self.gauges.update(gauges)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmpPath = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmpPath, self.path)
+
+
+@contextmanager
+def timed(phase):
+    """
+    Times the block as <phase> in the StageMetrics active on this thread, if there is one
+    """
+
+    m = getattr(_local, 'metrics', None)
+    if m is None:
+        yield
+        return
+
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    entry = [time.perf_counter(), 0.0]  # [start, time spent in phases within this one]
+    _local.stack.append(entry)
+    try:
+        yield
+    finally:
+        _local.stack.pop()
+        secs = time.perf_counter() - entry[0]
+        m.add_time(phase, secs - entry[1])
+        if _local.stack:
+            _local.stack[-1][1] += secs
+
+
+def count(name, n=1):
+    """
+    Adds <n> to counter <name> of the StageMetrics active on this thread, if there is one
+    """
+
+    m = getattr(_local, 'metrics', None)
+    if m is not None:
+        m.count(name, n)
+
+
+def load_snapshots(theDir=metricsDir):
+    """
+    Returns the latest snapshot of every stage that has written one to <theDir>
+    """
+
+    snaps = []
+    if not os.path.isdir(theDir):
+        return snaps
+    for fileName in sorted(os.listdir(theDir)):
+        if fileName.endswith('.json'):
+            try:
+                with open(os.path.join(theDir, fileName), encoding='utf-8') as f:
+                    snaps.append(json.load(f))
+            except (OSError, ValueError) as err:
+                print('metrics.load_snapshots: could not read {}: {}'.format(fileName, err))
+    return snaps
+
+
+def render(snaps):
+    """
+    Returns the snapshots <snaps> in the Prometheus text exposition format
+    """
+
+    samples = {name: [] for name in metricDefs}  # {metric: [(labels, value)]}
+    for snap in snaps:
+        labels = 'routine="{}",stage="{}"'.format(snap['routine'], snap['stage'])
+        for name, value in snap['counters'].items():
+            samples[name].append(('{{{}}}'.format(labels), value))
+        for phase, value in snap['seconds'].items():
+            samples['seconds'].append(('{{{},phase="{}"}}'.format(labels, phase), value))
+        for name, value in snap['gauges'].items():
+            if value is not None:
+                samples[name].append(('{{{}}}'.format(labels), value))
+
+        cumulative = 0
+        for bound, n in zip(callBuckets + ('+Inf',), snap['callCounts']):
+            cumulative += n
+            samples['call_seconds'].append(('_bucket{{{},le="{}"}}'.format(labels, bound), cumulative))
+        samples['call_seconds'].append(('_sum{{{}}}'.format(labels), snap['callSum']))
+        samples['call_seconds'].append(('_count{{{}}}'.format(labels), cumulative))
+
+    lines = []
+    for name, (metricType, helpTxt) in metricDefs.items():
+        if not samples[name]:
+            continue
+        fullName = 'routine_{}{}'.format(name, '_total' if metricType == 'counter' else '')
+        lines.append('# HELP {} {}'.format(fullName, helpTxt))
+        lines.append('# TYPE {} {}'.format(fullName, metricType))
+        lines += ['{}{} {}'.format(fullName, labels, value) for labels, value in samples[name]]
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, theDir=metricsDir):
+    """
+    Writes everything in <theDir> to <path> in the Prometheus text format, e.g. for node_exporter's textfile collector
+    """
+
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'w', encoding='utf-8') as f:
+        f.write(render(load_snapshots(theDir)))
+    os.replace(tmpPath, path)
+
+
+class MetricsServer:
+    """
+    Serves render() of the snapshots in <theDir> on http://<host>:<port>/metrics. Use start()/stop(), or
+    serve_forever() from __main__.
+    It only listens on localhost unless <host> says otherwise, e.g. '0.0.0.0' for a scraper on another host.
+    """
+
+    def __init__(self, host='localhost', port=9464, theDir=metricsDir):
+
+        self.host = host
+        self.port = port
+        self.theDir = theDir
+        self.server = None
+        self.thread = None
+
+    def start(self):
+
+        self.server = ThreadingHTTPServer((self.host, self.port), self.handler_class())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        print('MetricsServer: serving on http://{}:{}/metrics'.format(self.host, self.port))
+
+    def stop(self):
+
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def serve_forever(self):
+
+        self.start()
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def handler_class(self):
+
+        theDir = self.theDir
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                payload = render(load_snapshots(theDir)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+
+    MetricsServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 9464).serve_forever()
@@ -0,0 +1,36 @@
+"""
+Record types for parsed MWS and Walmart API data.
+They're namedtuples, so they have no per-instance dict, and each one is already a tuple of SQL parameters in the
+column order of the statement it's written with. Field names are the SQL column names.
+"""
+
+from collections import namedtuple
+
+
+rankFields = ('salesrank1', 'catid1', 'salesrank2', 'catid2', 'salesrank3', 'catid3', 'salesrank4', 'catid4')
+
+# One Product from a GetMatchingProductForIdResult. item_attribs, relationships and sales_ranks are xml text
+AzProduct = namedtuple('AzProduct', ('asin', 'az_name', 'az_brand', 'var_parent') + rankFields +
+                       ('item_attribs', 'relationships', 'sales_ranks'))
+
+# A GetMatchingProductForIdResult: the UPC/ASIN/etc. it was for, and a list of AzProducts
+AzMatchResult = namedtuple('AzMatchResult', ('id', 'products'))
+
+# Rows for Products_WmAz and Matcher_WmAz, written by Products.match_to_az
+ProductMatch = namedtuple('ProductMatch', ('asin', 'az_name', 'wm_id', 'wm_name', 'wm_price', 'upc', 'az_brand',
+                                           'wm_instock', 'free_ship') + rankFields + ('var_parent',))
+MatcherCandidate = namedtuple('MatcherCandidate', ('unique_id', 'upc', 'wm_id', 'wm_name', 'wm_price', 'wm_model',
+                                                   'wm_brand', 'asin', 'item_attribs', 'relationships', 'sales_ranks'))
+
+# UPDATE "Products_WmAz" parameters, with the asin for the WHERE clause last
+CompPricing = namedtuple('CompPricing', ('comp_price',) + rankFields + ('trade_in', 'asin'))
+LowestOffers = namedtuple('LowestOffers', ('lowest_fba', 'lowest_merch', 'asin'))
+FeesEstimate = namedtuple('FeesEstimate', ('my_price', 'fees_est', 'asin'))
+
+# A row of Prod_Wm, from the Search or Product Lookup APIs
+WmItem = namedtuple('WmItem', ('fetched', 'wm_id', 'name', 'price', 'upc', 'model', 'brand', 'in_stock',
+                               'avail_online', 'free_ship', 'clearance'))
+
+# A subcategory of the Walmart taxonomy, for WmTaxo_Updated
+TaxoNode = namedtuple('TaxoNode', ('full_id', 'dept_id', 'dept_name', 'cat_id', 'cat_name', 'subcat_id',
+                                   'subcat_name', 'update_uuid', 'birthdate'))
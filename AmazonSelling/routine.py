@@ -1,13 +1,23 @@
 import abc
+import asyncio
 import datetime
+import heapq
+import itertools
+import math
+import queue
 import time
-from collections import deque
 from decimal import Decimal
-from multiprocessing import Process, Pipe, Value, Lock
+from multiprocessing import Process, Pipe, Queue, Event
 from multiprocessing.connection import wait
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from Amazon.mwsutils import Products, FulfillmentInventory
-from AmazonSelling.tools import call_sql, union_no_dups, make_sql_list, con_postgres
+from Amazon.mwsutils import Products, FulfillmentInventory, quotaListeners, calc_column
+from AmazonSelling.jobqueue import JobQueue
+from AmazonSelling.metrics import StageMetrics, load_snapshots, timed
+from AmazonSelling.schema import ensure_schema
+from AmazonSelling.throttle import TokenBucket, PgTokenBucket
+from AmazonSelling.tools import call_sql, con_postgres, datetime_floor, pg_pool, WorkQueue
 from Walmart.walmartclasses import WmRoutine, update_wm_data_timestamps
 
 
@@ -30,49 +40,91 @@ class Routine:
     'gmpfAsin':  {'maxreqquota': 20, 'restorerate': 10,             'maxpercall': 20, 'minpercall': 16},
     'lis':       {'maxreqquota': 30, 'restorerate': 2,              'maxpercall': 10, 'minpercall': 0}}  # Actual maxpercall is 50
 
+    # The ops whose queues are a PriorityWorkQueue ordered by priority_score, rather than a FIFO WorkQueue. Their
+    # queries return (key, due, net, salesrank, hours overdue, Walmart price change since last check)
+    prioritized = ()
+    priorityWeights = {'net': 1.0, 'salesrank': 10.0, 'overdue': 0.1, 'priceChange': 20.0}
+    longTailShare = 0.2  # The share of each call that goes to the longest-waiting items, whatever their score
+    
+    # If True, each op's queue is a JobQueue named after the Routine and the op, kept in the "Jobs" table, so it
+    # survives a crash and can be shared by Routines on several hosts. If False, it's a WorkQueue in the process.
+    durable = True
+    
+    # If True, the stages keep going rather than finishing once their upstream stages have, polling for items as they
+    # become due at most every <pollEvery> seconds. RoutineContinuous is the Routine that runs like that
+    continuous = False
+    pollEvery = 0
+    
+    # If True, the MWS quotas are PgTokenBuckets, shared with every other Routine using the same database, since
+    # the quotas are per seller account. If False, they're TokenBuckets, shared only by this Routine's processes.
+    sharedQuotas = True
+    
+    # The token buckets adjust their restore rates from MWS's responses (see TokenBucket.feedback), up to <rateCeiling>
+    # times the restorerate in <throt>
+    rateCeiling = 2.0
+    
+    # The MWS Action each op in <throt> calls, for Amazon.mwsutils.quotaListeners
+    mwsActions = {
+    'lmp':       'ListMatchingProducts',
+    'gpcfAsin':  'GetProductCategoriesForASIN',
+    'gmp':       'GetMatchingProduct',
+    'gmpfId':    'GetMatchingProductForId',
+    'gcpfAsin':  'GetCompetitivePricingForASIN',
+    'glolfAsin': 'GetLowestOfferListingsForASIN',
+    'glpofAsin': 'GetLowestPricedOffersForASIN',
+    'gmfe':      'GetMyFeesEstimate',
+    'gmpfAsin':  'GetMatchingProductForASIN',
+    'lis':       'ListInventorySupply'}
+    jobKeyTypes = {'gmpfId': int}  # For the JobQueues. Other ops' keys are ASINs or SKUs
+    
+    # How long (seconds) a stage with several upstream stages holds on to an ASIN that only some of them have pushed.
+    # After that, the one that hasn't probably failed it, so it's dropped, and left to the stage's due query
+    joinFor = 900
+
     def __init__(self):
         pass
         
-    def routine(self):
+    def routine(self, mode='processes'):
+        """
+        Runs every stage in <self.triggers>. <mode> is 'processes' (a Process per stage) or 'asyncio' (see routine_async)
+        """
         
-        mwsProducts = Products()
-        procs = {
-        'wm':        {'func': None,                                             'target': WmRoutine().routine},
-        'lmp':       {'func': None,                                             'target': self.mws_proc},
-        'gpcfAsin':  {'func': None,                                             'target': self.mws_proc},
-        'gmp':       {'func': None,                                             'target': self.mws_proc},
-        'gmpfId':    {'func': mwsProducts.match_to_az,                          'target': self.mws_proc},
-        'gcpfAsin':  {'func': mwsProducts.get_comp_pricing,                     'target': self.mws_proc},
-        'glolfAsin': {'func': mwsProducts.get_lowest_offer_listings,            'target': self.mws_proc},
-        'glpofAsin': {'func': None,                                             'target': self.mws_proc},
-        'gmfe':      {'func': mwsProducts.get_fees_est,                         'target': self.mws_proc},
-        'gmpfAsin':  {'func': None,                                             'target': self.mws_proc},
-        'lis':       {'func': FulfillmentInventory().get_list_inventory_supply, 'target': self.mws_proc}}
+        if mode == 'asyncio':
+            asyncio.run(self.routine_async())
+            return
         
-        ammo = {op: {'val': Value('i', self.throt[op]['maxreqquota']), 'lock': Lock()} for op in self.throt}
+        procs = self.stage_procs()
         
         # Holds the pipe ends that are passed to each process, and are used to signal when each process has finished.
         # Defines the hierarchy of the processes - the order in which they will terminate, from upstream to downstream.
         # The keys in <self.triggers> also define which procs will be run by this routine
-                
-        allDone = Value('i', 0)  # This is for throttle_refresher
-        allDoneLock = Lock()
-        
-        thr = Process(target=self.throttle_refresher, args=(ammo, allDone))
-        thr.start()
         
         allProcs = []
+        ensure_schema()
+        buckets = self.make_buckets()
         self.qDefs = self.get_query_defs()
         update_wm_data_timestamps()
         
         for op in self.triggers:
             for sendEnd in self.triggers[op]['send']:
                 self.triggers[sendEnd]['recv'][op], self.triggers[op]['send'][sendEnd] = Pipe(duplex=False)
+        
+        # Between two MWS processes, each batch of finished ASINs is also pushed straight downstream over a Queue,
+        # so the downstream process can start on them right away instead of waiting to find them in SQL. Stages
+        # marked 'takesStreams' in stage_procs (post_proc) get them too
+        takesStreams = {op: procs[op]['target'] == self.mws_proc or procs[op].get('takesStreams', False)
+                        for op in self.triggers}
+        streams = {(op, sendEnd): Queue() for op in self.triggers for sendEnd in self.triggers[op]['send']
+                   if procs[op]['target'] == self.mws_proc and takesStreams[sendEnd]}
                 
         for op in self.triggers:
             theKwargs = {'op': op, 'func': procs[op]['func'], 'triggs': self.triggers[op]}
-            if op in ammo:
-                theKwargs['ammo'] = ammo[op]
+            if op in buckets:
+                theKwargs['bucket'] = buckets[op]
+            if takesStreams[op]:
+                theKwargs['streamsIn'] = {up: streams[(up, down)] for up, down in streams if down == op}
+            if procs[op]['target'] == self.mws_proc:
+                theKwargs['streamsOut'] = {down: streams[(up, down)] for up, down in streams if up == op}
 
             # noinspection PyTypeChecker
             procs[op]['proc'] = Process(target=procs[op]['target'], kwargs=theKwargs)
@@ -85,36 +137,121 @@ class Routine:
             
             '''
             Create another process that periodically prints out which processes are currently active
-            It can use <allDone> to know when to stop
+            It can stop once every process in <allProcs> has been joined
             '''
             # printr = Process(target=self.print_active_procs)
             # printr.start()
 
         for p in allProcs:
             p.join()
+    
+    def stage_procs(self):
+        """
+        Returns {op: {'func': the mwsutils function it runs, 'target': what runs it}} for every op a Routine can have
+        """
         
-        with allDoneLock:
-            allDone.value = 1
+        mwsProducts = Products()
+        return {
+        'wm':        {'func': None,                                             'target': WmRoutine().routine},
+        'lmp':       {'func': None,                                             'target': self.mws_proc},
+        'gpcfAsin':  {'func': None,                                             'target': self.mws_proc},
+        'gmp':       {'func': None,                                             'target': self.mws_proc},
+        'gmpfId':    {'func': mwsProducts.match_to_az,                          'target': self.mws_proc},
+        'gcpfAsin':  {'func': mwsProducts.get_comp_pricing,                     'target': self.mws_proc},
+        'glolfAsin': {'func': mwsProducts.get_lowest_offer_listings,            'target': self.mws_proc},
+        'glpofAsin': {'func': None,                                             'target': self.mws_proc},
+        'gmfe':      {'func': mwsProducts.get_fees_est,                         'target': self.mws_proc},
+        'gmpfAsin':  {'func': None,                                             'target': self.mws_proc},
+        'lis':       {'func': FulfillmentInventory().get_list_inventory_supply, 'target': self.mws_proc}}
+    
+    async def routine_async(self, maxThreads=8):
+        """
+        Runs the same stages as routine(), but as coroutines in this one process, using mws_stage in place of mws_proc.
+        There's no async MWS or Postgres library in use here, so the blocking calls (SQL, and the mwsutils functions)
+        run in a pool of <maxThreads> threads while the event loop does the throttling and the hand-offs between
+        stages. Stages that aren't MWS functions (WmRoutine) run in the pool as they are, and still start their own
+        processes.
+        """
+        
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=maxThreads))
+        
+        # Every stage shares this process's connection pool. A thread can hold two connections at once (get_fees_est
+        # and record_timestamps within it, say), so there are enough for every thread to reuse theirs
+        pg_pool().size = 2 * maxThreads
+        
+        procs = self.stage_procs()
+        
+        await loop.run_in_executor(None, ensure_schema)
+        buckets = await loop.run_in_executor(None, self.make_buckets)
+        for op in buckets:
+            quotaListeners[self.mwsActions[op]] = buckets[op]
+        self.qDefs = self.get_query_defs()
+        await loop.run_in_executor(None, update_wm_data_timestamps)
+        
+        isMws = {op: procs[op]['target'] == self.mws_proc for op in self.triggers}
+        
+        # Pipes are only needed for stages that aren't MWS functions, which signal through their <triggs> as usual
+        for op in self.triggers:
+            for sendEnd in self.triggers[op]['send']:
+                if not isMws[op]:
+                    self.triggers[sendEnd]['recv'][op], self.triggers[op]['send'][sendEnd] = Pipe(duplex=False)
+        
+        # A stage that takes streams but isn't an MWS stage runs in the executor, so its streams are thread-safe Queues
+        streams = {(op, sendEnd): asyncio.Queue() if isMws[sendEnd] else queue.Queue()
+                   for op in self.triggers for sendEnd in self.triggers[op]['send']
+                   if isMws[op] and (isMws[sendEnd] or procs[sendEnd].get('takesStreams', False))}
+        
+        stages = []
+        for op in self.triggers:
+            if isMws[op]:
+                stages.append(self.mws_stage(op, procs[op]['func'], buckets[op],
+                                             {up: streams[(up, down)] for up, down in streams if down == op},
+                                             {down: streams[(up, down)] for up, down in streams if up == op},
+                                             {up: self.triggers[op]['recv'][up] for up in self.triggers[op]['recv']
+                                              if not isMws[up]}))
+            else:
+                theKwargs = {'op': op, 'func': procs[op]['func'], 'triggs': self.triggers[op]}
+                if procs[op].get('takesStreams', False):
+                    theKwargs['streamsIn'] = {up: streams[(up, down)] for up, down in streams if down == op}
+                stages.append(loop.run_in_executor(None, partial(procs[op]['target'], **theKwargs)))
         
-        thr.join()
+        await asyncio.gather(*stages)
     
     def mws_proc(self, **kwargs):
         """
-        Continuously runs its MWS function until the previous MWS function reports that it's all done.
-        When the previous MWS function (or Walmart's Routine, in the case of gmpfId) is done, this function
-        will update its queue with the rest of the items, run through all those until they're complete, and
-        then report itself as all done.
+        Continuously runs its MWS function until the previous MWS functions report that they're all done.
+        Items come from three places: the fill_q query, run at the start for whatever's left over from before (and
+        again each time the queue runs low, while a paged query still has more pages);
+        the ASINs that upstream MWS processes push through <streamsIn> as soon as they've written them; and, for
+        processes fed by something that doesn't stream (Walmart's Routine, in the case of gmpfId), the fill_q query
+        run again whenever the queue runs low.
+        When there's more than one upstream process, an ASIN is only queued once every one of them has pushed it.
+        Once all upstream processes are done, the fill_q query is run one last time to sweep up anything that was
+        missed, those items are run through, and then this process reports itself as all done.
         """
 
+        streamsIn, streamsOut = {}, {}
         for key, value in kwargs.items():
             if key == 'op':
                 op = value
             if key == 'func':
                 func = value
-            if key == 'ammo':
-                ammo = value
+            if key == 'bucket':
+                bucket = value
             if key == 'triggs':
                 triggs = value
+            if key == 'streamsIn':
+                streamsIn = value
+            if key == 'streamsOut':
+                streamsOut = value
+        
+        # So this process's MWS requests report back to <bucket> (see Amazon.mwsutils.quota_feedback)
+        quotaListeners[self.mwsActions[op]] = bucket
+        
+        # Everything timed in this process (SQL, MWS requests) is recorded for this stage
+        m = StageMetrics(type(self).__name__, op)
+        m.activate()
              
 #         if op == 'gmpfId':
 #             print ("Asd")
@@ -123,38 +260,52 @@ class Routine:
             
         if type(self.qDefs[op]['qry']) is str:
             isQry = True
-            q = deque()
+            q = self.make_queue(op)
+            self.fill_q(op, q)
             
             # A dict with keys equal to the keys in triggs['recv'], and all values False
             finishUps = {recvEnd: False for recvEnd in triggs['recv']}
                     
         elif type(self.qDefs[op]['qry']) in (list, tuple):
             isQry = False
-            q = deque(self.qDefs[op]['qry'])
-            finishUps = {'bluhhuuuuurrrpp': True}
+            q = self.make_queue(op, self.qDefs[op]['qry'])
+            finishUps = {recvEnd: False for recvEnd in streamsIn}
             
         else:
             print("Invalid value for self.qDefs[op]['qry'] in routine.Routine.mws_proc")
             return
         
+        # Only poll SQL for new items if some upstream process can't push them here itself, or items become due
+        # by themselves (in a continuous Routine)
+        polls = isQry and (self.continuous or any(recvEnd not in streamsIn for recvEnd in triggs['recv']))
+        swept = not isQry
+        joins = {}  # {asin: (set of the upstream ops that have pushed it so far, when the first one did)}
+        lastFill = time.time()
+        
         funcName = func.__name__
 
-        throtGap = 1.1
-        qGap = 8
+        qGap = 8 if polls and not streamsIn else 0.25  # Streamed items shouldn't have to wait long
         
         while True:
             prev = time.time()
             
+            q.extend((key,) for key in self.recv_streams(streamsIn, joins, finishUps))
+            
             finished = all(q for q in finishUps.values())  # Will be T if all values in finishUps are T, else F
             
             # If we don't have enough items for a full call, check to see if more items are ready
             if len(q) < self.throt[op]['maxpercall']:
-                if isQry:
-                    q = self.fill_q(op, q)
+                if self.should_fill(op, polls, finished, swept, lastFill):
+                    self.fill_q(op, q)
+                    lastFill = time.time()
+                    swept = finished and not self.qDefs[op].get('more')
                 
                 if finished and len(q) == 0:
                     print("{} signing off!".format(funcName))
+                    m.flush(lambda: self.stage_gauges(q, bucket), force=True)
 
+                    for sendEnd in streamsOut:
+                        streamsOut[sendEnd].put(None)
                     for sendEnd in triggs['send']:
                         triggs['send'][sendEnd].send('')
                         triggs['send'][sendEnd].close()
@@ -162,40 +313,44 @@ class Routine:
                     break
 
             # Enough items in q to warrant an MWS call (which is anything > 0 if <finished> is True)
-            if len(q) >= (1 - finished) * self.throt[op]['minpercall']:
+            margs = []
+            if len(q) >= (1 - finished) * self.throt[op]['minpercall'] and len(q) > 0:
+                # Claimed before the tokens are taken, since a JobQueue can hand out fewer than len(q) said (its count
+                # is cached, and other hosts share it), or none at all
                 num = min(len(q), self.throt[op]['maxpercall'])
-                if ammo['val'].value >= num:  # Not gonna get throttled
-                    margs = [q.pop() for _ in range(num)]
-                    
-                    if margs:
-                        if len(margs[0]) == 1:  # Convert a list of single-length tuples/lists to just a list
-                            margs = [elem[0] for elem in margs]
-                    
-#                     Run the mwsutils function                    
-                    print("{} - starting".format(funcName))
-                    if op == 'gmpfId':
-                        func('Walmart', 'upc', margs)
-                    elif op == 'gcpfAsin':
-                        func(margs)
-                    elif op == 'glolfAsin':
-                        func(margs)
-                    elif op == 'gmfe':
-                        func(margs)
-                    elif op == 'lis':
-                        func(margs)
-                    print("{} - leaving".format(funcName))
-                        
-                    with ammo['lock']:
-                        ammo['val'].value -= len(margs)
-                        
+                margs = [WorkQueue.key(elem) for elem in q.pop_many(num)]  # Just the first column of each row
+            
+            if margs:
+                # Sleeps exactly until the throttle has the tokens, so this isn't going to get throttled
+                m.add_time('quota', bucket.take(len(margs)))
+                m.count('quota_tokens', len(margs))
+                
+#                 Run the mwsutils function
+                print("{} - starting".format(funcName))
+                records = self.timed_call(m, op, func, margs)
+                # None means the call (or its writes) failed, so its jobs go back in the queue, to be tried again
+                # until they've used up the JobQueue's maxAttempts
+                if records is None:
+                    q.release(margs)
                 else:
-                    time.sleep(max(prev + throtGap - time.time(), 0))
+                    q.complete(margs)
+                print("{} - leaving".format(funcName))
+                
+                # Push the finished ASINs straight to the downstream processes
+                if streamsOut and records:
+                    keys = self.stream_keys(op, records)
+                    if keys:
+                        for sendEnd in streamsOut:
+                            streamsOut[sendEnd].put(keys)
             else:
                 # The only way I could find to trip a condition after a message is sent down a pipe in another process.
                 # https://docs.python.org/3/library/multiprocessing.html#multiprocessing.connection.wait
                 # Checks each receive Pipe end for a message. <finishedUps> records which receive Pipe ends have gotten
-                # their message.
+                # their message. Upstream processes that stream are done when their stream says so, in recv_streams,
+                # since their last items could still be in the stream after the Pipe message has arrived.
                 for recvEnd in triggs['recv']:
+                    if recvEnd in streamsIn:
+                        continue
                     if wait([triggs['recv'][recvEnd]], 0.1) and not finishUps[recvEnd]:
                         try:
                             _ = triggs['recv'][recvEnd].recv()
@@ -204,56 +359,359 @@ class Routine:
                             print("{} giving EOFError".format(op))
                             finishUps[recvEnd] = True             
                 
-                time.sleep(max(prev + qGap - time.time(), 0))
+                with timed('idle'):
+                    time.sleep(max(prev + qGap - time.time(), 0))
+            
+            m.flush(lambda: self.stage_gauges(q, bucket))
 
+    async def mws_stage(self, op, func, bucket, streamsIn, streamsOut, recvEnds):
+        """
+        The asyncio version of mws_proc, for routine_async. <streamsIn>/<streamsOut> are asyncio Queues, and
+        <recvEnds> are the Pipe ends from upstream stages that don't stream (WmRoutine).
+        SQL and the mwsutils function run in the event loop's executor, so other stages carry on in the meantime. That
+        includes every use of the queue, since a JobQueue's are SQL too.
+        """
+        
+        loop = asyncio.get_running_loop()
+        
+        # This stage shares the process, so its metrics are only active around what it runs in the executor
+        m = StageMetrics(type(self).__name__, op)
+        
+        if type(self.qDefs[op]['qry']) is str:
+            isQry = True
+            q = await loop.run_in_executor(None, self.make_queue, op)
+            await loop.run_in_executor(None, m.run, self.fill_q, op, q)
+            finishUps = {recvEnd: False for recvEnd in list(recvEnds) + list(streamsIn)}
+        
+        elif type(self.qDefs[op]['qry']) in (list, tuple):
+            isQry = False
+            q = await loop.run_in_executor(None, self.make_queue, op, self.qDefs[op]['qry'])
+            finishUps = {recvEnd: False for recvEnd in streamsIn}
+        
+        else:
+            print("Invalid value for self.qDefs[op]['qry'] in routine.Routine.mws_stage")
+            return
+        
+        polls = isQry and (self.continuous or bool(recvEnds))
+        swept = not isQry
+        joins = {}
+        lastFill = time.time()
+        
+        funcName = func.__name__
+        
+        qGap = 8 if polls and not streamsIn else 0.25  # Streamed items shouldn't have to wait long
+        
+        while True:
+            prev = loop.time()
+            
+            # recv_streams stays on the event loop, since asyncio Queues aren't thread-safe
+            newItems = [(key,) for key in self.recv_streams(streamsIn, joins, finishUps)]
+            if newItems:
+                await loop.run_in_executor(None, q.extend, newItems)
+            for recvEnd in recvEnds:
+                if not finishUps[recvEnd] and recvEnds[recvEnd].poll():
+                    try:
+                        _ = recvEnds[recvEnd].recv()
+                    except EOFError:
+                        print("{} giving EOFError".format(op))
+                    finishUps[recvEnd] = True
+            
+            finished = all(finishUps.values())
+            
+            qLen = await loop.run_in_executor(None, len, q)
+            if qLen < self.throt[op]['maxpercall']:
+                if self.should_fill(op, polls, finished, swept, lastFill):
+                    await loop.run_in_executor(None, m.run, self.fill_q, op, q)
+                    lastFill = time.time()
+                    swept = finished and not self.qDefs[op].get('more')
+                    qLen = await loop.run_in_executor(None, len, q)
+                
+                if finished and qLen == 0:
+                    print("{} signing off!".format(funcName))
+                    await loop.run_in_executor(None, partial(m.flush, lambda: self.stage_gauges(q, bucket), force=True))
+                    for sendEnd in streamsOut:
+                        streamsOut[sendEnd].put_nowait(None)
+                    break
+            
+            margs = []
+            if qLen >= (1 - finished) * self.throt[op]['minpercall'] and qLen > 0:
+                num = min(qLen, self.throt[op]['maxpercall'])
+                margs = [WorkQueue.key(elem) for elem in await loop.run_in_executor(None, q.pop_many, num)]
+            
+            if margs:
+                m.add_time('quota', await bucket.take_async(len(margs)))
+                m.count('quota_tokens', len(margs))
+                
+                print("{} - starting".format(funcName))
+                records = await loop.run_in_executor(None, m.run, self.timed_call, m, op, func, margs)
+                await loop.run_in_executor(None, q.release if records is None else q.complete, margs)
+                print("{} - leaving".format(funcName))
+                
+                if streamsOut and records:
+                    keys = await loop.run_in_executor(None, self.stream_keys, op, records)  # It can query SQL
+                    if keys:
+                        for sendEnd in streamsOut:
+                            streamsOut[sendEnd].put_nowait(keys)
+            else:
+                idle = max(prev + qGap - loop.time(), 0)
+                await asyncio.sleep(idle)
+                m.add_time('idle', idle)
+            
+            await loop.run_in_executor(None, m.flush, lambda: self.stage_gauges(q, bucket))
+    
+    def make_buckets(self):
+        """
+        Returns {op: token bucket} for each MWS op in <self.triggers>, shared by whichever stages use that operation
+        """
+        
+        buckets = {}
+        for op in self.triggers:
+            if op in self.throt:
+                if self.sharedQuotas:
+                    buckets[op] = PgTokenBucket(op, self.throt[op]['maxreqquota'], self.throt[op]['restorerate'],
+                                                ceiling=self.rateCeiling)
+                else:
+                    buckets[op] = TokenBucket(self.throt[op]['maxreqquota'], self.throt[op]['restorerate'],
+                                              ceiling=self.rateCeiling)
+        return buckets
+    
+    def make_queue(self, op, items=()):
+        """
+        Returns the queue for <op>, with <items> added: a JobQueue if <self.durable>, else a WorkQueue. Either way,
+        the ops in <self.prioritized> hand out their items by priority_score.
+        """
+        
+        scoreFunc = self.priority_score if op in self.prioritized else None
+        if self.durable:
+            q = JobQueue('{}.{}'.format(type(self).__name__, op), self.jobKeyTypes.get(op, str), scoreFunc,
+                         self.longTailShare)
+            q.reclaim_host()  # Only this process works on this queue from this host, so anything else is left over
+            q.extend(items)
+        elif scoreFunc:
+            q = PriorityWorkQueue(scoreFunc, self.longTailShare, items)
+        else:
+            q = WorkQueue(items)
+        return q
+    
+    def should_fill(self, op, polls, finished, swept, lastFill):
+        """
+        Whether <op>'s stage should run fill_q now: if its paged query has more pages, for the last sweep once its
+        upstream stages are done, or if it <polls> and it's been <self.pollEvery> seconds since the last fill (<lastFill>)
+        """
+        
+        if self.qDefs[op].get('more') or (finished and not swept):
+            return True
+        return polls and time.time() - lastFill >= self.pollEvery
+    
+    def timed_call(self, m, op, func, margs):
+        """
+        call_func, recorded in the StageMetrics <m>. Whatever time the call spends outside the MWS requests and SQL it
+        times itself is counted as parsing
+        """
+        
+        start = time.perf_counter()
+        with timed('parse'):
+            records = self.call_func(op, func, margs)
+        m.record_call(len(margs), len(records or []), time.perf_counter() - start)
+        return records
+    
+    def stage_gauges(self, q, bucket):
+        """
+        The gauges for a stage's metrics snapshot, from its queue <q> and token bucket <bucket>
+        """
+        
+        return {'queue_depth': len(q), 'quota_rate': bucket.rate, 'quota_available': bucket.available()}
+    
+    def call_func(self, op, func, margs):
+        """
+        Runs <op>'s mwsutils function on <margs>, and returns the records it wrote
+        """
+        
+        records = None
+        if op == 'gmpfId':
+            records = func('Walmart', 'upc', margs)
+        elif op == 'gcpfAsin':
+            records = func(margs)
+        elif op == 'glolfAsin':
+            records = func(margs)
+        elif op == 'gmfe':
+            records = func(margs)
+        elif op == 'lis':
+            records = func(margs)
+        return records
+    
+    def recv_streams(self, streamsIn, joins, finishUps):
+        """
+        Takes everything that's waiting in the <streamsIn> queues, without blocking.
+        Returns the ASINs that every upstream process has now pushed. ASINs still waiting on another upstream process
+        are kept in <joins>, for up to <self.joinFor> seconds. A None in a stream means that upstream process is done,
+        which is recorded in <finishUps>.
+        """
+        
+        ready = []
+        for upOp, stream in streamsIn.items():
+            while True:
+                try:
+                    keys = stream.get_nowait()
+                except (queue.Empty, asyncio.QueueEmpty):  # A multiprocessing Queue, or an asyncio one
+                    break
+                
+                if keys is None:
+                    finishUps[upOp] = True
+                    continue
+                
+                for key in keys:
+                    if len(streamsIn) == 1:
+                        ready.append(key)
+                        continue
+                    if key not in joins:
+                        joins[key] = (set(), time.time())
+                    joins[key][0].add(upOp)
+                    if len(joins[key][0]) == len(streamsIn):
+                        del joins[key]
+                        ready.append(key)
+        
+        # Drop the ASINs that have waited too long. <joins> is in the order they were first pushed, so they're the first
+        # ones. Whatever a failed upstream op didn't push is still due, so the due query finds it
+        cutoff = time.time() - self.joinFor
+        for key in list(itertools.takewhile(lambda k: joins[k][1] < cutoff, joins)):
+            del joins[key]
+        
+        return ready
+    
+    def priority_score(self, row):
+        """
+        Scores a row from a prioritized op's query: a weighted sum of its last net, how well it sells (salesrank is the
+        rank as a fraction of its category, so lower is better), how long it's been overdue, and how much its Walmart
+        price has changed since it was last checked. Missing values count as 0.
+        Rows without those columns (ASINs streamed from an upstream op) are scored highest, since they've just been
+        updated upstream and are waiting on this op to be complete.
+        """
+        
+        if len(row) < 6:
+            return math.inf
+        
+        net, salesrank, overdue, priceChange = (float(g) if g is not None else None for g in row[2:6])
+        w = self.priorityWeights
+        return (w['net'] * (net or 0.0) +
+                w['salesrank'] * (1.0 - salesrank if salesrank is not None else 0.0) +
+                w['overdue'] * (overdue or 0.0) +
+                w['priceChange'] * (priceChange or 0.0))
+    
+    def stream_keys(self, op, records):
+        """
+        Returns the ASINs that <op> pushes downstream, from the records its mwsutils function returned
+        """
+        
+        return list(dict.fromkeys(r.asin for r in records))
+    
     def fill_q(self, op, q):
         """
-        Updates the queue for each MWS function from SQL
+        Adds to the queue (a WorkQueue) for each MWS function from SQL
+        If the query def has a 'limit', the query is paged with a keyset: its last three parameters are the due time
+        and key of the last row of the previous page, and the LIMIT. Its rows are (key, due time). When a page comes
+        back short, the next call starts from the beginning again. <self.qDefs[op]['more']> says if there's more.
         """
         
-        if 'args' not in self.qDefs[op]:
-            self.qDefs[op]['args'] = []
+        qDef = self.qDefs[op]
+        if 'args' not in qDef:
+            qDef['args'] = []
+        
+        theArgs = list(qDef['args'])
+        if 'limit' in qDef:
+            theArgs += list(qDef.get('after', (None, None))) + [qDef['limit']]
 
         con = con_postgres()
-        # Combine with existing queue, ensuring no duplicates
-        blurp = deque(union_no_dups(list(q), call_sql(con, self.qDefs[op]['qry'], self.qDefs[op]['args'],
-                                                      "executeReturn")))
+        rows = call_sql(con, qDef['qry'], theArgs, "executeReturn", prepare=True) or []
         con.close()
-            
-        return blurp
-
-    def throttle_refresher(self, ammo, allDone):
-        """
-        Keep tabs on MWS throttle values, and refresh them every second, or whatever <gap> is
-        """
         
-        gap = 1.05
+        if 'limit' in qDef:
+            qDef['more'] = len(rows) == qDef['limit']
+            qDef['after'] = (rows[-1][1], rows[-1][0]) if qDef['more'] else (None, None)
         
-        while not allDone.value:
-            prev = time.time()
-            for op in self.throt.keys():
-                if ammo[op]['val'].value < self.throt[op]['maxreqquota']:
-                    with ammo[op]['lock']:
-                        ammo[op]['val'].value = min(ammo[op]['val'].value + self.throt[op]['restorerate'],
-                                                    self.throt[op]['maxreqquota'])
-#                     print ("{} - refreshed up to {}".format(op, ammo[op]['val'].value))
-            time.sleep(max(prev + gap - time.time(), 0))
-        
-        print("throttle_refresher signing off!")
+        # Add to the end of the existing queue, skipping any duplicates. Rows are keyed by their first column, and
+        # the rest is there for priority_score. Jobs that failed aren't put back by a poll until they've been pruned
+        q.extend(rows, retryFailed=False)
 
     @abc.abstractmethod
     def get_query_defs(self):
         pass
     
     def print_active_procs(self):
-        pass
-        raise NotImplementedError
+        """
+        Prints a line for each stage of this Routine from its latest metrics snapshot (see AmazonSelling.metrics)
+        """
+        
+        for snap in load_snapshots():
+            if snap['routine'] != type(self).__name__:
+                continue
+            secs = snap['seconds']
+            print('{:10} {:6} calls {:7} items, queue {:6}, {:.0f}s ago | quota {:.0f}s api {:.0f}s parse {:.0f}s '
+                  'sql {:.0f}s idle {:.0f}s'.format(snap['stage'], snap['counters']['calls'], snap['counters']['items'],
+                                                    snap['gauges'].get('queue_depth', 0),
+                                                    time.time() - snap['gauges']['last_update'], secs['quota'],
+                                                    secs['api'], secs['parse'], secs['sql'], secs['idle']))
     
     @abc.abstractmethod
     def define_attribs(self):
         raise NotImplementedError
         
 
+class PriorityWorkQueue(WorkQueue):
+    """
+    A WorkQueue that hands items out highest score first, except for a <longTailShare> of each pop_many, which goes to
+    the items that have been waiting longest. That way every item still gets its turn, whatever its score.
+    <scoreFunc> takes an item and returns its score. Scores are computed once, when the item is added.
+    """
+    
+    def __init__(self, scoreFunc, longTailShare=0.2, items=()):
+        self.scoreFunc = scoreFunc
+        self.longTailShare = longTailShare
+        self.heap = []  # (-score, seq, key). Entries for items that have since been popped are skipped lazily
+        self.seqs = {}  # {key: seq of its current heap entry}
+        self.numPushed = 0
+        super().__init__(items)
+    
+    def extend(self, items, retryFailed=True):
+        
+        numAdded = 0
+        for item in items:
+            k = self.key(item)
+            if k not in self.items:
+                self.items[k] = item
+                self.numPushed += 1
+                self.seqs[k] = self.numPushed
+                heapq.heappush(self.heap, (-self.scoreFunc(item), self.numPushed, k))
+                numAdded += 1
+        
+        if len(self.heap) > 2 * len(self.items) + 64:  # Drop the stale entries
+            self.heap = [entry for entry in self.heap if self.seqs.get(entry[2]) == entry[1]]
+            heapq.heapify(self.heap)
+        return numAdded
+    
+    def pop_many(self, n):
+        
+        n = min(n, len(self.items))
+        numTail = min(n, math.ceil(n * self.longTailShare))
+        
+        popped = []
+        for _ in range(numTail):
+            k, item = self.items.popitem(last=False)
+            del self.seqs[k]
+            popped.append(item)
+        
+        while len(popped) < n:
+            _, seq, k = heapq.heappop(self.heap)
+            if self.seqs.get(k) == seq:
+                del self.seqs[k]
+                popped.append(self.items.pop(k))
+        return popped
+    
+    def discard(self, item):
+        super().discard(item)
+        self.seqs.pop(self.key(item), None)
+    
+
 class RoutineOGaster(Routine):
     
     triggers = {
@@ -262,6 +720,8 @@ class RoutineOGaster(Routine):
     'gcpfAsin':  {'recv': {'gmpfId':   None},                     'send': {'gmfe':     None}},
     'glolfAsin': {'recv': {'gmpfId':   None},                     'send': {'gmfe':     None}},
     'gmfe':      {'recv': {'gcpfAsin': None,  'glolfAsin': None}, 'send': {}}}
+    
+    prioritized = ('gcpfAsin', 'glolfAsin', 'gmfe')
 
     def define_attribs(self):
         raise NotImplementedError
@@ -269,47 +729,212 @@ class RoutineOGaster(Routine):
     def get_query_defs(self):
         
         fillQDefs = {theProc: {} for theProc in ('gmpfId', 'gcpfAsin', 'glolfAsin', 'gmfe')}
+        
+        # Each query walks its next_due index (see AmazonSelling.schema) a page at a time, picking up after the last
+        # row of the previous page. fill_q fills in the last two %s's (the previous page's last due/key) and the LIMIT.
     
         # GetMatchingProductsForID
-        fillQDefs['gmpfId']['qry'] =    '''SELECT wm_id
+        fillQDefs['gmpfId']['qry'] =    '''SELECT wm_id, match_due
                                            FROM "Prod_Wm"
-                                           WHERE  upc IS NOT Null AND dup IS False
-                                           AND (last_matched IS Null OR EXTRACT(EPOCH FROM (localtimestamp -
-                                           last_matched)/86400) > 30)'''  # last_matched is either Null or at least 1 month old
+                                           WHERE upc IS NOT Null AND dup IS False
+                                           AND match_due <= localtimestamp  -- last_matched is either Null or at least 1 month old
+                                           AND (match_due, wm_id) > (COALESCE(%s, '-infinity'::timestamp), COALESCE(%s, -1))
+                                           ORDER BY match_due, wm_id
+                                           LIMIT %s'''
         
         # GetCompetitivePricingForASIN
-        fillQDefs['gcpfAsin']['qry'] =  '''SELECT a.asin
-                                           FROM "Products_WmAz" AS a
-                                           INNER JOIN "Timestamps_WmAz" AS b
+        fillQDefs['gcpfAsin']['qry'] =  '''SELECT b.asin, b.az_comp_price_due, a.net, a.salesrank,
+                                           EXTRACT(EPOCH FROM localtimestamp - b.az_comp_price_due)/3600,
+                                           ABS(c.price - a.wm_price)/NULLIF(a.wm_price, 0)
+                                           FROM "Timestamps_WmAz" AS b
+                                           INNER JOIN "Products_WmAz" AS a
                                            ON a.asin = b.asin
                                            INNER JOIN "Prod_Wm" AS c
                                            ON a.wm_id = c.wm_id
-                                           WHERE a.free_ship = True AND a.wm_instock = True -- AND a.salesrank1 IS NOT Null
-                                           AND EXTRACT(EPOCH FROM (localtimestamp - c.fetched)/86400) < 4
-                                           AND (b.az_comp_price IS Null OR EXTRACT(EPOCH FROM (localtimestamp - b.az_comp_price)/3600) > 42)'''
+                                           WHERE b.az_comp_price_due <= localtimestamp
+                                           AND (b.az_comp_price_due, b.asin) > (COALESCE(%s, '-infinity'::timestamp), COALESCE(%s, ''))
+                                           AND a.free_ship = True AND a.wm_instock = True -- AND a.salesrank1 IS NOT Null
+                                           AND c.fetched > localtimestamp - interval '4 days'
+                                           ORDER BY b.az_comp_price_due, b.asin
+                                           LIMIT %s'''
         
         # GetLowestOfferListingsForASIN
-        fillQDefs['glolfAsin']['qry'] = '''SELECT a.asin
-                                           FROM "Products_WmAz" AS a
-                                           INNER JOIN "Timestamps_WmAz" AS b
+        fillQDefs['glolfAsin']['qry'] = '''SELECT b.asin, b.az_lowest_offer_due, a.net, a.salesrank,
+                                           EXTRACT(EPOCH FROM localtimestamp - b.az_lowest_offer_due)/3600,
+                                           ABS(c.price - a.wm_price)/NULLIF(a.wm_price, 0)
+                                           FROM "Timestamps_WmAz" AS b
+                                           INNER JOIN "Products_WmAz" AS a
                                            ON a.asin = b.asin
                                            INNER JOIN "Prod_Wm" AS c
                                            ON a.wm_id = c.wm_id
-                                           WHERE a.free_ship = True AND a.wm_instock = True -- AND a.salesrank1 IS NOT Null
-                                           AND EXTRACT(EPOCH FROM (localtimestamp - c.fetched)/86400) < 4
-                                           AND (b.az_lowest_offer IS Null OR EXTRACT(EPOCH FROM (localtimestamp - b.az_lowest_offer)/3600) > 42)'''
+                                           WHERE b.az_lowest_offer_due <= localtimestamp
+                                           AND (b.az_lowest_offer_due, b.asin) > (COALESCE(%s, '-infinity'::timestamp), COALESCE(%s, ''))
+                                           AND a.free_ship = True AND a.wm_instock = True -- AND a.salesrank1 IS NOT Null
+                                           AND c.fetched > localtimestamp - interval '4 days'
+                                           ORDER BY b.az_lowest_offer_due, b.asin
+                                           LIMIT %s'''
         
-        # GetMyFeesEstimate
-        fillQDefs['gmfe']['qry'] =      '''SELECT a.asin
-                                           FROM "Products_WmAz" AS a
-                                           INNER JOIN "Timestamps_WmAz" AS b
+        # GetMyFeesEstimate. az_fees_due is only set while az_comp_price and az_lowest_offer are both newer than az_fees
+        fillQDefs['gmfe']['qry'] =      '''SELECT b.asin, b.az_fees_due, a.net, a.salesrank,
+                                           EXTRACT(EPOCH FROM localtimestamp - b.az_fees_due)/3600,
+                                           ABS(c.price - a.wm_price)/NULLIF(a.wm_price, 0)
+                                           FROM "Timestamps_WmAz" AS b
+                                           INNER JOIN "Products_WmAz" AS a
                                            ON a.asin = b.asin
-                                           WHERE COALESCE(a.comp_price, a.lowest_fba, a.lowest_merch) IS NOT Null
-                                           AND COALESCE(b.az_comp_price, DATE '0001-01-01') > COALESCE(b.az_fees, DATE '0001-01-02')
-                                           AND COALESCE(b.az_lowest_offer, DATE '0001-01-01') > COALESCE(b.az_fees, DATE '0001-01-02')'''
+                                           INNER JOIN "Prod_Wm" AS c
+                                           ON a.wm_id = c.wm_id
+                                           WHERE b.az_fees_due IS NOT Null
+                                           AND (b.az_fees_due, b.asin) > (COALESCE(%s, '-infinity'::timestamp), COALESCE(%s, ''))
+                                           AND COALESCE(a.comp_price, a.lowest_fba, a.lowest_merch) IS NOT Null
+                                           ORDER BY b.az_fees_due, b.asin
+                                           LIMIT %s'''
+        
+        # Bigger pages for the prioritized ops, since their queues can only be ordered within what's been fetched
+        for g in fillQDefs:
+            fillQDefs[g]['limit'] = 5000 if g in self.prioritized else 500
         
         return fillQDefs
     
+    def stream_keys(self, op, records):
+        
+        # Same filters as the gcpfAsin and glolfAsin queries: in stock with free shipping, and due for either of them,
+        # which includes every newly matched ASIN (its due times start out at the time it was matched). The rest are
+        # left to the polls, rather than repriced minutes after they last were
+        if op == 'gmpfId':
+            asins = list(dict.fromkeys(r.asin for r in records if r.wm_instock and r.free_ship))
+            if not asins:
+                return asins
+            sqlTxt = '''SELECT k.asin FROM unnest(%s::text[]) AS k(asin)
+                        LEFT JOIN "Timestamps_WmAz" AS b
+                        ON b.asin = k.asin
+                        WHERE b.asin IS Null
+                        OR b.az_comp_price_due <= localtimestamp OR b.az_lowest_offer_due <= localtimestamp'''
+            con = con_postgres()
+            rows = call_sql(con, sqlTxt, [asins], 'executeReturn', prepare=True)
+            con.close()
+            if rows is None:
+                return asins  # Pushing one too many beats leaving one to wait for the poll
+            due = {row[0] for row in rows}
+            return [asin for asin in asins if asin in due]
+        return super().stream_keys(op, records)
+    
+
+class RoutineContinuous(RoutineOGaster):
+    """
+    RoutineOGaster as a long-running scheduler instead of an hourly sweep. Every MWS stage keeps polling its next_due
+    query, so items are worked on as soon as they become due and each quota stays busy. Walmart's Routine is rerun
+    every <wmEvery> seconds, and salesrank and net are recalculated every <postEvery> seconds for just the ASINs that
+    changed (the 'post' stage).
+    Runs until <until> (a unix time, or forever if None) or stop(), and then winds down like any other Routine.
+    """
+    
+    triggers = {
+    'wm':        {'recv': {},                                                    'send': {'gmpfId':   None}},
+    'gmpfId':    {'recv': {'wm':       None},                                    'send': {'gcpfAsin': None,  'glolfAsin': None,  'post': None}},
+    'gcpfAsin':  {'recv': {'gmpfId':   None},                                    'send': {'gmfe':     None,  'post': None}},
+    'glolfAsin': {'recv': {'gmpfId':   None},                                    'send': {'gmfe':     None}},
+    'gmfe':      {'recv': {'gcpfAsin': None,  'glolfAsin': None},                'send': {'post':     None}},
+    'post':      {'recv': {'gmpfId':   None,  'gcpfAsin':  None, 'gmfe': None},  'send': {}}}
+    
+    continuous = True
+    pollEvery = 30
+    wmEvery = 3600
+    postEvery = 60
+    
+    # The columns the post stage recalculates for the ASINs pushed by each upstream stage. match_to_az and
+    # get_comp_pricing write prices and sales ranks, and get_fees_est writes my_price and fees_est
+    postColumns = {'gmpfId': ('salesrank', 'net'), 'gcpfAsin': ('salesrank', 'net'), 'gmfe': ('net',)}
+    
+    def __init__(self, until=None):
+        super().__init__()
+        self.until = until
+        self.stopping = Event()
+    
+    def stop(self):
+        self.stopping.set()
+    
+    def running(self):
+        return not self.stopping.is_set() and (self.until is None or time.time() < self.until)
+    
+    def stage_procs(self):
+        
+        procs = super().stage_procs()
+        procs['wm'] = {'func': procs['wm']['target'], 'target': self.wm_loop}
+        procs['post'] = {'func': None, 'target': self.post_proc, 'takesStreams': True}
+        return procs
+    
+    def wm_loop(self, op, func, triggs):
+        """
+        Runs Walmart's Routine (<func>) every <self.wmEvery> seconds while this Routine is running, and brings the
+        wm_data timestamps up to date for what it fetched. Once it stops, it signals its downstream stages, which is what
+        WmRoutine.routine does when it's run on its own.
+        """
+        
+        while self.running():
+            start = time.time()
+            since = datetime_floor(1.0 / 60)  # Same rounding as Prod_Wm.fetched
+            
+            func(triggs={'send': {}})
+            update_wm_data_timestamps(since)
+            
+            while self.running() and time.time() - start < self.wmEvery:
+                time.sleep(min(5, start + self.wmEvery - time.time()))
+        
+        print("{} signing off!".format(op))
+        for sendEnd in triggs['send']:
+            triggs['send'][sendEnd].send('')
+            triggs['send'][sendEnd].close()
+    
+    def post_proc(self, op, func, triggs, streamsIn):
+        """
+        Collects the ASINs pushed by the upstream stages, and every <self.postEvery> seconds recalculates the columns in
+        <self.postColumns> for them. Finishes once every upstream stage has.
+        """
+        
+        m = StageMetrics(type(self).__name__, op)
+        m.run(self.post_loop, m, streamsIn)
+    
+    def post_loop(self, m, streamsIn):
+        
+        pending = {'salesrank': set(), 'net': set()}
+        finishUps = {upOp: False for upOp in streamsIn}
+        last = time.time()
+        
+        while True:
+            for upOp, stream in streamsIn.items():
+                while True:
+                    try:
+                        keys = stream.get_nowait()
+                    except queue.Empty:
+                        break
+                    
+                    if keys is None:
+                        finishUps[upOp] = True
+                    else:
+                        for col in self.postColumns.get(upOp, ()):
+                            pending[col].update(keys)
+            
+            done = all(finishUps.values())
+            if done or time.time() - last >= self.postEvery:
+                for col in ('salesrank', 'net'):  # Every column that's pending, in the order they're calculated
+                    if pending[col]:
+                        asins = sorted(pending[col])
+                        pending[col] = set()
+                        
+                        start = time.perf_counter()
+                        with timed('parse'):
+                            calc_column(col, asins)
+                        m.record_call(len(asins), len(asins), time.perf_counter() - start)
+                
+                m.flush(lambda: {'queue_depth': sum(len(p) for p in pending.values())}, force=done)
+                last = time.time()
+                if done:
+                    print("post signing off!")
+                    break
+            
+            with timed('idle'):
+                time.sleep(1)
+
 
 class RoutineDisplay1(Routine):
     """
@@ -440,7 +1065,7 @@ class RoutineManually(Routine):
         startTs = datetime.datetime.now()
         
         fillQDefs = {theProc: {} for theProc in ('gmpfId', 'gcpfAsin', 'glolfAsin', 'gmfe')}
-        wmIdsSQLList = make_sql_list(tuple(t[0] for t in self.wmIds), 'int')
+        wmIds = [t[0] for t in self.wmIds]
     
         # GetMatchingProductsForID
         fillQDefs['gmpfId']['qry'] = self.wmIds
@@ -450,31 +1075,31 @@ class RoutineManually(Routine):
                                            FROM "Products_WmAz" AS a
                                            INNER JOIN "Timestamps_WmAz" AS b
                                            ON a.asin = b.asin
-                                           WHERE a.wm_id IN {}
+                                           WHERE a.wm_id = ANY(%s)
                                            AND COALESCE(b.match_to_az, DATE '0001-01-01') >= %s
-                                           AND (b.az_comp_price IS Null OR b.az_comp_price < %s)'''.format(wmIdsSQLList)
+                                           AND (b.az_comp_price IS Null OR b.az_comp_price < %s)'''
         
         # GetLowestOfferListingsForASIN
         fillQDefs['glolfAsin']['qry'] = '''SELECT a.asin
                                            FROM "Products_WmAz" AS a
                                            INNER JOIN "Timestamps_WmAz" AS b
                                            ON a.asin = b.asin
-                                           WHERE a.wm_id IN {}
+                                           WHERE a.wm_id = ANY(%s)
                                            AND COALESCE(b.match_to_az, DATE '0001-01-01') >= %s
-                                           AND (b.az_lowest_offer IS Null OR b.az_lowest_offer < %s)'''.format(wmIdsSQLList)
+                                           AND (b.az_lowest_offer IS Null OR b.az_lowest_offer < %s)'''
         
         # GetMyFeesEstimate
         fillQDefs['gmfe']['qry'] =      '''SELECT a.asin
                                            FROM "Products_WmAz" AS a
                                            INNER JOIN "Timestamps_WmAz" AS b
                                            ON a.asin = b.asin
-                                           WHERE a.wm_id IN {}
+                                           WHERE a.wm_id = ANY(%s)
                                            AND b.az_comp_price > %s
                                            AND b.az_lowest_offer > %s
-                                           AND (b.az_fees IS Null OR b.az_fees < %s)'''.format(wmIdsSQLList)
+                                           AND (b.az_fees IS Null OR b.az_fees < %s)'''
         
-        fillQDefs['gcpfAsin']['args'] = [startTs, startTs]
-        fillQDefs['glolfAsin']['args'] = [startTs, startTs]                                  
-        fillQDefs['gmfe']['args'] = [startTs, startTs, startTs]
+        fillQDefs['gcpfAsin']['args'] = [wmIds, startTs, startTs]
+        fillQDefs['glolfAsin']['args'] = [wmIds, startTs, startTs]                                  
+        fillQDefs['gmfe']['args'] = [wmIds, startTs, startTs, startTs]
         
         return fillQDefs
@@ -0,0 +1,204 @@
+"""
+Columns, tables and indexes that the Routine queues rely on, added to the existing database.
+ensure_schema() only adds what's missing, so it's run at the start of every Routine.
+
+It also sets up the materialized views in <managedViews> for refresh_view(): each gets the unique index that
+REFRESH ... CONCURRENTLY needs, and every table it reads from gets a trigger that marks it stale in "ViewRefresh" when
+the table changes, so a view is only refreshed when there's something new in it.
+"""
+
+from AmazonSelling.tools import call_sql, con_postgres, dueAfter, matchDueAfter
+
+
+# (table, column, column definition, the UPDATE that fills in the column for existing rows when it's first added)
+# A new row is due right away, hence DEFAULT localtimestamp. az_fees_due is Null when fees aren't due.
+dueColumns = (
+    ('Prod_Wm', 'match_due', 'timestamp NOT NULL DEFAULT localtimestamp',
+     '''UPDATE "Prod_Wm" SET match_due = last_matched + interval '{} seconds'
+        WHERE last_matched IS NOT Null'''.format(int(matchDueAfter.total_seconds()))),
+    ('Timestamps_WmAz', 'az_comp_price_due', 'timestamp NOT NULL DEFAULT localtimestamp',
+     '''UPDATE "Timestamps_WmAz" SET az_comp_price_due = az_comp_price + interval '{} seconds'
+        WHERE az_comp_price IS NOT Null'''.format(int(dueAfter['az_comp_price'].total_seconds()))),
+    ('Timestamps_WmAz', 'az_lowest_offer_due', 'timestamp NOT NULL DEFAULT localtimestamp',
+     '''UPDATE "Timestamps_WmAz" SET az_lowest_offer_due = az_lowest_offer + interval '{} seconds'
+        WHERE az_lowest_offer IS NOT Null'''.format(int(dueAfter['az_lowest_offer'].total_seconds()))),
+    ('Timestamps_WmAz', 'az_fees_due', 'timestamp',
+     '''UPDATE "Timestamps_WmAz" SET az_fees_due = GREATEST(az_comp_price, az_lowest_offer)
+        WHERE az_comp_price > COALESCE(az_fees, '-infinity') AND az_lowest_offer > COALESCE(az_fees, '-infinity')'''))
+
+# "Jobs" is for AmazonSelling.jobqueue. state is 'ready', 'leased' (to <worker>, until <lease_until>), 'done'
+# or 'failed' (after <attempts> reached the queue's maxAttempts)
+# "MwsQuota" is for throttle.PgTokenBucket: the tokens left in each MWS quota as of <stamp>
+# "ViewRefresh" is for refresh_view: whether each of the managedViews has changed since <refreshed>
+newTables = (
+    '''CREATE TABLE IF NOT EXISTS "Jobs" (
+           queue text NOT NULL,
+           key text NOT NULL,
+           state text NOT NULL DEFAULT 'ready',
+           priority double precision NOT NULL DEFAULT 0,
+           enqueued timestamp NOT NULL DEFAULT localtimestamp,
+           lease_until timestamp,
+           worker text,
+           attempts integer NOT NULL DEFAULT 0,
+           finished timestamp,
+           PRIMARY KEY (queue, key))''',
+    '''CREATE INDEX IF NOT EXISTS jobs_claimable ON "Jobs" (queue, priority DESC, enqueued)
+       WHERE state <> 'done' ''',
+    '''CREATE TABLE IF NOT EXISTS "MwsQuota" (
+           quota text PRIMARY KEY,
+           tokens double precision NOT NULL,
+           stamp timestamptz NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS "ViewRefresh" (
+           view text PRIMARY KEY,
+           stale boolean NOT NULL DEFAULT True,
+           refreshed timestamp)''',
+    # The views to mark are the trigger's arguments. "AND NOT stale" keeps it from locking the row (and so from making
+    # busy tables' writers wait on each other) once the view is already stale
+    '''CREATE OR REPLACE FUNCTION view_sources_changed() RETURNS trigger AS $$
+           BEGIN
+               UPDATE "ViewRefresh" SET stale = True WHERE view = ANY(TG_ARGV) AND NOT stale;
+               RETURN Null;
+           END
+       $$ LANGUAGE plpgsql''')
+
+# For throttle.PgTokenBucket.feedback: the restore rate as adjusted (Null until it has been), and the rate the hourly
+# quota allows until <hour_until>. There's nothing to fill in for existing rows
+quotaColumns = (
+    ('MwsQuota', 'rate', 'double precision', None),
+    ('MwsQuota', 'hour_rate', 'double precision', None),
+    ('MwsQuota', 'hour_until', 'timestamptz', None))
+
+# The WHERE clauses match the queue queries in RoutineOGaster.get_query_defs, so the planner can use them
+dueIndexes = (
+    '''CREATE INDEX IF NOT EXISTS prod_wm_match_due ON "Prod_Wm" (match_due, wm_id)
+       WHERE upc IS NOT Null AND dup IS False''',
+    '''CREATE INDEX IF NOT EXISTS timestamps_wmaz_comp_price_due ON "Timestamps_WmAz" (az_comp_price_due, asin)''',
+    '''CREATE INDEX IF NOT EXISTS timestamps_wmaz_lowest_offer_due ON "Timestamps_WmAz" (az_lowest_offer_due, asin)''',
+    '''CREATE INDEX IF NOT EXISTS timestamps_wmaz_fees_due ON "Timestamps_WmAz" (az_fees_due, asin)
+       WHERE az_fees_due IS NOT Null''')
+
+# (materialized view, the columns that are unique in it). The views themselves are defined in the database, not here.
+# If a view's columns don't turn out to be unique, its index can't be made, and it's refreshed the old, blocking way
+managedViews = (
+    ('public."Display1"', ('asin',)),
+    ('public."Already"', ('sku',)),
+    ('io."Enroute"', ('purchase_id',)),
+    ('io."In_Stock"', ('purchase_id',)))
+
+# The tables (not views) that a view reads from, following any views it reads from down to their tables
+viewSourcesSql = '''WITH RECURSIVE deps(oid) AS (
+                          SELECT %s::regclass::oid
+                          UNION
+                          SELECT d.refobjid
+                          FROM deps
+                          JOIN pg_rewrite AS r ON r.ev_class = deps.oid
+                          JOIN pg_depend AS d ON d.classid = 'pg_rewrite'::regclass AND d.objid = r.oid
+                                              AND d.refclassid = 'pg_class'::regclass AND d.refobjid <> deps.oid)
+                      SELECT c.oid::regclass::text, EXISTS (SELECT 1 FROM pg_trigger AS t
+                                                            WHERE t.tgrelid = c.oid AND t.tgname = %s)
+                      FROM deps
+                      JOIN pg_class AS c ON c.oid = deps.oid
+                      WHERE c.relkind IN ('r', 'p')'''
+
+
+def ensure_schema():
+    """
+    Adds any of the next_due columns (filling them in from the existing timestamps), tables and indexes that are missing
+    """
+
+    con = con_postgres()
+
+    for sqlTxt in newTables:
+        call_sql(con, sqlTxt, [], 'executeNoReturn')
+
+    for tbl, col, colDef, backfill in dueColumns + quotaColumns:
+        exists = call_sql(con, '''SELECT 1 FROM information_schema.columns
+                                  WHERE table_name = %s AND column_name = %s''', [tbl, col], 'executeReturn')
+        if not exists:
+            print('ensure_schema: adding {}.{}'.format(tbl, col))
+            call_sql(con, 'ALTER TABLE "{}" ADD COLUMN IF NOT EXISTS {} {}'.format(tbl, col, colDef), [],
+                     'executeNoReturn')
+            if backfill:
+                call_sql(con, backfill, [], 'executeNoReturn')
+
+    for sqlTxt in dueIndexes:
+        call_sql(con, sqlTxt, [], 'executeNoReturn')
+
+    for view, keyCols in managedViews:
+        ensure_view(con, view, keyCols)
+
+    con.close()
+
+
+def view_names(view):
+    """
+    Returns the names of the unique index and the triggers that ensure_view makes for <view>
+    """
+
+    bare = view.split('.')[-1].strip('"').lower()
+    return '{}_refresh_key'.format(bare), 'stale_{}'.format(bare)
+
+
+def ensure_view(con, view, keyCols):
+    """
+    Gives materialized view <view> a unique index on <keyCols>, a row in "ViewRefresh", and a trigger on each of the
+    tables it reads from. Does nothing if the view doesn't exist.
+    """
+
+    rows = call_sql(con, 'SELECT to_regclass(%s)', [view], 'executeReturn')
+    if not rows or rows[0][0] is None:
+        return
+
+    idxName, trigName = view_names(view)
+    call_sql(con, 'CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})'.format(idxName, view, ', '.join(keyCols)), [],
+             'executeNoReturn')
+    call_sql(con, '''INSERT INTO "ViewRefresh" (view) VALUES (%s) ON CONFLICT (view) DO NOTHING''', [view],
+             'executeNoReturn')
+
+    # Creating a trigger locks the table against writes, so it's only done for tables that don't have one yet
+    for tbl, hasTrigger in call_sql(con, viewSourcesSql, [view, trigName], 'executeReturn') or []:
+        if not hasTrigger:
+            print('ensure_schema: marking {} stale on changes to {}'.format(view, tbl))
+            call_sql(con, '''CREATE TRIGGER {} AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {}
+                              FOR EACH STATEMENT EXECUTE PROCEDURE view_sources_changed(%s)'''.format(trigName, tbl),
+                     [view], 'executeNoReturn')
+
+
+def refresh_view(view, force=False):
+    """
+    Refreshes materialized view <view> (one of managedViews), unless none of the tables it reads from have changed
+    since the last time (or <force>). Once the view has its unique index and has been filled, it's refreshed
+    CONCURRENTLY, so anything reading it, like the Display Data workbook, isn't blocked while it is.
+    Returns True if it was refreshed.
+    """
+
+    con = con_postgres()
+
+    rows = call_sql(con, 'SELECT stale FROM "ViewRefresh" WHERE view = %s', [view], 'executeReturn')
+    if not rows:
+        ensure_schema()  # New view, or new database
+    elif not rows[0][0] and not force:
+        con.close()
+        return False
+
+    # Cleared before the refresh starts, so that anything changed while it's running gets the view marked stale again
+    call_sql(con, '''UPDATE "ViewRefresh" SET stale = False, refreshed = localtimestamp WHERE view = %s''', [view],
+             'executeNoReturn')
+
+    rows = call_sql(con, '''SELECT c.relispopulated AND EXISTS (SELECT 1 FROM pg_index AS i
+                                                             WHERE i.indrelid = c.oid AND i.indisunique AND i.indisvalid
+                                                             AND i.indpred IS Null AND i.indexprs IS Null)
+                             FROM pg_class AS c
+                             WHERE c.oid = %s::regclass''', [view], 'executeReturn')
+    concurrently = bool(rows and rows[0][0])
+
+    # The SELECT is there so call_sql says whether the refresh worked
+    done = call_sql(con, 'REFRESH MATERIALIZED VIEW {}{}; SELECT True'.format('CONCURRENTLY ' if concurrently else '',
+                                                                             view), [], 'executeReturn')
+    if done:
+        con.commit()
+    else:
+        call_sql(con, '''UPDATE "ViewRefresh" SET stale = True WHERE view = %s''', [view], 'executeNoReturn')
+
+    con.close()
+    return bool(done)
@@ -0,0 +1,400 @@
+"""
+Runs a Routine's <triggers> graph in virtual time, with the MWS calls and SQL replaced by models, to see how long a
+cycle would take, how much of each quota it would use, and where each stage's time would go, without running it live.
+
+The stages follow the same rules as Routine.mws_proc: the same call sizes (<throt>), queue classes and priorities,
+paged fill_q queries, hand-offs over streams (including the joins where a stage has more than one upstream stage), and
+the same idle gaps. Each op's quota is a throttle.TokenBucket on the virtual clock, with the Routine's <rateCeiling>,
+so its feedback from throttled requests plays out as it would live. A second TokenBucket at the real restore rate
+stands in for MWS, and throttles a request when the Routine's bucket has let it through too soon.
+
+A call takes the time in its stage's CallModel, which can be seeded from the metrics snapshots of a live run (see
+AmazonSelling.metrics). The results are kept in a StageMetrics per stage, so they can be compared with the live ones.
+Stages that aren't MWS ops (Walmart's Routine, the post stage) take their model's time once, for all their items.
+Hourly quotas aren't modelled, and a continuous Routine is simulated as a single sweep.
+"""
+
+import heapq
+import math
+import queue
+import random
+import sys
+
+from AmazonSelling.metrics import StageMetrics, load_snapshots, metricsDir
+from AmazonSelling.routine import RoutineOGaster, PriorityWorkQueue
+from AmazonSelling.throttle import TokenBucket
+from AmazonSelling.tools import WorkQueue
+
+
+class CallModel:
+    """
+    How long a call of a stage's mwsutils function takes: <apiSecs> for the MWS request, plus <itemSecs> for each item
+    for parsing and SQL. Each part is scaled by its own lognormal factor, with sigma <jitter>.
+    """
+
+    def __init__(self, apiSecs=0.5, itemSecs=0.01, jitter=0.25):
+
+        self.apiSecs = apiSecs
+        self.itemSecs = itemSecs
+        self.jitter = jitter
+
+    @classmethod
+    def from_snapshot(cls, snap, jitter=0.25):
+        """
+        The model for a stage's metrics snapshot <snap>: its mean 'api' time per call, and its 'parse' and 'sql' time
+        per item
+        """
+
+        calls = snap['counters']['calls']
+        if not calls:
+            return cls(jitter=jitter)
+        secs = snap['seconds']
+        return cls(secs['api'] / calls, (secs['parse'] + secs['sql']) / max(snap['counters']['items'], 1), jitter)
+
+    def api_time(self, rng):
+
+        return self.apiSecs * rng.lognormvariate(0, self.jitter)
+
+    def item_time(self, n, rng):
+
+        return self.itemSecs * n * rng.lognormvariate(0, self.jitter)
+
+
+def models_from_metrics(routineName, theDir=metricsDir, jitter=0.25):
+    """
+    Returns {stage: CallModel} from the latest metrics snapshots of Routine <routineName> (a class name) in <theDir>
+    """
+
+    return {snap['stage']: CallModel.from_snapshot(snap, jitter) for snap in load_snapshots(theDir)
+            if snap['routine'] == routineName}
+
+
+class Workload:
+    """
+    What a simulated Routine has to get through: <backlog> is {op: the number of items due when it starts}, and
+    <passRate> is {op: the share of its items an op pushes downstream}. For gmpfId, that's the matches that are in stock
+    with free shipping (see RoutineOGaster.stream_keys), which then count as new ASINs downstream.
+    The ASIN ops' backlogs are drawn from the same ASINs, so an ASIN due for gcpfAsin is also due for glolfAsin, and
+    gmfe's join works the way it does live. Rows have the columns RoutineOGaster's queries return, with made-up
+    priorities, so prioritized ops order them by priority_score.
+    """
+
+    def __init__(self, backlog, passRate=None, seed=0):
+
+        self.backlog = backlog
+        self.passRate = passRate or {'gmpfId': 0.3}
+        self.seed = seed
+
+    def rows(self, op):
+        """
+        Returns <op>'s backlog as query rows, in the order its query would return them (most overdue first)
+        """
+
+        rng = random.Random('{}.{}'.format(self.seed, op))
+        theRows = []
+        for i in range(self.backlog.get(op, 0)):
+            key = i if op == 'gmpfId' else 'B{:09d}'.format(i)
+            overdue = rng.expovariate(1 / 24.0)  # Hours
+            theRows.append((key, -overdue, rng.gauss(2.0, 4.0), rng.random(), overdue, rng.expovariate(1 / 0.05)))
+        theRows.sort(key=lambda row: row[1])
+        return theRows
+
+    def stream_keys(self, op, keys, rng):
+        """
+        The keys <op> pushes downstream after a call on <keys>
+        """
+
+        rate = self.passRate.get(op, 1.0)
+        if op == 'gmpfId':
+            return ['N{:09d}'.format(k) for k in keys if rng.random() < rate]
+        return [k for k in keys if rate >= 1.0 or rng.random() < rate]
+
+
+class Simulator:
+    """
+    Simulates one run of <routine> (a Routine instance) through <workload>. <models> is {op: CallModel}. MWS ops that
+    aren't in it get the default CallModel, and other stages take no time. <mwsRates> is {op: the restore rate MWS
+    really allows}, if it isn't the one in <routine.throt>. Each fill_q query takes <fillSecs>.
+    Settings that are being compared, like <prioritized>, <longTailShare> or <rateCeiling>, are read from <routine>,
+    so set them on the instance before running it.
+    """
+
+    def __init__(self, routine, workload, models=None, mwsRates=None, fillSecs=0.5, seed=0):
+
+        self.routine = routine
+        self.workload = workload
+        self.models = models or {}
+        self.mwsRates = mwsRates or {}
+        self.fillSecs = fillSecs
+        self.rng = random.Random(seed)
+
+        self.now = 0.0
+        self.done = {}  # {op: True} once a stage has signed off
+        self.metrics = {}
+        self.buckets = {}
+        self.waits = {}  # {op: [(seconds from when an item was due or pushed to when its call finished, its score)]}
+        self.ends = {}
+
+    def clock(self):
+
+        return self.now
+
+    def run(self):
+        """
+        Runs the simulation to the end, and returns the results (see results)
+        """
+
+        r = self.routine
+        triggers = r.triggers
+        qDefs = r.get_query_defs()
+        isMws = {op: op in r.throt for op in triggers}
+
+        # The same streams as Routine.routine. Stages that aren't MWS ops take them if they have MWS stages upstream,
+        # which is what the post stage does
+        takesStreams = {op: isMws[op] or any(isMws[up] for up in triggers[op]['recv']) for op in triggers}
+        streams = {(op, sendEnd): queue.Queue() for op in triggers for sendEnd in triggers[op]['send']
+                   if isMws[op] and takesStreams[sendEnd]}
+
+        events = []  # (time, seq, op, stage generator)
+        for seq, op in enumerate(triggers):
+            self.metrics[op] = StageMetrics('sim.{}'.format(type(r).__name__), op)
+            streamsIn = {up: streams[(up, down)] for up, down in streams if down == op}
+            streamsOut = {down: streams[(up, down)] for up, down in streams if up == op}
+            if isMws[op]:
+                self.buckets[op] = TokenBucket(r.throt[op]['maxreqquota'], r.throt[op]['restorerate'], self.clock,
+                                               ceiling=r.rateCeiling)
+                gen = self.mws_stage(op, qDefs[op], streamsIn, streamsOut)
+            else:
+                gen = self.other_stage(op, streamsIn)
+            events.append((0.0, seq, op, gen))
+        heapq.heapify(events)
+
+        seq = len(events)
+        while events:
+            self.now, _, op, gen = heapq.heappop(events)
+            try:
+                phase, secs = next(gen)
+            except StopIteration:
+                self.done[op] = True
+                self.ends[op] = self.now
+                continue
+            self.metrics[op].add_time(phase, secs)
+            seq += 1
+            heapq.heappush(events, (self.now + secs, seq, op, gen))
+
+        return self.results()
+
+    def mws_stage(self, op, qDef, streamsIn, streamsOut):
+        """
+        Routine.mws_proc, as a generator that yields (phase, seconds) for each thing it spends time on
+        """
+
+        r = self.routine
+        throt = r.throt[op]
+        model = self.models.get(op) or CallModel()
+        m = self.metrics[op]
+        bucket = self.buckets[op]
+        mws = TokenBucket(throt['maxreqquota'], self.mwsRates.get(op, throt['restorerate']), self.clock)
+        recvs = r.triggers[op]['recv']
+
+        q = PriorityWorkQueue(r.priority_score, r.longTailShare) if op in r.prioritized else WorkQueue()
+        isQry = type(qDef['qry']) is str
+        backlog = self.workload.rows(op) if isQry else list(qDef['qry'])
+        limit = qDef.get('limit', len(backlog)) if isQry else 0
+        available = {}  # {key: when it was due, which for the backlog is the start}
+        scores = {}
+
+        finishUps = {up: False for up in (recvs if isQry else streamsIn)}
+        polls = isQry and (r.continuous or any(up not in streamsIn for up in recvs))
+        qGap = 8 if polls and not streamsIn else 0.25
+        joins = {}
+        swept = not isQry
+        lastFill = 0.0
+        self.waits[op] = []
+
+        page = backlog[:limit] if isQry else backlog
+        q.extend(page)
+        pos = len(page)  # How far through <backlog> the fills have got
+        more = len(page) == limit > 0
+        for row in page:
+            available[WorkQueue.key(row)] = 0.0
+            scores[WorkQueue.key(row)] = r.priority_score(row)
+        if isQry:
+            yield 'sql', self.fillSecs
+
+        while True:
+            prev = self.now
+
+            for key in r.recv_streams(streamsIn, joins, finishUps):
+                if key not in q:
+                    q.extend([(key,)])
+                    available[key] = self.now
+                    scores[key] = math.inf
+            for up in recvs:
+                if up not in streamsIn and self.done.get(up):
+                    finishUps[up] = True
+
+            finished = all(finishUps.values())
+
+            if len(q) < throt['maxpercall']:
+                if more or (finished and not swept) or (polls and self.now - lastFill >= r.pollEvery):
+                    page = backlog[pos:pos + limit]
+                    q.extend(page)
+                    for row in page:
+                        available.setdefault(WorkQueue.key(row), 0.0)
+                        scores.setdefault(WorkQueue.key(row), r.priority_score(row))
+                    pos += len(page)
+                    more = len(page) == limit > 0
+                    swept = finished and not more
+                    yield 'sql', self.fillSecs
+                    lastFill = self.now
+
+                if finished and len(q) == 0:
+                    for sendEnd in streamsOut:
+                        streamsOut[sendEnd].put(None)
+                    return
+
+            if len(q) >= (1 - finished) * throt['minpercall'] and len(q) > 0:
+                num = min(len(q), throt['maxpercall'])
+                keys = [WorkQueue.key(elem) for elem in q.pop_many(num)]
+
+                yield from self.take(bucket, num)
+                m.count('quota_tokens', num)
+                start = self.now
+
+                # MWS throttles the request if its own bucket is short, and then it's retried once the Routine's
+                # bucket has the tokens again, as QuotaMWSConnection does
+                while not mws.try_take(num):
+                    m.count('throttled')
+                    bucket.feedback(throttled=True)
+                    yield 'api', model.api_time(self.rng)
+                    yield from self.take(bucket, num)
+                    m.count('quota_tokens', num)
+                bucket.feedback()
+
+                yield 'api', model.api_time(self.rng)
+                yield 'parse', model.item_time(num, self.rng)
+
+                m.record_call(num, num, self.now - start)
+                self.waits[op] += [(self.now - available.pop(k), scores.pop(k)) for k in keys]
+
+                if streamsOut:
+                    pushed = self.workload.stream_keys(op, keys, self.rng)
+                    if pushed:
+                        for sendEnd in streamsOut:
+                            streamsOut[sendEnd].put(pushed)
+            elif prev + qGap > self.now:
+                yield 'idle', prev + qGap - self.now
+
+    @staticmethod
+    def take(bucket, num):
+        """
+        Waits (in virtual time) until <num> tokens can be taken from <bucket>, and takes them
+        """
+
+        while not bucket.try_take(num):
+            # The wait can come out too small to move the clock on at all, from rounding in the bucket's refill
+            yield 'quota', max(bucket.wait_time(num), 1e-6)
+
+    def other_stage(self, op, streamsIn):
+        """
+        A stage that isn't an MWS op: waits for its upstream stages, then takes its model's time for every item it was
+        sent (or just its 'api' time, if it isn't sent any)
+        """
+
+        model = self.models.get(op) or CallModel(0.0, 0.0, 0.0)
+        recvs = self.routine.triggers[op]['recv']
+        finishUps = {up: False for up in recvs}
+        numItems = 0
+
+        # Like RoutineContinuous.post_loop, every stream's items count, whether or not the other streams have sent them
+        while True:
+            for up, stream in streamsIn.items():
+                while True:
+                    try:
+                        keys = stream.get_nowait()
+                    except queue.Empty:
+                        break
+                    if keys is None:
+                        finishUps[up] = True
+                    else:
+                        numItems += len(keys)
+            for up in recvs:
+                if up not in streamsIn and self.done.get(up):
+                    finishUps[up] = True
+            if all(finishUps.values()):
+                break
+            yield 'idle', 1.0
+
+        start = self.now
+        yield 'api', model.api_time(self.rng)
+        yield 'parse', model.item_time(numItems, self.rng)
+        self.metrics[op].record_call(numItems, numItems, self.now - start)
+
+    def results(self):
+        """
+        Returns {'cycleSecs': how long until the last stage signed off, 'concurrency': how many stages were busy on
+        average, 'stages': {op: the stage's StageMetrics snapshot, plus its 'end', its 'quotaUse' (tokens taken, as a
+        share of what its quota allowed over the cycle), and the mean seconds items waited in its queue, overall
+        ('meanWait') and for the top tenth by priority_score ('topWait')}}
+        """
+
+        cycleSecs = max(self.ends.values()) if self.ends else 0.0
+        stages = {}
+        busy = 0.0
+        for op, m in self.metrics.items():
+            snap = m.snapshot()
+            snap['end'] = self.ends.get(op, cycleSecs)
+            busy += sum(snap['seconds'][phase] for phase in ('api', 'parse', 'sql'))
+
+            if op in self.buckets:
+                throt = self.routine.throt[op]
+                allowed = throt['maxreqquota'] + float(self.mwsRates.get(op, throt['restorerate'])) * cycleSecs
+                snap['quotaUse'] = snap['counters']['quota_tokens'] / allowed
+
+            waits = self.waits.get(op, [])
+            snap['meanWait'] = sum(w for w, _ in waits) / len(waits) if waits else None
+            scored = sorted((g for g in waits if g[1] != math.inf), key=lambda g: g[1], reverse=True)
+            top = scored[:max(1, len(scored) // 10)] if scored else []
+            snap['topWait'] = sum(w for w, _ in top) / len(top) if top else None
+            stages[op] = snap
+
+        return {'cycleSecs': cycleSecs, 'concurrency': busy / cycleSecs if cycleSecs else 0.0, 'stages': stages}
+
+    @staticmethod
+    def print_results(res):
+
+        print('Cycle: {:.0f}s ({:.2f}h), {:.2f} stages busy on average'.format(res['cycleSecs'], res['cycleSecs'] / 3600,
+                                                                              res['concurrency']))
+        for op, snap in res['stages'].items():
+            secs = snap['seconds']
+            print('{:10} ends {:8.0f}s | {:6} calls {:7} items {:5} throttled | quota use {} | wait {} top {} | '
+                  'quota {:.0f}s api {:.0f}s parse {:.0f}s sql {:.0f}s idle {:.0f}s'.format(
+                      op, snap['end'], snap['counters']['calls'], snap['counters']['items'],
+                      snap['counters']['throttled'],
+                      '{:.0%}'.format(snap['quotaUse']) if 'quotaUse' in snap else '-',
+                      '{:.0f}s'.format(snap['meanWait']) if snap['meanWait'] is not None else '-',
+                      '{:.0f}s'.format(snap['topWait']) if snap['topWait'] is not None else '-',
+                      secs['quota'], secs['api'], secs['parse'], secs['sql'], secs['idle']))
+
+
+def simulate(routine, workload, models=None, **kwargs):
+    """
+    Runs a Simulator, prints its results and returns them. If <models> is None, they're seeded from the metrics
+    snapshots of <routine>'s last live run.
+    """
+
+    if models is None:
+        models = models_from_metrics(type(routine).__name__)
+    res = Simulator(routine, workload, models, **kwargs).run()
+    Simulator.print_results(res)
+    return res
+
+
+if __name__ == '__main__':
+
+    # python -m AmazonSelling.simulator [number of matched ASINs due]
+    numAsins = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    theRoutine = RoutineOGaster()
+    simulate(theRoutine, Workload({'gmpfId': numAsins // 10, 'gcpfAsin': numAsins, 'glolfAsin': numAsins,
+                                   'gmfe': numAsins}))
@@ -0,0 +1,316 @@
+import asyncio
+import math
+import time
+from multiprocessing import Value, Lock
+
+from AmazonSelling.tools import call_sql, con_postgres
+
+
+def restore_time(deficit, rate, capRate=math.inf, capSecs=0.0):
+    """
+    Returns how many seconds it takes to restore <deficit> tokens at <rate> tokens/sec, when the rate is held to
+    <capRate> for the first <capSecs> seconds (by an hourly quota)
+    """
+
+    if deficit <= 0:
+        return 0.0
+    slowRate = min(rate, capRate)
+    if capSecs > 0 and slowRate < rate:
+        if slowRate * capSecs >= deficit:
+            return deficit / slowRate
+        return capSecs + (deficit - slowRate * capSecs) / rate
+    return deficit / rate
+
+
+class TokenBucket:
+    """
+    A token bucket for one MWS throttle: holds up to <capacity> tokens (maxreqquota), restored continuously at <rate>
+    tokens per second (restorerate). Tokens are fractional, so restore rates like 0.2/sec aren't lost to rounding.
+    The token count and its timestamp are in shared memory behind a multiprocessing Lock, so one bucket can be passed
+    to several Routine processes and they'll all draw from the same quota.
+    <clock> must be the same across processes, which time.monotonic is (it's system-wide on Windows and Linux).
+
+    The restore rate adjusts itself from what MWS says after each request, through feedback(): it's cut by <backoff>
+    each time a request is throttled (down to <floor> times <rate>), and creeps back up by <recovery> times <rate> after
+    each one that isn't (up to <ceiling> times <rate>, so a rate that was guessed too low gets found out). Operations
+    with an hourly quota also report how much of it is left, and the rate is held to what will make it last the hour.
+    """
+
+    def __init__(self, capacity, rate, clock=time.monotonic, ceiling=1.0, floor=0.1, backoff=0.5, recovery=0.05):
+
+        self.capacity = float(capacity)
+        self.set_limits(rate, ceiling, floor, backoff, recovery)
+        self.clock = clock
+        self.lock = Lock()
+        self.tokens = Value('d', self.capacity, lock=False)
+        self.stamp = Value('d', clock(), lock=False)
+        self.rateNow = Value('d', self.nominalRate, lock=False)
+        self.hourRate = Value('d', math.inf, lock=False)  # The rate allowed by the hourly quota, until <hourUntil>
+        self.hourUntil = Value('d', -math.inf, lock=False)
+
+    def set_limits(self, rate, ceiling, floor, backoff, recovery):
+
+        self.nominalRate = float(rate)
+        self.maxRate = self.nominalRate * ceiling
+        self.minRate = self.nominalRate * floor
+        self.backoff = backoff
+        self.step = self.nominalRate * recovery
+
+    @property
+    def rate(self):
+        """
+        The restore rate right now, in tokens per second
+        """
+
+        if self.clock() < self.hourUntil.value:
+            return min(self.rateNow.value, self.hourRate.value)
+        return self.rateNow.value
+
+    def refill(self):
+        """
+        Brings <self.tokens> up to date with the clock. Must be called with <self.lock> held
+        """
+
+        now = self.clock()
+        if now > self.stamp.value:
+            capped = max(min(now, self.hourUntil.value) - self.stamp.value, 0.0)  # Time spent under the hourly cap
+            gained = (capped * min(self.rateNow.value, self.hourRate.value) +
+                      (now - self.stamp.value - capped) * self.rateNow.value)
+            self.tokens.value = min(self.capacity, self.tokens.value + gained)
+            self.stamp.value = now
+
+    def check_n(self, n):
+
+        if n > self.capacity:
+            raise ValueError('Can never take {} tokens from a TokenBucket with a capacity of {}'.format(n, self.capacity))
+
+    def seconds_for(self, n):
+        """
+        Returns how many seconds until <n> tokens will be available. Must be called with <self.lock> held, after refill
+        """
+
+        return restore_time(n - self.tokens.value, self.rateNow.value, self.hourRate.value,
+                            self.hourUntil.value - self.stamp.value)
+
+    def available(self):
+        """
+        Returns the number of tokens in the bucket right now
+        """
+
+        with self.lock:
+            self.refill()
+            return self.tokens.value
+
+    def wait_time(self, n=1):
+        """
+        Returns how many seconds until <n> tokens will be available (0 if they already are)
+        """
+
+        self.check_n(n)
+        with self.lock:
+            self.refill()
+            return self.seconds_for(n)
+
+    def try_take(self, n=1):
+        """
+        Takes <n> tokens and returns True if they're available, else takes nothing and returns False
+        """
+
+        self.check_n(n)
+        with self.lock:
+            self.refill()
+            if self.tokens.value >= n:
+                self.tokens.value -= n
+                return True
+            return False
+
+    def take(self, n=1, sleep=time.sleep):
+        """
+        Takes <n> tokens, sleeping exactly as long as it takes for them to be restored if they aren't available yet.
+        Returns the number of seconds spent waiting.
+        """
+
+        self.check_n(n)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens.value >= n:
+                    self.tokens.value -= n
+                    return waited
+                wait = self.seconds_for(n)
+
+            # Another process may take the tokens first, in which case this just goes round again
+            sleep(wait)
+            waited += wait
+
+    async def take_async(self, n=1):
+        """
+        Like take(), but awaits instead of sleeping, for the asyncio Routine mode
+        """
+
+        self.check_n(n)
+        waited = 0.0
+        while not self.try_take(n):
+            wait = self.wait_time(n)
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
+
+    def feedback(self, throttled=False, remaining=None, resetsOn=None):
+        """
+        Adjusts the bucket after an MWS request. <throttled> is True if MWS said RequestThrottled, in which case its
+        bucket is empty, whatever this one thinks. <remaining> and <resetsOn> (a unix time) are from the
+        x-mws-quota-remaining and x-mws-quota-resetsOn headers, for operations with an hourly quota.
+        """
+
+        with self.lock:
+            self.refill()
+            if throttled:
+                self.tokens.value = 0.0
+                self.rateNow.value = max(self.minRate, self.rateNow.value * self.backoff)
+            else:
+                self.rateNow.value = min(self.maxRate, self.rateNow.value + self.step)
+
+            if remaining is not None and resetsOn is not None:
+                secsLeft = resetsOn - time.time()
+                if secsLeft > 0:
+                    self.hourRate.value = max(remaining, 0) / secsLeft
+                    self.hourUntil.value = self.stamp.value + secsLeft
+
+
+class PgTokenBucket(TokenBucket):
+    """
+    A TokenBucket kept in a row of the "MwsQuota" table (see AmazonSelling.schema), named <name>, instead of in shared
+    memory. MWS quotas are per seller account, so this is what lets Routines in separate process trees, or on separate
+    hosts, draw from the same quota: each take is a single UPDATE of the row, which Postgres serializes, and the time
+    comes from the database server's clock, so the hosts' clocks don't have to agree.
+    The adjusted restore rate and the hourly quota are in the row too, so feedback from any Routine applies to all.
+    """
+
+    def __init__(self, name, capacity, rate, ceiling=1.0, floor=0.1, backoff=0.5, recovery=0.05):
+
+        self.name = name
+        self.capacity = float(capacity)
+        self.set_limits(rate, ceiling, floor, backoff, recovery)
+
+        # Starts full, like TokenBucket. If another Routine already made the row, it's left as it is
+        con = con_postgres()
+        call_sql(con, '''INSERT INTO "MwsQuota" (quota, tokens, stamp) VALUES (%s, %s, clock_timestamp())
+                         ON CONFLICT (quota) DO NOTHING''', [name, self.capacity], 'executeNoReturn')
+        con.close()
+
+    def refill(self):
+        pass  # Done as part of each statement below
+
+    def sql_args(self, **kwargs):
+
+        theArgs = {'cap': self.capacity, 'rate': self.nominalRate, 'name': self.name}
+        theArgs.update(kwargs)
+        return theArgs
+
+    @staticmethod
+    def level_sql():
+        # The number of tokens in the row right now, as SQL. Another Routine may have moved stamp past when this
+        # statement started, hence the GREATEST. A Null rate means it hasn't been adjusted yet.
+        # If an hourly quota window ended since <stamp>, it's counted as if the window had lasted until now (so the
+        # level is a little low), to keep this a single expression
+        return '''LEAST(%(cap)s, tokens + GREATEST(EXTRACT(EPOCH FROM c.t - stamp), 0) *
+                        LEAST(COALESCE(rate, %(rate)s), CASE WHEN hour_until > c.t THEN hour_rate END))'''
+
+    @property
+    def rate(self):
+
+        sqlTxt = '''SELECT LEAST(COALESCE(rate, %(rate)s), CASE WHEN hour_until > c.t THEN hour_rate END)
+                    FROM "MwsQuota", (SELECT clock_timestamp() AS t) AS c
+                    WHERE quota = %(name)s'''
+        con = con_postgres()
+        rows = call_sql(con, sqlTxt, self.sql_args(), 'executeReturn')
+        con.close()
+        return float(rows[0][0]) if rows else self.nominalRate
+
+    def available(self):
+
+        sqlTxt = '''SELECT {} FROM "MwsQuota", (SELECT clock_timestamp() AS t) AS c
+                    WHERE quota = %(name)s'''.format(self.level_sql())
+        con = con_postgres()
+        rows = call_sql(con, sqlTxt, self.sql_args(), 'executeReturn')
+        con.close()
+        return float(rows[0][0]) if rows else 0.0
+
+    def wait_time(self, n=1):
+
+        self.check_n(n)
+        sqlTxt = '''SELECT {}, COALESCE(rate, %(rate)s), hour_rate, EXTRACT(EPOCH FROM hour_until - c.t)
+                    FROM "MwsQuota", (SELECT clock_timestamp() AS t) AS c
+                    WHERE quota = %(name)s'''.format(self.level_sql())
+        con = con_postgres()
+        rows = call_sql(con, sqlTxt, self.sql_args(), 'executeReturn')
+        con.close()
+        if not rows:
+            return restore_time(n, self.nominalRate)
+
+        level, rate, hourRate, hourSecs = rows[0]
+        return restore_time(n - float(level), float(rate),
+                            float(hourRate) if hourRate is not None else math.inf, float(hourSecs or 0))
+
+    def try_take(self, n=1):
+
+        self.check_n(n)
+
+        # The WHERE clause is checked again against the latest version of the row if another Routine updated it
+        # while this was waiting for the row lock, so the check and the take are atomic
+        sqlTxt = '''UPDATE "MwsQuota"
+                    SET tokens = {0} - %(n)s, stamp = GREATEST(c.t, stamp)
+                    FROM (SELECT clock_timestamp() AS t) AS c
+                    WHERE quota = %(name)s AND {0} >= %(n)s
+                    RETURNING tokens'''.format(self.level_sql())
+        con = con_postgres()
+        rows = call_sql(con, sqlTxt, self.sql_args(n=n), 'executeReturn')
+        con.commit()
+        con.close()
+        return bool(rows)
+
+    def take(self, n=1, sleep=time.sleep):
+
+        self.check_n(n)
+        waited = 0.0
+        while not self.try_take(n):
+            wait = self.wait_time(n)
+            sleep(wait)
+            waited += wait
+        return waited
+
+    async def take_async(self, n=1):
+
+        # The SQL is blocking, so it goes to the event loop's executor
+        loop = asyncio.get_running_loop()
+        self.check_n(n)
+        waited = 0.0
+        while not await loop.run_in_executor(None, self.try_take, n):
+            wait = await loop.run_in_executor(None, self.wait_time, n)
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
+
+    def feedback(self, throttled=False, remaining=None, resetsOn=None):
+
+        hourRate = hourUntil = None
+        if remaining is not None and resetsOn is not None and resetsOn > time.time():
+            hourRate = max(remaining, 0) / (resetsOn - time.time())
+            hourUntil = resetsOn
+
+        sqlTxt = '''UPDATE "MwsQuota"
+                    SET tokens = CASE WHEN %(throttled)s THEN 0 ELSE {} END,
+                        stamp = GREATEST(c.t, stamp),
+                        rate = CASE WHEN %(throttled)s THEN GREATEST(%(minRate)s, COALESCE(rate, %(rate)s) * %(backoff)s)
+                                    ELSE LEAST(%(maxRate)s, COALESCE(rate, %(rate)s) + %(step)s) END,
+                        hour_rate = COALESCE(%(hourRate)s, hour_rate),
+                        hour_until = COALESCE(to_timestamp(%(hourUntil)s), hour_until)
+                    FROM (SELECT clock_timestamp() AS t) AS c
+                    WHERE quota = %(name)s'''.format(self.level_sql())
+        con = con_postgres()
+        call_sql(con, sqlTxt, self.sql_args(throttled=throttled, minRate=self.minRate, maxRate=self.maxRate,
+                                            backoff=self.backoff, step=self.step, hourRate=hourRate,
+                                            hourUntil=hourUntil), 'executeNoReturn')
+        con.close()
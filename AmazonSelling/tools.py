@@ -1,13 +1,24 @@
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from operator import itemgetter
-from random import randint
+from random import randint, uniform
 
 import datetime
 import dateutil.parser
-import inspect
+import io
+import itertools
+import json
 import os
+import psycopg2.extensions
 import psycopg2.extras
+import re
 import requests
 import configparser
+import sys
+import threading
+import time
+
+from AmazonSelling.metrics import count, timed
 
 
 def get_request(url, theTimeout, retries):
@@ -93,46 +104,312 @@ def datetime_floor(minuteInterval, theTs=None):
 
 def con_postgres():
     """
-    :return: Postgres connection object to the database defined in credentials.ini
+    :return: Postgres connection object to the database defined in credentials.ini, from this process's PgPool.
+    Closing it puts it back in the pool. pg_con() does the same as a with block.
+    Inside a UnitOfWork, it's the unit's connection.
+    """
+    
+    unit = getattr(_local, 'unit', None)
+    if unit is not None:
+        return unit.con
+    return pg_pool().get()
+
+
+@contextmanager
+def pg_con():
+    """
+    A pooled Postgres connection for the duration of a with block:  with pg_con() as con: ...
+    It goes back to the pool at the end of the block, with anything left uncommitted rolled back.
+    """
+    
+    con = con_postgres()
+    try:
+        yield con
+    finally:
+        con.close()
+
+
+def pg_pool():
+    """
+    :return: This process's PgPool
+    """
+    
+    pid = os.getpid()
+    pool = PgPool.pools.get(pid)
+    if pool is None:
+        with PgPool.poolsLock:
+            pool = PgPool.pools.setdefault(pid, PgPool())
+    return pool
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    A psycopg2 connection whose close() hands it back to its process's PgPool, so code that already closes its
+    connections reuses them as it is. really_close() closes it for good.
+    While it's the connection of a UnitOfWork, commit() and close() are left to the unit, and rollback() rolls the
+    whole unit back.
     """
-    credParts = ('dbname', 'user', 'password')
-    creds = get_credentials({'PostgreSQL': credParts})['PostgreSQL']
-    conStr = ' '.join(['{}={}'.format(credPart, creds[credPart]) for credPart in credParts if creds[credPart]])
-    return psycopg2.connect(conStr)
     
+    unit = None  # The UnitOfWork it's the connection of, if any
+    
+    def commit(self):
+        if self.unit is None:
+            super().commit()
+    
+    def rollback(self):
+        if self.unit is not None:
+            self.unit.failed = True
+        super().rollback()
+    
+    def close(self):
+        
+        if self.unit is not None:
+            return
+        
+        # A connection inherited across a fork isn't this process's to pool
+        if getattr(self, 'pid', None) == os.getpid():
+            pg_pool().put(self)
+        else:
+            self.really_close()
+    
+    def really_close(self):
+        super().close()
 
-def call_sql(con, sqlTxt, theData, qryType, dictCur=False):
+
+class PgPool:
+    """
+    The Postgres connections of one process. get() hands out an idle connection, or opens a new one if there aren't
+    any (so nested users never wait on each other), and closing it puts it back, as long as fewer than <size> are idle.
+    The Routine's stage processes each have a pool of the default size. routine_async sizes its pool for its threads.
+    Health checks: a connection that's been idle for more than <checkAfter> seconds gets a SELECT 1 before it's handed
+    out, broken ones are dropped, and none is kept more than <maxAge> seconds, so one the server (or a firewall) has
+    quietly dropped is never handed out.
+    Whatever a connection's last user left uncommitted is rolled back when it comes back, as closing it would have done.
+    """
+    
+    pools = {}  # {pid: PgPool}. A connection can't be shared across a fork, so each process has its own
+    poolsLock = threading.Lock()
+    
+    def __init__(self, size=4, checkAfter=30, maxAge=3600):
+        self.size = size
+        self.checkAfter = checkAfter
+        self.maxAge = maxAge
+        self.idle = []  # [(connection, when it was put back)], most recent last
+        self.lock = threading.Lock()  # The asyncio Routine mode uses the pool from several threads
+        self.conStr = None
+    
+    def connect(self):
+        
+        if self.conStr is None:  # Only read credentials.ini once per process
+            credParts = ('dbname', 'user', 'password')
+            creds = get_credentials({'PostgreSQL': credParts})['PostgreSQL']
+            self.conStr = ' '.join(['{}={}'.format(credPart, creds[credPart]) for credPart in credParts
+                                    if creds[credPart]])
+        
+        con = psycopg2.connect(self.conStr, connection_factory=PooledConnection)
+        con.pid = os.getpid()
+        con.opened = time.time()
+        con.pooled = False
+        con.prepared = OrderedDict()  # {sqlTxt: (statement name, EXECUTE of it)}, see prepared_sql
+        return con
+    
+    def healthy(self, con, since):
+        
+        if con.closed or time.time() - con.opened > self.maxAge:
+            return False
+        if time.time() - since > self.checkAfter:
+            try:
+                cur = con.cursor()
+                cur.execute('SELECT 1')
+                cur.close()
+                con.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+    
+    def get(self):
+        
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                con, since = self.idle.pop()
+            con.pooled = False
+            if self.healthy(con, since):
+                return con
+            con.really_close()
+        
+        return self.connect()
+    
+    def put(self, con):
+        
+        if con.pooled or con.closed:  # Closed twice, or already closed for good
+            return
+        
+        try:
+            if con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                con.rollback()
+        except psycopg2.Error:
+            con.really_close()
+            return
+        
+        with self.lock:
+            if len(self.idle) < self.size and time.time() - con.opened < self.maxAge:
+                con.pooled = True
+                self.idle.append((con, time.time()))
+                return
+        con.really_close()
+    
+    def close_all(self):
+        
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for con, _ in idle:
+            con.really_close()
+
+
+_local = threading.local()  # .unit is the UnitOfWork open on this thread
+
+
+class UnitOfWork:
+    """
+    Runs every statement of a with block in one transaction, on one pooled connection, with a single commit at the end:
+        with UnitOfWork() as unit:
+            call_sql(unit.con, sqlTxt, theData, 'executeBatch', key=itemgetter(0))
+            record_timestamps(asins, col)
+    While it's open, con_postgres() and pg_con() on the same thread hand out its connection, so functions called within
+    it (record_timestamps, say) join it as they are, and their commits and closes wait for the end of the block.
+    So an API response's data and its timestamps are written together or not at all: if any statement fails (call_sql
+    rolls back), or the block raises, everything in the unit is rolled back, <failed> is True, and the items stay due.
+    A UnitOfWork opened within another one just joins it.
+    """
+    
+    def __init__(self):
+        self.con = None
+        self.failed = False
+        self.outer = None
+    
+    def __enter__(self):
+        
+        self.outer = getattr(_local, 'unit', None)
+        if self.outer is not None:
+            self.con = self.outer.con
+            return self
+        
+        self.con = pg_pool().get()
+        self.con.unit = self
+        _local.unit = self
+        return self
+    
+    def __exit__(self, excType, excValue, tb):
+        
+        if self.outer is not None:
+            self.failed = self.outer.failed or excType is not None
+            return False
+        
+        _local.unit = None
+        con = self.con
+        con.unit = None
+        try:
+            if excType is None and not self.failed:
+                with timed('sql'):
+                    con.commit()
+            else:
+                self.failed = True
+                con.rollback()
+                print('UnitOfWork: rolled back, nothing in it was written')
+        except psycopg2.DatabaseError as e:
+            self.failed = True
+            print('DatabaseError %s' % e)
+        finally:
+            con.close()
+        return False
+    
+
+# A statement that fails with a deadlock or a serialization failure is retried up to <sqlRetries> times, after a random
+# wait of up to <retryBase> * 2^(attempt number) seconds (but no more than <retryCap>), as long as it was the start of
+# its transaction. Otherwise (in a UnitOfWork, say) what came before it in the transaction has been rolled back with it,
+# so it's left failed, and the items it was writing stay due
+sqlRetries = 5
+retryBase = 0.05
+retryCap = 2.0
+
+
+def call_sql(con, sqlTxt, theData, qryType, dictCur=False, itersize=2000, prepare=False, key=None):
+    # If <prepare>, an 'executeNoReturn', 'executeReturn' or 'executeBatch' statement is run as a prepared statement
+    # (see prepared_sql). For fixed statements that are run over and over, like the Routine stages' queries and writes
+    # An 'executeBatch' sorts <theData> by <key> (a function of a row, like a sort key) first, so every writer locks the
+    # rows of a table in the same order (the primary key's), and concurrent writers can't deadlock each other. So every
+    # 'executeBatch' that writes to a shared table should pass the <key> of the column it's keyed on.
+    # A 'copyMerge' does the same with Staged.key
+    
+    if qryType == 'executeStream':  # Returns a generator of lists of rows, see stream_rows
+        return stream_rows(con, sqlTxt, theData, dictCur, itersize)
     
     err = False
     
+    if qryType == 'executeBatch' and key is not None:
+        theData = sorted(theData, key=key)
+    
     if dictCur:
         cur = con.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     else:
         cur = con.cursor()
     
-    try:
-        if qryType == 'executeNoReturn':
-            cur.execute(sqlTxt, theData)
-            con.commit()
-        elif qryType == 'executeReturn':
-            cur.execute(sqlTxt, theData)
-            values = cur.fetchall()
-        elif qryType == 'executeBatch':
-            psycopg2.extras.execute_batch(cur, sqlTxt, theData)
-            con.commit()
-        else:
-            print('qryType not recognized, sorry')
+    unit = getattr(con, 'unit', None)
+    attempt = 0
+    while True:
+        retryable = con.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        unitFailed = unit.failed if unit is not None else False
+        
+        try:
+            with timed('sql'):
+                theSql = sqlTxt
+                if prepare and qryType in ('executeNoReturn', 'executeReturn', 'executeBatch'):
+                    theSql = prepared_sql(con, sqlTxt)
+                
+                if qryType == 'executeNoReturn':
+                    cur.execute(theSql, theData)
+                    con.commit()
+                elif qryType == 'executeReturn':
+                    cur.execute(theSql, theData)
+                    values = cur.fetchall()
+                elif qryType == 'executeBatch':
+                    psycopg2.extras.execute_batch(cur, theSql, theData)
+                    con.commit()
+                elif qryType == 'copyMerge':  # <theData> is a Staged
+                    copy_merge(cur, theSql, theData)
+                    con.commit()
+                else:
+                    print('qryType not recognized, sorry')
+                    err = True
+        
+        except psycopg2.extensions.TransactionRollbackError as e:  # Deadlock or serialization failure
+            con.rollback()
+            if retryable and attempt < sqlRetries:
+                if unit is not None:
+                    unit.failed = unitFailed  # Nothing of the unit's was lost
+                count('sql_retries')
+                with timed('sql'):
+                    time.sleep(uniform(0, min(retryCap, retryBase * 2 ** attempt)))
+                attempt += 1
+                continue
             err = True
+            print('DatabaseError (after {} retries) {}'.format(attempt, e))
             
-    except psycopg2.DatabaseError as e:
-        err = True
-        if con:
-            con.rollback()
-        print('DatabaseError %s' % e)
+        except psycopg2.DatabaseError as e:
+            err = True
+            if con:
+                con.rollback()
+                if e.pgcode == '26000' and getattr(con, 'prepared', None):  # invalid_sql_statement_name
+                    con.prepared.clear()  # A prepared statement has gone somehow, so they're all prepared again
+            print('DatabaseError %s' % e)
+            
+        except KeyError as e:
+            err = True
+            print('KeyError: Dictionary key %s was not found in the set of existing keys' % e)
         
-    except KeyError as e:
-        err = True
-        print('KeyError: Dictionary key %s was not found in the set of existing keys' % e)
+        break
         
     if cur:
         cur.close()
@@ -141,6 +418,160 @@ def call_sql(con, sqlTxt, theData, qryType, dictCur=False):
         return values
     
 
+preparedIds = itertools.count()  # For unique names for prepared_sql's statements
+maxPrepared = 100  # The most statements prepared_sql keeps prepared on one connection
+
+
+def prepared_sql(con, sqlTxt):
+    """
+    Returns an EXECUTE of <sqlTxt> as a prepared statement on <con>, taking the same parameters, PREPAREing it the first
+    time it's used on <con>. So Postgres parses and plans it once per pooled connection, instead of on every call.
+    A prepared statement lasts as long as its connection (a rollback doesn't undo a PREPARE), as does the cache of them.
+    Only the <maxPrepared> most recently used are kept: the one used longest ago is DEALLOCATEd to make room, so a
+    caller that formats its SQL can't fill the server up with prepared statements.
+    <sqlTxt> can only have %s parameters. If it has %(name)s ones, or <con> isn't from a PgPool, <sqlTxt> is returned
+    as it is.
+    """
+    
+    cache = getattr(con, 'prepared', None)
+    if cache is None or '%(' in sqlTxt:
+        return sqlTxt
+    
+    if sqlTxt in cache:
+        cache.move_to_end(sqlTxt)  # Least recently used first
+        theStmt = cache[sqlTxt][1]
+    else:
+        # %s's become $1, $2, ... and %%'s become %
+        numParams = 0
+        body = []
+        for piece in re.split('(%%|%s)', sqlTxt):
+            if piece == '%s':
+                numParams += 1
+                body.append('${}'.format(numParams))
+            else:
+                body.append('%' if piece == '%%' else piece)
+        
+        name = 'stmt_{}'.format(next(preparedIds))
+        cur = con.cursor()
+        while len(cache) >= maxPrepared:
+            _, (oldName, _) = cache.popitem(last=False)
+            cur.execute('DEALLOCATE {}'.format(oldName))
+        cur.execute('PREPARE {} AS {}'.format(name, ''.join(body)))
+        cur.close()
+        theStmt = 'EXECUTE {}{}'.format(name, '({})'.format(', '.join(['%s'] * numParams)) if numParams else '')
+        cache[sqlTxt] = (name, theStmt)
+    
+    return theStmt
+
+
+streamIds = itertools.count()  # For unique names for stream_rows' cursors
+
+
+def stream_rows(con, sqlTxt, theData, dictCur=False, itersize=2000):
+    """
+    call_sql's 'executeStream' qryType. Runs the SELECT <sqlTxt> in a named (server-side) cursor and yields its rows in
+    lists of up to <itersize>, fetching each list as it's needed, so only one of them is ever in memory, however big the
+    result is. Stopping early (break) closes the cursor.
+    The cursor lasts as long as <con>'s transaction, so nothing may commit on <con> while it's being read: write on
+    another connection, or in a UnitOfWork. On a DatabaseError, it prints, rolls back, and yields nothing more.
+    """
+    
+    cursorFactory = psycopg2.extras.RealDictCursor if dictCur else None
+    cur = con.cursor('stream_{}_{}'.format(os.getpid(), next(streamIds)), cursor_factory=cursorFactory)
+    try:
+        with timed('sql'):
+            cur.execute(sqlTxt, theData)
+        while True:
+            with timed('sql'):
+                rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            yield rows
+    except psycopg2.DatabaseError as e:
+        con.rollback()
+        print('DatabaseError %s' % e)
+    finally:
+        if not con.closed and con.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+            cur.close()
+
+
+# The <theData> of call_sql's 'copyMerge' qryType. <rows> (tuples of the columns <cols> of table <tbl>) are streamed with
+# COPY into a temp table called staged, with the same column types, and then <sqlTxt> merges them in with a single
+# INSERT ... SELECT ... FROM staged ... ON CONFLICT, or UPDATE ... FROM staged. Much faster than execute_batch for big
+# writes, since it's one round trip and one statement.
+# If <key> is given, only the last row for each key is kept (as if the rows had been written one by one), and the rows
+# of <tbl> with those keys are locked in key order before the merge, the same order sorted execute_batch writes lock
+# them in, so merges don't deadlock with each other. An INSERT merge should ORDER BY <key> too, for the new rows.
+Staged = namedtuple('Staged', ('tbl', 'cols', 'rows', 'key'))
+Staged.__new__.__defaults__ = (None,)
+
+
+def copy_value(value):
+    """
+    <value> in COPY's text format
+    """
+    
+    if value is None:
+        return '\\N'
+    return pg_text(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def pg_text(value):
+    """
+    <value> as text that Postgres's input functions read as the same value execute_batch would have written: lists and
+    tuples as array literals, dicts (and psycopg2 Json) as JSON, bytes as bytea's hex format
+    """
+    
+    if isinstance(value, bool):
+        return 'true' if value else 'false'  # What an execute_batch INSERT of a bool into a text column would write
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return '{} seconds'.format(value.total_seconds())
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join(array_element(v) for v in value) + '}'
+    if isinstance(value, dict):
+        return json.dumps(value)
+    if isinstance(value, psycopg2.extras.Json):
+        return json.dumps(value.adapted)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    return str(value)  # Numbers (Decimal included), strings, UUIDs
+
+
+def array_element(value):
+    # One element of an array literal. Nested lists are sub-arrays, and everything else is quoted
+    
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (list, tuple)):
+        return pg_text(value)
+    return '"' + pg_text(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def copy_merge(cur, sqlTxt, staged):
+    """
+    Runs a 'copyMerge' (see Staged) on cursor <cur>, in the current transaction. staged is dropped once it's merged,
+    so one transaction (a UnitOfWork) can run several.
+    """
+    
+    rows = staged.rows
+    if staged.key:
+        i = list(staged.cols).index(staged.key)
+        rows = {row[i]: row for row in rows}.values()
+    
+    cols = ', '.join(staged.cols)
+    cur.execute('CREATE TEMP TABLE staged ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA'.format(cols, staged.tbl))
+    buf = io.StringIO(''.join('\t'.join(copy_value(v) for v in row) + '\n' for row in rows))
+    cur.copy_expert('COPY staged ({}) FROM STDIN'.format(cols), buf)
+    
+    if staged.key:
+        cur.execute('''SELECT Null FROM {0} WHERE {1} IN (SELECT {1} FROM staged)
+                       ORDER BY {1} FOR UPDATE'''.format(staged.tbl, staged.key))
+    cur.execute(sqlTxt)
+    cur.execute('DROP TABLE staged')
+
+
 def write_to_file(filename, data, dirrr='', absPath=False):
     """
     If <dirrr> is ommited and <absPath> is False, file will be written to the same folder as the caller
@@ -150,46 +581,78 @@ def write_to_file(filename, data, dirrr='', absPath=False):
     if absPath:
         _dirrr = dirrr
     else:  # We're going by relative path
-        # Get the location of the caller function, and paste dirrr on the end to get the full path
-        _dirrr = '{}/{}'.format(os.path.dirname(os.path.abspath(inspect.stack()[1][1])), dirrr)
+        # Get the location of the caller function, and paste dirrr on the end to get the full path.
+        # sys._getframe just looks at the caller's frame, where inspect.stack() would build (and read the source for)
+        # the whole stack.
+        _dirrr = '{}/{}'.format(os.path.dirname(os.path.abspath(sys._getframe(1).f_code.co_filename)), dirrr)
     
     with open(os.path.join(_dirrr, filename), 'w', encoding='utf-8') as f:
         f.write(data)
     
 
-def union_no_dups(j, k):
+class WorkQueue:
     """
-    Returns a list of lists containing the union of j and k without duplicates
-    Duplicates are defined by matching values in the first columns of j and k. For instance: If j[6][0] == k[52][0]
-    j and k are lists of lists or lists of tuples.
+    An ordered queue of work items (query rows, or single values) without duplicates.
+    Items are keyed by their first column, and kept in an OrderedDict, so checking for a duplicate
+    is O(1) and items come out in the order they went in (FIFO).
     """
     
-    # Convert j to list of lists
-    if j:  # j is not empty
-        if isinstance(j[0], tuple):
-            j = [list(elem) for elem in j]
+    def __init__(self, items=()):
+        self.items = OrderedDict()
+        self.extend(items)
+    
+    @staticmethod
+    def key(item):
+        return item[0] if isinstance(item, (list, tuple)) else item
+    
+    def __len__(self):
+        return len(self.items)
     
-    if k:  # k is not empty
+    def __contains__(self, item):
+        return self.key(item) in self.items
     
-        # Make lists of the first columns in each list of lists, j and k
-        m = [i[0] for i in j]
-        n = [i[0] for i in k]
+    def extend(self, items, retryFailed=True):
+        """
+        Adds <items> to the end of the queue, skipping any whose key is already in it. Returns the number added.
+        <retryFailed> is for JobQueue. Nothing fails in here, since a failed call's items are just dropped.
+        """
         
-        # Make a list of all indices in n that do not have duplicate values in m
-        nondupIndices = [ind[0] for ind in enumerate(n) if not n[ind[0]] in m]
+        numAdded = 0
+        for item in items:
+            k = self.key(item)
+            if k not in self.items:
+                self.items[k] = item
+                numAdded += 1
+        return numAdded
+    
+    def pop_many(self, n):
+        """
+        Removes and returns (up to) the first <n> items
+        """
         
-        # Append all the non-dupes in k into j
-        for q in nondupIndices:
-            j.append(list(k[q]))
-        return j
+        return [self.items.popitem(last=False)[1] for _ in range(min(n, len(self.items)))]
     
-    else:
-        return j
+    def discard(self, item):
+        self.items.pop(self.key(item), None)
+    
+    def complete(self, keys):
+        pass  # Popped items are already gone. This is for JobQueue, whose items are only gone once they're done
     
+    def release(self, keys):
+        pass  # A failed call's items are still due in SQL, so the next fill_q puts them back
+        
+
+# How long after each operation an ASIN is due for it again. Kept in <col>_due in Timestamps_WmAz, next to <col>
+dueAfter = {'az_comp_price':   datetime.timedelta(hours=42),
+            'az_lowest_offer': datetime.timedelta(hours=42)}
+matchDueAfter = datetime.timedelta(days=30)  # For Prod_Wm.match_due, from Prod_Wm.last_matched
+
 
 def record_timestamps(datums, col):
     # Log the timestamp of an operation (col)
     # <datums>can either be a list of asins, or a list of lists contains asins and timestamps
+    # Also keeps the next_due columns up to date: <col>_due for the columns in <dueAfter>, and az_fees_due, which is
+    # set to when fees became due (once both az_comp_price and az_lowest_offer are newer than az_fees), or else Null
     
     if col in ['wm_data', 'match_to_az', 'az_comp_price', 'az_fees', 'az_lowest_offer']:
         tbl = 'Timestamps_WmAz'
@@ -199,10 +662,22 @@ def record_timestamps(datums, col):
         return    
 
     if isinstance(datums[0], list) or isinstance(datums[0], tuple):  # datums is 2D, which means it includes timestamps
-        theData = [(i[0], datetime_floor(1.0/60, theTs=i[1]), datetime_floor(1.0/60, theTs=i[1]),) for i in datums]
+        theData = [(i[0], datetime_floor(1.0/60, theTs=i[1]),) for i in datums]
     else:  # datums just has asins, no timestamps
         ts = datetime_floor(1.0/60)
-        theData = [(i, ts, ts,) for i in datums]
+        theData = [(i, ts,) for i in datums]
+    
+    cols = [col]
+    setTxts = ['{0} = EXCLUDED.{0}'.format(col)]
+    if col in dueAfter:
+        theData = [i + (i[1] + dueAfter[col],) for i in theData]
+        cols.append(col + '_due')
+        setTxts.append('{0}_due = EXCLUDED.{0}_due'.format(col))
+    if col in ('az_comp_price', 'az_lowest_offer', 'az_fees'):
+        # The new value for <col>, and the existing ones for the other two
+        c, l, f = ('EXCLUDED.' + g if g == col else 't.' + g for g in ('az_comp_price', 'az_lowest_offer', 'az_fees'))
+        setTxts.append("""az_fees_due = CASE WHEN {0} > COALESCE({2}, '-infinity') AND {1} > COALESCE({2}, '-infinity')
+                       THEN GREATEST({0}, {1}) END""".format(c, l, f))
         
     # Sort theData by the first value (ASIN) of each tuple. This is to prevent Postgres deadlocks --->
     # https://www.postgresql.org/docs/9.4/static/explicit-locking.html#LOCKING-DEADLOCKS
@@ -211,14 +686,12 @@ def record_timestamps(datums, col):
     # https://stackoverflow.com/questions/17243620/operator-itemgetter-or-lambda/17243726
     theData.sort(key=itemgetter(0))
     
-    sqlTxt = '''INSERT INTO "{}" (asin, {})
-                VALUES(%s, %s)
+    sqlTxt = '''INSERT INTO "{0}" AS t (asin, {1})
+                SELECT asin, {1} FROM staged ORDER BY asin
                 ON CONFLICT ("asin") DO UPDATE
-                SET {} = %s'''.format(tbl, col, col)
-    con = con_postgres()
-    call_sql(con, sqlTxt, theData, 'executeBatch')
-    if con:
-        con.close()
+                SET {2}'''.format(tbl, ', '.join(cols), ', '.join(setTxts))
+    with pg_con() as con:
+        call_sql(con, sqlTxt, Staged('"{}"'.format(tbl), ['asin'] + cols, theData, 'asin'), 'copyMerge')
         
 
 def str_to_datetime(theStr):
@@ -368,17 +841,3 @@ def chunks(theList, n):
     
     for i in range(0, len(theList), n):
         yield theList[i:i + n]
-        
-
-def make_sql_list(theList, theType):
-    """
-    Create a string from a list or tuple to be used in a SQL query.
-    Parameters: theList (list or tuple, 1-D), theType (string: 'int' or 'str')
-    """
-    
-    if theType == 'int':
-        return '({})'.format(','.join(map(str, theList)))
-    elif theType == 'str':
-        return "('{}')".format("','".join(theList))
-    else:
-        raise ValueError("<theType> should be a string with a value of either 'int' or 'str'")
@@ -1,6 +1,9 @@
+from operator import itemgetter
+
 import xlwings as xw
 
 from AmazonSelling.inventory import update_skus
+from AmazonSelling.schema import refresh_view
 from AmazonSelling.tools import call_sql, con_postgres
 from ExcelIntegration.xlfuncs import sql_to_xl, xl_to_sql
 
@@ -34,9 +37,7 @@ def displaydata_tosql_manual():
     
 def displaydata_toxl_already():
     
-    con = con_postgres()
-    call_sql(con, 'REFRESH MATERIALIZED VIEW public."Already"', [], 'executeNoReturn')
-    con.close()
+    refresh_view('public."Already"')
     
     sql_to_xl('Already', wkbk=xw.Book.caller(), sh='Already')
     
@@ -61,7 +62,7 @@ def displaydata_tosql_already():
     sqlTxt = '''UPDATE io."SKUs"
                 SET fragile = %s, polybag = %s, expire = %s, ingredients = %s, discontinue = %s, edit = %s, non_joliet = %s
                 WHERE sku = %s'''
-    call_sql(con, sqlTxt, theData, 'executeBatch')
+    call_sql(con, sqlTxt, theData, 'executeBatch', key=itemgetter(-1))
     
     if con:
         con.close()
@@ -294,9 +295,7 @@ def displaydata_fillinvloader():
     
 def displaydata_toxl_enroute():
     
-    con = con_postgres()
-    call_sql(con, 'REFRESH MATERIALIZED VIEW io."Enroute"', [], 'executeNoReturn')
-    con.close()
+    refresh_view('io."Enroute"')
     
     sql_to_xl('io.Enroute', wkbk=xw.Book.caller(), sh='Enroute')
 
@@ -322,7 +321,7 @@ def displaydata_tosql_enroute():
     sqlTxt = '''UPDATE io."Purchased"
                 SET received = %s, cancelled = %s, lost = %s, notes = %s
                 WHERE purchase_id = %s'''
-    call_sql(con, sqlTxt, theData, "executeBatch")
+    call_sql(con, sqlTxt, theData, "executeBatch", key=itemgetter(-1))
     
     if con:
         con.close()
@@ -330,9 +329,7 @@ def displaydata_tosql_enroute():
         
 def displaydata_toxl_instock():
     
-    con = con_postgres()
-    call_sql(con, 'REFRESH MATERIALIZED VIEW io."In_Stock"', [], "executeNoReturn")
-    con.close()
+    refresh_view('io."In_Stock"')
 
     sql_to_xl('io.In_Stock', wkbk=xw.Book.caller(), sh='In Stock')
 
@@ -368,12 +365,12 @@ def displaydata_tosql_instock():
     sqlTxt = '''UPDATE io."Purchased"
                 SET labeled = %s, packed = COALESCE(packed, 0) + COALESCE(%s, 0), lost = %s, pack_date = %s, notes = %s
                 WHERE purchase_id = %s'''
-    call_sql(con, sqlTxt, theData1, "executeBatch")
+    call_sql(con, sqlTxt, theData1, "executeBatch", key=itemgetter(-1))
     
     sqlTxt = '''UPDATE io."SKUs"
                 SET non_joliet = %s
                 WHERE sku = %s'''
-    call_sql(con, sqlTxt, theData2, 'executeBatch')
+    call_sql(con, sqlTxt, theData2, 'executeBatch', key=itemgetter(-1))
     
     if con:
         con.close()
@@ -1,3 +1,5 @@
+from operator import itemgetter
+
 import datetime
 import itertools
 import re
@@ -70,16 +72,15 @@ def sql_to_xl(tbl, wkbk=None, sh='Sheet1', where=None):
     
     print(sqlTxt)    
     
-    # Double tuple comprehension: creates a tuple of tuples with the column index and the data for that column.
-    # The data part of each 2nd level tuple is itself a tuple, and transposed so the data pastes in as columns instead
-    # of rows.
-    datumsByCol = tuple((colIndexes[i], tuple((j[i],) for j in call_sql(con, sqlTxt, [], 'executeReturn')),)
-                        for i in range(len(colIndexes)))
+    # Streams the rows a batch at a time, and pastes each batch in below the last one, so the table is never all in
+    # memory at once. Each column of a batch is a tuple of 1-tuples, so the data pastes in as columns instead of rows.
+    rowNum = 1
+    for datums in call_sql(con, sqlTxt, [], 'executeStream', itersize=5000):
+        for i, colIndex in enumerate(colIndexes):
+            datumsRange(rowNum, colIndex).value = tuple((j[i],) for j in datums)
+        rowNum += len(datums)
     if con:
         con.close()
-    
-    for col in datumsByCol:
-        datumsRange(1, col[0]).value = col[1]
 
     
 def xl_to_sql(tbl, caller, sh='Sheet1', upsert=False):
@@ -168,7 +169,7 @@ def xl_to_sql(tbl, caller, sh='Sheet1', upsert=False):
                     VALUES({})'''.format(tbl, names, formatters)
         
     print(sqlTxt)
-    call_sql(con, sqlTxt, datums, 'executeBatch')
+    call_sql(con, sqlTxt, datums, 'executeBatch', key=itemgetter(0))  # The first column is the primary key
     
     if con:
         con.close()
@@ -191,7 +192,7 @@ def test_get_arrays():
                 SET expire = %s
                 WHERE purchase_id = %s'''
     con = con_postgres()
-    call_sql(con, sqlTxt, theData, 'executeBatch')
+    call_sql(con, sqlTxt, theData, 'executeBatch', key=itemgetter(1))
     con.close()
 
         
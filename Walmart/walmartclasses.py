@@ -6,13 +6,22 @@ import time
 import uuid
 import xml.etree.ElementTree as ET
 from multiprocessing import Process
-from operator import itemgetter
+from operator import attrgetter, itemgetter
 
 import math
 import psycopg2.extras
 
+from AmazonSelling.archive import archive_response
+from AmazonSelling.jobqueue import JobQueue
+from AmazonSelling.records import WmItem, TaxoNode
+from AmazonSelling.schema import ensure_schema
 from AmazonSelling.tools import datetime_floor, call_sql, get_request, record_timestamps, write_to_file, \
-    get_credentials, con_postgres
+    get_credentials, con_postgres, pg_con, Staged, UnitOfWork
+
+
+# The Walmart API fields for each WmItem field after <fetched>, in order
+wmItemTags = ("itemId", "name", "salePrice", "upc", "modelNumber", "brandName", "stock", "availableOnline",
+              "freeShippingOver35Dollars", "clearance")
 
 
 class WmRoutine:
@@ -337,11 +346,11 @@ class Search:
             print("[Path: {}, Query: '{}'], start at {}: {} {}"
                   .format(self.subCat, self.qry, self.startIndex, resultLib['numTries'],
                           "try" if resultLib['numTries'] == 1 else "tries"))
-            self.resultTxt = resultLib['result'].text            
-     
-            with open(os.path.join(os.path.dirname(__file__), 'DataFiles/Search.{}'.format(self.ext)), 'w',
-                      encoding="utf-8") as f:
-                f.write(self.resultTxt)                
+            self.resultTxt = resultLib['result'].text
+            
+            # Keep the raw response in Walmart/DataFiles/archive
+            archive_response('Walmart', 'Search', resultLib['result'].content,
+                             ids=[self.subCat or self.qry, self.startIndex])
                 
 #         with open('H:\\Arbitrage\\Walmart\\DataFiles\\Search.json') as q:
 #             self.resultTxt = q.read()
@@ -433,20 +442,22 @@ class Search:
         
         if theData:
             sqlTxt = '''INSERT INTO "Prod_Wm" (fetched, wm_id, name, price, upc, model, brand, in_stock, avail_online, free_ship, clearance)
-                        VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        SELECT fetched, wm_id, name, price, upc, model, brand, in_stock, avail_online, free_ship, clearance
+                        FROM staged ORDER BY wm_id
                         ON CONFLICT ("wm_id") DO UPDATE
-                        SET fetched = %s, name = %s, price = %s, upc = %s, model = %s, brand = %s, in_stock = %s,
-                        avail_online = %s, free_ship = %s, clearance = %s'''
-            theData.sort(key=itemgetter(1))
-            con = con_postgres()
-            call_sql(con, sqlTxt, theData, "executeBatch")
-            
-            if self.subCat:  # Need to update with path
-                theData2 = [[self.subCat, g[1]] for g in theData]  # Get wm_id along with the subCat
-                theData2.sort(key=itemgetter(1))
-                call_sql(con, 'UPDATE "Prod_Wm" SET path = %s WHERE wm_id = %s', theData2, "executeBatch")
-            
-            con.close()
+                        SET fetched = EXCLUDED.fetched, name = EXCLUDED.name, price = EXCLUDED.price,
+                        upc = EXCLUDED.upc, model = EXCLUDED.model, brand = EXCLUDED.brand,
+                        in_stock = EXCLUDED.in_stock, avail_online = EXCLUDED.avail_online,
+                        free_ship = EXCLUDED.free_ship, clearance = EXCLUDED.clearance'''
+            theData.sort(key=attrgetter('wm_id'))
+            with pg_con() as con:
+                call_sql(con, sqlTxt, Staged('"Prod_Wm"', WmItem._fields, theData, 'wm_id'), "copyMerge")
+                
+                if self.subCat:  # Need to update with path
+                    theData2 = [[self.subCat, g.wm_id] for g in theData]  # Get wm_id along with the subCat
+                    theData2.sort(key=itemgetter(1))
+                    call_sql(con, '''UPDATE "Prod_Wm" AS p SET path = s.path FROM staged AS s WHERE p.wm_id = s.wm_id''',
+                             Staged('"Prod_Wm"', ('path', 'wm_id'), theData2, 'wm_id'), "copyMerge")
             
             
 class SearchXML(Search):
@@ -486,8 +497,7 @@ class SearchXML(Search):
         theData = []
         if self.root:
             ts = datetime_floor(1.0/60)
-            tagsTupl = ("itemId", "name", "salePrice", "upc", "modelNumber", "brandName", "stock", "availableOnline",
-                        "freeShippingOver35Dollars", "clearance")
+            tagsTupl = wmItemTags
             
             for w in self.root.findall(".//items/item"):
                 values = dict.fromkeys(tagsTupl)  # Initializes a dict with keys from tagsTupl, and all values as None
@@ -499,28 +509,7 @@ class SearchXML(Search):
                 # Only add this item if it has a numeric upc
                 values['upc'] = self.check_and_fix_upc(values['upc'], values['itemId'])
                 if values['upc']:
-                    theData.append((ts,
-                                    values["itemId"],
-                                    values["name"],
-                                    values["salePrice"],
-                                    values["upc"],
-                                    values["modelNumber"],
-                                    values["brandName"],
-                                    values["stock"],
-                                    values["availableOnline"],
-                                    values["freeShippingOver35Dollars"],
-                                    values["clearance"],
-                                    # ON CONFLICT DO UPDATE values start here
-                                    ts,
-                                    values["name"],
-                                    values["salePrice"],
-                                    values["upc"],
-                                    values["modelNumber"],
-                                    values["brandName"],
-                                    values["stock"],
-                                    values["availableOnline"],
-                                    values["freeShippingOver35Dollars"],
-                                    values["clearance"]))
+                    theData.append(WmItem(ts, *(values[tag] for tag in tagsTupl)))
                     
         return theData
     
@@ -555,10 +544,6 @@ class SearchJSON(Search):
         theData = []        
         if self.theJson['items']:
             ts = datetime_floor(1.0/60)
-            preConflictTags = ("itemId", "name", "salePrice", "upc", "modelNumber", "brandName", "stock",
-                               "availableOnline", "freeShippingOver35Dollars", "clearance")
-            postConflictTags = ("name", "salePrice", "upc", "modelNumber", "brandName", "stock", "availableOnline",
-                                "freeShippingOver35Dollars", "clearance")
             jsonItems = self.theJson['items']
             
             for i in jsonItems:
@@ -568,8 +553,7 @@ class SearchJSON(Search):
                     i['upc'] = self.check_and_fix_upc(i['upc'], i['itemId'])
                     
                     if i['upc']:
-                        theData.append((ts,) + tuple(i[tag] if tag in i else None for tag in preConflictTags) + 
-                                       (ts,) + tuple(i[tag] if tag in i else None for tag in postConflictTags))
+                        theData.append(WmItem(ts, *(i.get(tag) for tag in wmItemTags)))
         
         return theData
     
@@ -599,28 +583,70 @@ class Lookup:
     https://developer.walmartlabs.com/docs/read/Home
     """
     
+    redoAfter = datetime.timedelta(hours=1)
+    
     def __init__(self):
         self.apiKey = get_credentials({'WalmartAPI': 'apiKey'})
         self.err = {'isErr': False, 'datums': None}
         
-    def lookup_batch(self, wmIdsTupl):
+    def lookup_batch(self, wmIdsTupl, durable=True):
         """
         Fetches and writes to SQL the lookup data for a potentially large number of wm_ids
         <wmIdsTupl> is a tuple of wm_ids
+        If <durable>, the wm_ids go through the 'Lookup' JobQueue, so if this is interrupted, running it again picks up
+        where it left off (wm_ids looked up within the last <self.redoAfter> aren't looked up again), and lookups running
+        on other hosts share the work. It returns once none of <wmIdsTupl> are left in the queue to claim, whatever
+        else other callers have put in it. A chunk that fails is put back and tried again, up to the JobQueue's
+        maxAttempts, and the wm_ids that were still failing at the end are printed.
         """
         
-        # Get 20 wm_ids at a time from wmIdsTupl
-        for i in range(0, math.ceil(len(wmIdsTupl) / 20)):
-            queryResult = self.lookup(wmIdsTupl[20 * i:min(len(wmIdsTupl), 20 * (i + 1))])
+        if not durable:
+            # Get 20 wm_ids at a time from wmIdsTupl
+            for i in range(0, math.ceil(len(wmIdsTupl) / 20)):
+                self.lookup_and_write(wmIdsTupl[20 * i:min(len(wmIdsTupl), 20 * (i + 1))])
+            return
+        
+        ensure_schema()  # For the "Jobs" table, since this can run before any Routine has
+        q = JobQueue('Lookup', int, redoAfter=self.redoAfter, onlyKeys=wmIdsTupl)
+        q.reclaim_host()
+        q.extend(wmIdsTupl)
+        
+        failed = set()
+        while len(q) > 0:
+            wmIds = tuple(q.key(elem) for elem in q.pop_many(20))
+            if not wmIds:
+                break  # Claimed by another host in the meantime
             
-            theJson = xml_json_err_check(queryResult, 'json')  # This will also write err to file, if there is an err
-            if not theJson['isErr']:
-                self.json_to_sql(theJson['datums'])
+            if self.lookup_and_write(wmIds):
+                q.complete(wmIds)
+                failed.difference_update(wmIds)
+            else:
+                q.release(wmIds)
+                failed.update(wmIds)
+        
+        if failed:
+            print('Lookup.lookup_batch: {} wm_ids failed, and were left for the next lookup_batch: {}'
+                  .format(len(failed), sorted(failed)))
+    
+    def lookup_and_write(self, smallWmIdsTupl):
+        """
+        Looks up <smallWmIdsTupl> and writes the data to SQL. Returns False if there was an error, in the lookup or in
+        writing it
+        """
+        
+        queryResult = self.lookup(smallWmIdsTupl)
+        
+        theJson = xml_json_err_check(queryResult, 'json')  # This will also write err to file, if there is an err
+        if theJson['isErr']:
+            return False
+        return self.json_to_sql(theJson['datums'])
     
     def lookup(self, smallWmIdsTupl):
         # Returns a list of dicts of the parsed API data for the given wm_ids
         # <smallWmIdsTupl> is a tuple of wm_ids with no more than 20 elements
+        # Returns None if the request failed
         
+        queryResult = None
         urlStr = 'http://api.walmartlabs.com/v1/items?ids={}&apiKey={}&format=json'\
                  .format(','.join(str(w) for w in smallWmIdsTupl), self.apiKey)
         resultLib = get_request(urlStr, 15, 3)
@@ -630,7 +656,8 @@ class Lookup:
                   .format(len(smallWmIdsTupl), resultLib['numTries'], 'try' if resultLib['numTries'] == 1 else 'tries'))
             queryResult = resultLib['result'].text
             
-            write_to_file('product_lookup.json', queryResult, dirrr='DataFiles', absPath=False)
+            # Keep the raw response in Walmart/DataFiles/archive
+            archive_response('Walmart', 'product_lookup', resultLib['result'].content, ids=smallWmIdsTupl)
          
         else:  
             print('Request result returned None for the following input for walmartclasses.Lookup.lookup:')
@@ -639,30 +666,26 @@ class Lookup:
         return queryResult
 
     def json_to_sql(self, theJson):
-        # Takes a raw Product Lookup JSON string and writes it to SQL
+        # Takes a raw Product Lookup JSON string and writes it to SQL. Returns False if the write failed
         
         jsonItems = theJson['items']
-        theData = []
-        preConflictTags = ("itemId", "name", "salePrice", "upc", "modelNumber", "brandName", "stock", "availableOnline",
-                           "freeShippingOver35Dollars", "clearance")
-        postConflictTags = ("name", "salePrice", "upc", "modelNumber", "brandName", "stock", "availableOnline",
-                            "freeShippingOver35Dollars", "clearance")
         ts = datetime_floor(1.0/60)
-        
-        for i in jsonItems:            
-            theData.append((ts,) + tuple(i[tag] if tag in i else None for tag in preConflictTags) + 
-                           (ts,) + tuple(i[tag] if tag in i else None for tag in postConflictTags))
+        theData = [WmItem(ts, *(i.get(tag) for tag in wmItemTags)) for i in jsonItems]
 
         if theData:
             sqlTxt = '''INSERT INTO "Prod_Wm" (fetched, wm_id, name, price, upc, model, brand, in_stock, avail_online, free_ship, clearance)
-                        VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        SELECT fetched, wm_id, name, price, upc, model, brand, in_stock, avail_online, free_ship, clearance
+                        FROM staged ORDER BY wm_id
                         ON CONFLICT ("wm_id") DO UPDATE
-                        SET fetched = %s, name = %s, price = %s, upc = %s, model = %s, brand = %s, in_stock = %s,
-                        avail_online = %s, free_ship = %s, clearance = %s'''
-            theData.sort(key=itemgetter(1))
-            con = con_postgres()
-            call_sql(con, sqlTxt, theData, "executeBatch")
-            con.close()
+                        SET fetched = EXCLUDED.fetched, name = EXCLUDED.name, price = EXCLUDED.price,
+                        upc = EXCLUDED.upc, model = EXCLUDED.model, brand = EXCLUDED.brand,
+                        in_stock = EXCLUDED.in_stock, avail_online = EXCLUDED.avail_online,
+                        free_ship = EXCLUDED.free_ship, clearance = EXCLUDED.clearance'''
+            theData.sort(key=attrgetter('wm_id'))
+            with UnitOfWork() as unit:
+                call_sql(unit.con, sqlTxt, Staged('"Prod_Wm"', WmItem._fields, theData, 'wm_id'), "copyMerge")
+            return not unit.failed
+        return True
             
 
 class Taxo:
@@ -727,26 +750,22 @@ class Taxo:
                             subCat_id = int(subCat.find("id").text.split('_')[2])
                             subCat_name = subCat.find("name").text
                             
-                            theData.append([full_id,
-                                            dept_id,
-                                            dept_name,
-                                            cat_id,
-                                            cat_name,
-                                            subCat_id,
-                                            subCat_name,
-                                            updateuuid,
-                                            datetime.date.today(),
-                                            # ON CONFLICT DO UPDATE values start here
-                                            dept_name,
-                                            cat_name,
-                                            subCat_name,
-                                            updateuuid])
+                            theData.append(TaxoNode(full_id,
+                                                    dept_id,
+                                                    dept_name,
+                                                    cat_id,
+                                                    cat_name,
+                                                    subCat_id,
+                                                    subCat_name,
+                                                    updateuuid,
+                                                    datetime.date.today()))
                             
         sqlTxt = '''INSERT INTO "WmTaxo_Updated" (full_id, dept_id, dept_name, cat_id, cat_name, subcat_id, subcat_name, update_uuid, birthdate)
                     VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)
                     ON CONFLICT (full_id) DO UPDATE
-                    SET dept_name = %s, cat_name = %s, subcat_name = %s, update_uuid = %s'''
-        call_sql(con, sqlTxt, theData, "executeBatch")
+                    SET dept_name = EXCLUDED.dept_name, cat_name = EXCLUDED.cat_name,
+                    subcat_name = EXCLUDED.subcat_name, update_uuid = EXCLUDED.update_uuid'''
+        call_sql(con, sqlTxt, theData, "executeBatch", key=itemgetter(0))
         
         # Set "active" column in WmTaxo_Updated to True when that row's uuid matches the new one
         sqlTxt = '''UPDATE "WmTaxo_Updated"
@@ -782,6 +801,8 @@ class Taxo:
                     ON CONFLICT (full_id) DO UPDATE
                     SET active = excluded.active'''
         call_sql(con, sqlTxt, [], "executeNoReturn")
+        
+        con.close()
 
 
 def wm_db_query(items):
@@ -811,16 +832,16 @@ def wm_db_query(items):
         
         sqlTxt = '''SELECT wm_id, name, price, upc, model, brand, in_stock, free_ship FROM "Prod_Wm" '''    
         
-        # Sort out <items> depending on what type it is
-        if isList:  # Write the wm_id's out into the WHERE clause of a SQL SELECT statement
-            sqlSnippet = 'WHERE'
-            for wm_id in items:
-                sqlSnippet = sqlSnippet + " (wm_id = '" + str(wm_id) + "') OR"
-            sqlSnippet = sqlSnippet[:-3]  # Remove the last 3 characters: ' or'
-        else:  # Write the SQL bit to get the n most pertinent items
-            sqlSnippet = 'ORDER BY fetched ASC FETCH FIRST %s ROWS ONLY' % items
+        # Sort out <items> depending on what type it is. Either way, it's a single parameter, so the SQL is the same
+        # every time
+        if isList:  # The wm_id's, as an array
+            sqlSnippet = 'WHERE wm_id = ANY(%s)'
+            theArgs = [list(items)]
+        else:  # Get the n most pertinent items
+            sqlSnippet = 'ORDER BY fetched ASC FETCH FIRST %s ROWS ONLY'
+            theArgs = [items]
         
-        dict_cur.execute(sqlTxt + sqlSnippet)
+        dict_cur.execute(sqlTxt + sqlSnippet, theArgs)
         wmDicts = dict_cur.fetchall()  # List of dicts
     
     # Some error-logging
@@ -856,7 +877,9 @@ def wm_db_query(items):
     return wmDicts
     
 
-def update_wm_data_timestamps():
+def update_wm_data_timestamps(since=None):
+    # Copies Prod_Wm.fetched to Timestamps_WmAz.wm_data. If <since> (a datetime) is given, only for the items fetched
+    # since then
     
     print('update_wm_data_timestamps - starting...')
     
@@ -866,9 +889,12 @@ def update_wm_data_timestamps():
                 INNER JOIN "Products_WmAz" as b
                 ON a.wm_id = b.wm_id
                 WHERE a.fetched IS NOT Null'''
-    datums = call_sql(con, sqlTxt, [], 'executeReturn')
+    if since:
+        sqlTxt += ' AND a.fetched >= %s'
     
-    if datums:
+    # A batch at a time, so the whole catalogue's timestamps are never in memory at once. record_timestamps writes on
+    # its own connection
+    for datums in call_sql(con, sqlTxt, [since] if since else [], 'executeStream', itersize=5000):
         record_timestamps(datums, 'wm_data')
     
     if con:
@@ -933,9 +959,8 @@ def update_wm_query_log(num, ts=None):
                 VALUES(%s, %s)
                 ON CONFLICT (timestamp) DO UPDATE
                 SET num_queries = "WmQueryLog".num_queries + %s'''
-    con = con_postgres()
-    theData = [ts, num, num]
-    call_sql(con, sqlTxt, theData, "executeNoReturn")
+    with pg_con() as con:
+        call_sql(con, sqlTxt, [ts, num, num], "executeNoReturn")
     
 
 def xml_json_err_check(apiStr, xmlOrJson):
@@ -0,0 +1,177 @@
+"""
+JobQueue's state transitions, run against the Postgres database in credentials.ini (each test uses its own queue, and
+deletes it afterwards). Skipped if there isn't one to connect to.
+"""
+
+import datetime
+import time
+import unittest
+import uuid
+
+from AmazonSelling.jobqueue import JobQueue
+from AmazonSelling.schema import newTables
+from AmazonSelling.tools import call_sql, con_postgres
+
+
+def setUpModule():
+
+    try:
+        con = con_postgres()
+    except Exception as e:
+        raise unittest.SkipTest('No Postgres to test JobQueue against: {}'.format(e))
+    for sqlTxt in newTables:
+        if '"Jobs"' in sqlTxt:
+            call_sql(con, sqlTxt, [], 'executeNoReturn')
+    con.close()
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.name = 'test.{}'.format(uuid.uuid4())
+
+    def tearDown(self):
+        con = con_postgres()
+        call_sql(con, '''DELETE FROM "Jobs" WHERE queue = %s''', [self.name], 'executeNoReturn')
+        con.close()
+
+    def make_queue(self, **kwargs):
+        q = JobQueue(self.name, **kwargs)
+        q.countFor = 0  # No cached counts
+        return q
+
+    def states(self):
+        con = con_postgres()
+        rows = call_sql(con, '''SELECT key, state, attempts FROM "Jobs" WHERE queue = %s ORDER BY key''', [self.name],
+                        'executeReturn')
+        con.close()
+        return {key: (state, attempts) for key, state, attempts in rows}
+
+    def other_worker(self, q):
+        other = self.make_queue(keyType=q.keyType, leaseFor=q.leaseFor, maxAttempts=q.maxAttempts)
+        other.worker = 'elsewhere:1'
+        return other
+
+    def test_ready_leased_done(self):
+        q = self.make_queue(items=['a', 'b'])
+        self.assertEqual(len(q), 2)
+        self.assertEqual(self.states(), {'a': ('ready', 0), 'b': ('ready', 0)})
+
+        self.assertEqual(sorted(q.pop_many(5)), [('a',), ('b',)])
+        self.assertEqual(self.states(), {'a': ('leased', 1), 'b': ('leased', 1)})
+        self.assertEqual(len(q), 0)
+
+        q.complete(['a'])
+        self.assertEqual(self.states()['a'][0], 'done')
+        q.complete(['a'])  # Twice does nothing
+        self.assertEqual(self.states()['a'][0], 'done')
+
+    def test_keys_come_back_as_key_type(self):
+        q = self.make_queue(keyType=int, items=[3, 1, 2])
+        self.assertEqual(sorted(q.pop_many(5)), [(1,), (2,), (3,)])
+
+    def test_no_job_is_claimed_twice(self):
+        q = self.make_queue(items=['a', 'b', 'c'])
+        mine = q.pop_many(2)
+        theirs = self.other_worker(q).pop_many(5)
+        self.assertEqual(len(mine) + len(theirs), 3)
+        self.assertFalse(set(mine) & set(theirs))
+
+    def test_release_puts_back(self):
+        q = self.make_queue(items=['a'])
+        q.pop_many(1)
+        q.release(['a'])
+        self.assertEqual(self.states(), {'a': ('ready', 1)})
+        self.assertEqual(q.pop_many(1), [('a',)])
+
+    def test_only_the_lease_holder_finishes(self):
+        q = self.make_queue(items=['a'])
+        q.pop_many(1)
+        self.other_worker(q).complete(['a'])
+        self.assertEqual(self.states()['a'][0], 'leased')
+
+    def test_fails_after_max_attempts(self):
+        q = self.make_queue(maxAttempts=2, items=['a'])
+        q.pop_many(1)
+        q.release(['a'])
+        q.pop_many(1)
+        q.release(['a'])
+        self.assertEqual(self.states(), {'a': ('failed', 2)})
+        self.assertEqual(len(q), 0)
+        self.assertEqual(q.pop_many(1), [])
+
+    def test_expired_last_lease_fails(self):
+        q = self.make_queue(maxAttempts=1, leaseFor=datetime.timedelta(0), items=['a'])
+        q.pop_many(1)
+        time.sleep(0.01)
+        q.sweptAt = 0
+        self.assertEqual(q.pop_many(1), [])
+        self.assertEqual(self.states(), {'a': ('failed', 1)})
+
+    def test_expired_lease_can_be_claimed_again(self):
+        q = self.make_queue(leaseFor=datetime.timedelta(0), items=['a'])
+        q.pop_many(1)
+        time.sleep(0.01)
+        self.assertEqual(self.other_worker(q).pop_many(1), [('a',)])
+        self.assertEqual(self.states(), {'a': ('leased', 2)})
+
+    def test_extend_retries_failed_unless_told_not_to(self):
+        q = self.make_queue(maxAttempts=1, items=['a'])
+        q.pop_many(1)
+        q.release(['a'])
+        self.assertEqual(self.states(), {'a': ('failed', 1)})
+
+        self.assertEqual(q.extend(['a'], retryFailed=False), 0)
+        self.assertEqual(self.states(), {'a': ('failed', 1)})
+
+        self.assertEqual(q.extend(['a']), 1)
+        self.assertEqual(self.states(), {'a': ('ready', 0)})
+
+    def test_done_is_only_redone_after_redo_after(self):
+        q = self.make_queue(items=['a', 'b'], redoAfter=datetime.timedelta(hours=1))
+        q.pop_many(2)
+        q.complete(['a', 'b'])
+        self.assertEqual(q.extend(['a', 'c']), 1)
+        self.assertEqual(self.states(), {'a': ('done', 1), 'b': ('done', 1), 'c': ('ready', 0)})
+
+        q2 = self.make_queue()  # redoAfter of 0
+        self.assertEqual(q2.extend(['a']), 1)
+        self.assertEqual(self.states()['a'], ('ready', 0))
+
+    def test_extend_raises_priority(self):
+        q = self.make_queue(scoreFunc=lambda item: item[1], longTailShare=0, items=[('a', 1), ('b', 2)])
+        q.extend([('a', 5), ('b', 0)])
+        self.assertEqual(q.pop_many(1), [('a',)])
+        self.assertEqual(q.pop_many(1), [('b',)])
+
+    def test_only_keys(self):
+        self.make_queue(items=['a', 'b', 'c'])
+        q = self.make_queue(onlyKeys=['b'])
+        self.assertEqual(len(q), 1)
+        self.assertEqual(q.pop_many(5), [('b',)])
+
+    def test_reclaim_host(self):
+        q = self.make_queue(items=['a'])
+        crashed = self.make_queue()
+        crashed.worker = '{}:0'.format(q.host)
+        crashed.pop_many(1)
+        q.reclaim_host()
+        self.assertEqual(self.states(), {'a': ('ready', 1)})
+
+    def test_prune(self):
+        q = self.make_queue(items=['a', 'b', 'c'], pruneAfter=datetime.timedelta(0))
+        q.pop_many(3)
+        q.complete(['a'])
+        q.release(['b'])
+        time.sleep(0.01)
+        q.prune()
+        self.assertEqual(self.states(), {'b': ('ready', 1), 'c': ('leased', 1)})
+
+    def test_discard(self):
+        q = self.make_queue(items=['a', 'b'])
+        q.discard('a')
+        self.assertEqual(list(self.states()), ['b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
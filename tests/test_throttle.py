@@ -0,0 +1,98 @@
+import math
+import time
+import unittest
+
+from AmazonSelling.throttle import TokenBucket, restore_time
+
+
+class FakeClock:
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+class TestRestoreTime(unittest.TestCase):
+
+    def test_no_deficit(self):
+        self.assertEqual(restore_time(0, 1.0), 0.0)
+        self.assertEqual(restore_time(-2, 1.0), 0.0)
+
+    def test_plain_rate(self):
+        self.assertAlmostEqual(restore_time(3, 0.5), 6.0)
+
+    def test_capped_then_full_rate(self):
+        # 1 token at 0.1/sec for the first 10 seconds, then the other 2 at 1/sec
+        self.assertAlmostEqual(restore_time(3, 1.0, capRate=0.1, capSecs=10), 12.0)
+
+    def test_cap_lasts_long_enough(self):
+        self.assertAlmostEqual(restore_time(0.5, 1.0, capRate=0.1, capSecs=10), 5.0)
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(10, 2.0, clock=self.clock, ceiling=2.0, floor=0.25, backoff=0.5, recovery=0.1)
+
+    def test_starts_full(self):
+        self.assertEqual(self.bucket.available(), 10)
+
+    def test_try_take(self):
+        self.assertTrue(self.bucket.try_take(8))
+        self.assertFalse(self.bucket.try_take(3))
+        self.assertAlmostEqual(self.bucket.available(), 2)
+
+    def test_restores_fractional_tokens(self):
+        self.bucket.try_take(10)
+        self.clock.now += 0.25
+        self.assertAlmostEqual(self.bucket.available(), 0.5)
+        self.clock.now += 100
+        self.assertEqual(self.bucket.available(), 10)  # Never more than the capacity
+
+    def test_take_sleeps_exactly_long_enough(self):
+        self.bucket.try_take(10)
+        waited = self.bucket.take(3, sleep=self.clock.sleep)
+        self.assertAlmostEqual(waited, 1.5)
+        self.assertAlmostEqual(self.bucket.available(), 0)
+
+    def test_wait_time(self):
+        self.bucket.try_take(9)
+        self.assertEqual(self.bucket.wait_time(1), 0)
+        self.assertAlmostEqual(self.bucket.wait_time(4), 1.5)
+
+    def test_more_than_capacity(self):
+        with self.assertRaises(ValueError):
+            self.bucket.take(11, sleep=self.clock.sleep)
+
+    def test_throttled_feedback_empties_and_backs_off(self):
+        self.bucket.feedback(throttled=True)
+        self.assertEqual(self.bucket.available(), 0)
+        self.assertAlmostEqual(self.bucket.rate, 1.0)
+        for _ in range(5):
+            self.bucket.feedback(throttled=True)
+        self.assertAlmostEqual(self.bucket.rate, 0.5)  # <floor> times the nominal rate
+
+    def test_unthrottled_feedback_recovers_up_to_ceiling(self):
+        self.bucket.feedback(throttled=True)
+        self.bucket.feedback()
+        self.assertAlmostEqual(self.bucket.rate, 1.2)
+        for _ in range(100):
+            self.bucket.feedback()
+        self.assertAlmostEqual(self.bucket.rate, 4.0)  # <ceiling> times the nominal rate
+
+    def test_hourly_quota_holds_rate_down(self):
+        self.bucket.feedback(remaining=36, resetsOn=time.time() + 3600)
+        self.assertAlmostEqual(self.bucket.rate, 0.01, places=4)
+        self.clock.now += 3601
+        self.assertGreater(self.bucket.rate, 0.01)
+        self.assertFalse(math.isinf(self.bucket.rate))
+
+
+if __name__ == '__main__':
+    unittest.main()
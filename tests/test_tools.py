@@ -0,0 +1,120 @@
+import datetime
+import unittest
+from collections import OrderedDict
+from decimal import Decimal
+
+import psycopg2.extras
+
+import AmazonSelling.tools
+from AmazonSelling.tools import copy_value, prepared_sql
+
+
+class TestCopyValue(unittest.TestCase):
+
+    def test_null_and_bools(self):
+        self.assertEqual(copy_value(None), '\\N')
+        self.assertEqual(copy_value(True), 'true')
+        self.assertEqual(copy_value(False), 'false')
+
+    def test_numbers(self):
+        self.assertEqual(copy_value(3), '3')
+        self.assertEqual(copy_value(1.5), '1.5')
+        self.assertEqual(copy_value(Decimal('19.90')), '19.90')
+
+    def test_dates(self):
+        self.assertEqual(copy_value(datetime.date(2017, 3, 4)), '2017-03-04')
+        self.assertEqual(copy_value(datetime.datetime(2017, 3, 4, 5, 6, 7)), '2017-03-04T05:06:07')
+        self.assertEqual(copy_value(datetime.timedelta(minutes=2)), '120.0 seconds')
+
+    def test_escapes_copy_specials(self):
+        self.assertEqual(copy_value('a\\b\tc\nd\re'), 'a\\\\b\\tc\\nd\\re')
+
+    def test_arrays(self):
+        self.assertEqual(copy_value(['a', 'b']), '{"a","b"}')
+        self.assertEqual(copy_value((1, None)), '{"1",NULL}')
+        self.assertEqual(copy_value([[1, 2], [3, 4]]), '{{"1","2"},{"3","4"}}')
+        self.assertEqual(copy_value([]), '{}')
+
+    def test_array_elements_are_quoted_and_escaped(self):
+        # The element's quote and backslash are escaped for the array literal, and then the backslashes for COPY
+        self.assertEqual(copy_value(['say "hi"', 'a,b', 'c\\d']), '{"say \\\\"hi\\\\"","a,b","c\\\\\\\\d"}')
+
+    def test_json(self):
+        self.assertEqual(copy_value({'k': 1}), '{"k": 1}')
+        self.assertEqual(copy_value({'k': 'x\ny'}), '{"k": "x\\\\ny"}')
+        self.assertEqual(copy_value(psycopg2.extras.Json([1, 2])), '[1, 2]')
+
+    def test_bytes(self):
+        self.assertEqual(copy_value(b'\x00\xff'), '\\\\x00ff')
+
+
+class FakeCursor:
+
+    def __init__(self, executed):
+        self.executed = executed
+
+    def execute(self, sqlTxt, theData=None):
+        self.executed.append(sqlTxt)
+
+    def close(self):
+        pass
+
+
+class FakeCon:
+    # Just what prepared_sql uses of a PgPool connection
+
+    def __init__(self):
+        self.prepared = OrderedDict()
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self.executed)
+
+
+class TestPreparedSql(unittest.TestCase):
+
+    def test_numbers_the_parameters(self):
+        con = FakeCon()
+        theStmt = prepared_sql(con, 'SELECT a FROM t WHERE b = %s AND c = ANY(%s)')
+        name = con.prepared['SELECT a FROM t WHERE b = %s AND c = ANY(%s)'][0]
+        self.assertEqual(con.executed, ['PREPARE {} AS SELECT a FROM t WHERE b = $1 AND c = ANY($2)'.format(name)])
+        self.assertEqual(theStmt, 'EXECUTE {}(%s, %s)'.format(name))
+
+    def test_literal_percents(self):
+        con = FakeCon()
+        theStmt = prepared_sql(con, "SELECT a FROM t WHERE b LIKE 'x%%' AND c = %s")
+        name = theStmt.split()[1].split('(')[0]
+        self.assertEqual(con.executed, ["PREPARE {} AS SELECT a FROM t WHERE b LIKE 'x%' AND c = $1".format(name)])
+
+    def test_no_parameters(self):
+        con = FakeCon()
+        theStmt = prepared_sql(con, 'SELECT 1')
+        self.assertRegex(theStmt, r'^EXECUTE stmt_\d+$')
+
+    def test_prepares_once(self):
+        con = FakeCon()
+        first = prepared_sql(con, 'SELECT %s')
+        self.assertEqual(prepared_sql(con, 'SELECT %s'), first)
+        self.assertEqual(len(con.executed), 1)
+
+    def test_left_alone(self):
+        self.assertEqual(prepared_sql(FakeCon(), 'SELECT %(a)s'), 'SELECT %(a)s')
+        self.assertEqual(prepared_sql(object(), 'SELECT %s'), 'SELECT %s')  # Not a PgPool connection
+
+    def test_least_recently_used_is_deallocated(self):
+        con = FakeCon()
+        oldMax, AmazonSelling.tools.maxPrepared = AmazonSelling.tools.maxPrepared, 2
+        try:
+            prepared_sql(con, 'SELECT 1')
+            prepared_sql(con, 'SELECT 2')
+            prepared_sql(con, 'SELECT 1')  # So 'SELECT 2' is the least recently used
+            name2 = con.prepared['SELECT 2'][0]
+            prepared_sql(con, 'SELECT 3')
+        finally:
+            AmazonSelling.tools.maxPrepared = oldMax
+        self.assertEqual(list(con.prepared), ['SELECT 1', 'SELECT 3'])
+        self.assertIn('DEALLOCATE {}'.format(name2), con.executed)
+
+
+if __name__ == '__main__':
+    unittest.main()
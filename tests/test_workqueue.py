@@ -0,0 +1,92 @@
+import unittest
+
+from AmazonSelling.routine import PriorityWorkQueue
+from AmazonSelling.tools import WorkQueue
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def test_fifo(self):
+        q = WorkQueue(['a', 'b', 'c'])
+        self.assertEqual(q.pop_many(2), ['a', 'b'])
+        self.assertEqual(q.pop_many(5), ['c'])
+        self.assertEqual(q.pop_many(5), [])
+
+    def test_skips_duplicates_by_first_column(self):
+        q = WorkQueue([('a', 1), ('b', 2)])
+        self.assertEqual(q.extend([('a', 3), ('c', 4), ('c', 5)]), 1)
+        self.assertEqual(len(q), 3)
+        self.assertEqual(q.pop_many(3), [('a', 1), ('b', 2), ('c', 4)])  # The first row for a key is the one kept
+
+    def test_popped_items_can_be_added_again(self):
+        q = WorkQueue(['a'])
+        q.pop_many(1)
+        self.assertEqual(q.extend(['a']), 1)
+        self.assertIn('a', q)
+
+    def test_key(self):
+        self.assertEqual(WorkQueue.key(('a', 1)), 'a')
+        self.assertEqual(WorkQueue.key(['b', 2]), 'b')
+        self.assertEqual(WorkQueue.key('c'), 'c')
+
+    def test_discard(self):
+        q = WorkQueue(['a', 'b'])
+        q.discard(('a', 9))
+        q.discard('z')
+        self.assertEqual(q.pop_many(2), ['b'])
+
+    def test_complete_and_release_do_nothing(self):
+        q = WorkQueue(['a', 'b'])
+        q.pop_many(1)
+        q.complete(['a'])
+        q.release(['a'])
+        self.assertEqual(q.pop_many(2), ['b'])
+
+
+class TestPriorityWorkQueue(unittest.TestCase):
+
+    def score(self, item):
+        return item[1]
+
+    def test_highest_score_first(self):
+        q = PriorityWorkQueue(self.score, longTailShare=0, items=[('a', 1), ('b', 3), ('c', 2)])
+        self.assertEqual([item[0] for item in q.pop_many(3)], ['b', 'c', 'a'])
+
+    def test_ties_go_in_the_order_they_were_added(self):
+        q = PriorityWorkQueue(self.score, longTailShare=0, items=[('a', 1), ('b', 1), ('c', 1)])
+        self.assertEqual([item[0] for item in q.pop_many(3)], ['a', 'b', 'c'])
+
+    def test_long_tail_goes_to_the_oldest(self):
+        q = PriorityWorkQueue(self.score, longTailShare=0.25, items=[('old', 0), ('a', 5), ('b', 4), ('c', 3)])
+        self.assertEqual([item[0] for item in q.pop_many(4)], ['old', 'a', 'b', 'c'])
+        q.extend([('old', 0), ('a', 5), ('b', 4), ('c', 3)])
+        self.assertEqual([item[0] for item in q.pop_many(2)], ['old', 'a'])  # ceil(2 * 0.25) from the tail
+
+    def test_skips_duplicates(self):
+        q = PriorityWorkQueue(self.score, longTailShare=0, items=[('a', 1)])
+        self.assertEqual(q.extend([('a', 9), ('b', 2)]), 1)
+        self.assertEqual(q.pop_many(5), [('b', 2), ('a', 1)])  # The duplicate's score isn't taken
+
+    def test_readded_after_pop(self):
+        q = PriorityWorkQueue(self.score, longTailShare=0.5, items=[('a', 1), ('b', 2)])
+        q.pop_many(2)
+        q.extend([('a', 3)])
+        self.assertEqual(len(q), 1)
+        self.assertEqual(q.pop_many(2), [('a', 3)])
+
+    def test_discard(self):
+        q = PriorityWorkQueue(self.score, longTailShare=0, items=[('a', 1), ('b', 2), ('c', 3)])
+        q.discard('c')
+        self.assertEqual([item[0] for item in q.pop_many(3)], ['b', 'a'])
+
+    def test_stale_heap_entries_are_dropped(self):
+        q = PriorityWorkQueue(self.score, longTailShare=1.0)
+        for i in range(200):
+            q.extend([('k{}'.format(i), i)])
+            q.pop_many(1)  # All from the tail, so every heap entry goes stale
+        self.assertLessEqual(len(q.heap), 2 * len(q.items) + 65)
+        self.assertEqual(len(q), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()